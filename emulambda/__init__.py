@@ -1,14 +1,17 @@
 from __future__ import print_function
+import sys
+import time
+
+# When emulambda started loading, and how many modules were loaded then, for --startup-report.
+_LOADING = time.time(), len(sys.modules)
+
 import argparse
+import functools
 import gc
 from importlib import import_module
-import imp
-import json
+import importlib.util
 import os
-import sys
-import time
 import traceback
-import boto3
 
 
 USING_WINDOWS=False
@@ -19,60 +22,340 @@ else:
     USING_WINDOWS=True
     import psutil
 
-from emulambda.timeout import timeout, TimeoutError
-from emulambda.render import render_result, render_summary
+from emulambda.timeout import Deadline, TimeoutError, remaining_millis
+from emulambda.render import flush_results, render_batches, render_imports, render_load, render_profile, \
+    render_reload, render_result, render_routes, render_startup, render_summary, render_sweep
+from emulambda.stats import merge_stats, new_stats, record_stats
+from emulambda.gcpolicy import GCPolicy, parse_policy
+from emulambda.eventfile import Checkpoint, read_events
+from emulambda import credentials, memo, serializer
+from emulambda.memory import BACKENDS, get_meter
+from emulambda.loadgen import ARRIVALS, THROTTLING
+from emulambda.logs import LogCapture
+from emulambda.manifest import Router, is_manifest, load_manifest
+from emulambda.metrics import FORMATS as METRICS_FORMATS, get_sink
+from emulambda.profiler import KINDS as PROFILERS, get_profiler
+from emulambda.importtime import ImportRecorder, enable_lazy_imports
+from emulambda.sources import SOURCES, emit_batches
+from emulambda.startup import StartupTimer
+
+# Modes needing multiprocessing or http.server import their modules when they are entered, so that the commoner
+# modes start without them.
+_LOADED = time.time(), len(sys.modules)
 
 __author__ = 'dominiczippilli'
 __description__ = 'A local emulator for AWS Lambda for Python.'
 
 
 def main():
+    """
+    Run emulambda with the command line arguments, or the `trace-report` subcommand.
+    :return: Statistics dictionary of the invocations run, as from `new_stats()`.
+    """
+    if sys.argv[1:2] == ['trace-report']:
+        from emulambda.trace import report_main
+        return report_main(sys.argv[2:])
     sys.path.append(os.getcwd())
     sys.path.append("./lib")
     args = parseargs()
+    startup = StartupTimer(_LOADING, _LOADED) if args.startup_report else None
 
-    # Get process peak RSS memory before execution
-    pre_rss = get_memory_usage()
+    credentials.default_cache.endpoint_url = args.sts_endpoint
+    try:
+        serializer.select(args.json)
+    except ValueError as e:
+        print(str(e))
+        sys.exit(1)
+
+    # Read the manifest of functions to route events to, if given one
+    try:
+        router = Router(load_manifest(args.lambdapath), args.route_field, args.timeout, args.dump_samples) \
+            if args.manifest else None
+    except (IOError, ValueError) as e:
+        print(str(e))
+        sys.exit(1)
+
+    # Get a memory meter, which takes process memory before execution
+    try:
+        meter = get_meter(args.memory)
+    except ValueError as e:
+        print(str(e))
+        sys.exit(1)
 
-    # Import the lambda
-    lfunc = import_lambda(args.lambdapath)
+    # Get a profiler, if asked for; it calibrates itself before the lambda is loaded
+    profiler = get_profiler(args.profile, args.profile_interval / 1000.0) if args.profile else None
 
     # Build statistics dictionary
-    stats = {'clock': list(), 'rss': list()}
+    stats = new_stats(args.dump_samples)
+
+    # Time garbage collections, and force them as the policy says. Containers collect and time their own.
+    policy = GCPolicy('never', timed=False) if args.containers else GCPolicy(args.gc, meter, stats)
+
+    # Open the metrics file, if asked for
+    sink = get_sink(args.metrics, args.metrics_format) if args.metrics else None
+
+    # Capture the function's output to a log file, if asked for
+    capture = LogCapture(args.log_file, stats) if args.log_file else None
+
+    # Trace the wall time, CPU time, context switches and I/O of every invocation, if asked for
+    if args.trace:
+        from emulambda.trace import Tracer
+        try:
+            tracer = Tracer(args.trace)
+        except ValueError as e:
+            print(str(e))
+            sys.exit(1)
+    else:
+        tracer = None
+
+    if args.containers:
+        # Run the lambda in recyclable containers rather than importing it here
+        from emulambda.container import Container
+        from emulambda.forking import ForkServer
+        container = (ForkServer if args.fork_server else Container)(args, args.recycle_invokes, args.recycle_idle,
+                                                                    args.memory_size, stats)
+        lfunc = None
+        pending_init = list()
+    else:
+        container = None
+        enable_lazy_imports() if args.lazy_imports else None
+        imports = ImportRecorder() if args.import_profile else None
+        startup.mark('Emulambda setup') if startup else None
+        # Import the lambda, timing it as the cold start of our one and only container
+        imports.start() if imports else None
+        s = time.time()
+        try:
+            if router:
+                # Import every function of the manifest, each timed as its own cold start
+                router.load()
+                lfunc = None
+            else:
+                lfunc = import_lambda(args.lambdapath)
+        finally:
+            imports.stop() if imports else None
+        pending_init = list() if router else [(time.time() - s) * 1000]  # convert to ms
+        startup.mark('Handler import', handler=True) if startup else None
+        render_imports(imports, args.lambdapath, args.profile_top) if imports and args.verbose else None
+        render_startup(startup, args.lambdapath) if startup else None
+
+    if args.watch:
+        # Watch the modules of the lambda, to reload it when they change
+        from emulambda.reload import Reloader, get_watcher
+        reloader = Reloader(args.lambdapath, get_watcher(args.watch_interval))
+    else:
+        reloader = None
+    last = list()
+
+    # Keep results by event, to return instead of running the lambda again, if asked to
+    cache = memo.Memo(memo.code_fingerprint(args.lambdapath, lfunc), args.memo_size, args.memo_store,
+                      args.memo_verify, args.seed) if args.memoize else None
+
+    def run(_event=None, _context=None, _route=None, _index=0):
+        """
+        Run the lambda on an event, in a container if we have one.
+        :param _event: A valid Lambda _event object.
+        :param _route: Route of the manifest function to run, if running a manifest.
+        :param _index: Line number of the event in its stream, for the trace.
+        :return: Function result, execution time, execution RSS and init time (None for warm invocations).
+        """
+        if container:
+            return container.invoke(_event, _context)
 
-    def execute(_event=None, _context=None):
+        # Invoke the lambda
+        func, timeout, init = (_route.func, _route.timeout, _route.pending_init) if _route else \
+            (lfunc, args.timeout, pending_init)
+        # Claim the cold start before invoking, so that of invocations served concurrently, the first to start has it
+        try:
+            exec_init = init.pop()
+        except IndexError:
+            exec_init = None
+        capture.start() if capture else None
+        meter.start()
+        tracer.start() if tracer else None
+        result, exec_clock = invoke_lambda(func, _event, _context, timeout, args.role, profiler)
+        tracer.stop(_index, exec_clock < 0, exec_init is not None) if tracer else None
+
+        # Get peak memory of the execution
+        exec_rss = meter.stop()
+        capture.stop(exec_clock, exec_rss, exec_init) if capture else None
+        return result, exec_clock, exec_rss, exec_init
+
+    def execute(_event=None, _context=None, _index=1):
         """
         Encapsulation of _event-running code, with access to collectors and other variables in main() scope. Used
         for both single-run and stream modes.
         :param _event: A valid Lambda _event object.
+        :param _index: Line number of the event in its stream.
         :return: Void.
         """
-        # Invoke the lambda
         # TODO consider refactoring to pass stats through function
-        result, exec_clock = invoke_lambda(lfunc, _event, _context, args.timeout, args.role)
+        last[:] = [(_event, _context, _index)]
+        s = time.time()
+        key = cache.key(_event) if cache else None
+        memoized = cache.get(key) if key else None
+        if memoized is not None and not cache.sample():
+            # Return the memoized result; its statistics are kept apart from those of executions
+            stats['memo_hit'].add((time.time() - s) * 1000)  # convert to ms
+            stats['memo_saved'].add(memoized[1])
+            render_result(args.verbose, args.lambdapath, memoized[0], memoized[1], memoized[2], memoized=True)
+            return
+
+        route = router.route(_event) if router else None
+        if router and route is None:
+            print("No function of the manifest for event field %s=%s." % (
+                args.route_field, serializer.dumps(_event.get(args.route_field) if isinstance(_event, dict) else None)))
+            result, exec_clock, exec_rss, exec_init = "EMULAMBDA: ROUTING ERROR", -1, 0, None
+        else:
+            result, exec_clock, exec_rss, exec_init = run(_event, _context, route, _index)
 
-        # Get process peak RSS memory after execution
-        exec_rss = get_memory_usage() - pre_rss
+        if memoized is not None:
+            # A hit sampled for verification: compare the result with the memoized one
+            stats['memo_verified'] += 1
+            if exec_clock < 0 or not memo.same(memoized[0], result):
+                stats['memo_mismatches'] += 1
+                print("Nondeterminism detected: the result for line %i differs from the memoized one." % _index)
+        elif key and exec_clock >= 0:
+            cache.put(key, result, exec_clock, exec_rss)
 
         # Store statistics
-        stats['clock'].append(exec_clock)
-        stats['rss'].append(exec_rss)
+        record_stats(stats, exec_clock, exec_rss, exec_init)
+        router.record(route, exec_clock, exec_rss, exec_init) if route else None
+        sink.record(_index, result, exec_clock, exec_rss, exec_init, container.last_gc if container else policy.last) \
+            if sink else None
 
         # Render the result
-        render_result(args.verbose, args.lambdapath, result, exec_clock, exec_rss)
-
-    if args.stream:
-        # Enter stream mode
-        emit_to_function(args.verbose, args.eventfile, execute)
-        render_summary(stats) if args.verbose else None
-    elif args.contextfile:
-        context = read_file_to_object(args.contextfile)
-        event = read_file_to_string(args.eventfile)
-        execute(parse_event(event), context)
-    else:
-        # Single event mode
-        event = read_file_to_string(args.eventfile)
-        execute(parse_event(event))
+        render_result(args.verbose, route.name if route else args.lambdapath, result, exec_clock, exec_rss, exec_init)
+
+    def collect(i, line, result, exec_clock, exec_rss, exec_init, exec_gc=None):
+        """
+        Render a result coming back from a worker process. Workers keep their own statistics.
+        :return: Void.
+        """
+        sink.record(i, result, exec_clock, exec_rss, exec_init, exec_gc) if sink else None
+        print(
+            "\nObject %i %s" % (i, line.rstrip()[:65] + ('...' if len(line) > 65 else ''))) if args.verbose else None
+        render_result(args.verbose, args.lambdapath, result, exec_clock, exec_rss, exec_init)
+
+    try:
+        checkpoint = Checkpoint(args.checkpoint, start=args.start, end=args.end, step=args.sample, part=args.part) \
+            if args.stream and args.checkpoint else None
+    except ValueError as e:
+        print(str(e))
+        sys.exit(1)
+    if checkpoint and checkpoint.resumed:
+        print("Resuming after line %i, from checkpoint %s." % (checkpoint.resumed, args.checkpoint)) \
+            if args.verbose else None
+
+    def tally(i, line, result, exec_clock, exec_rss, exec_init):
+        """
+        Store the statistics of, and render, a result coming back out of order.
+        :return: Void.
+        """
+        record_stats(stats, exec_clock, exec_rss, exec_init)
+        collect(i, line, result, exec_clock, exec_rss, exec_init)
+
+    try:
+        if args.memory_sweep:
+            # Run the stream once per memory size
+            from emulambda.tiers import sweep
+            render_sweep(sweep(args, args.memory_sweep))
+        elif args.serve is not None:
+            # Enter server mode
+            from emulambda.server import Function, serve
+            if router:
+                functions = dict((route.name, Function(route.name, functools.partial(run, _route=route),
+                                                       args.dump_samples)) for route in router)
+            else:
+                name = args.function_name or args.lambdapath
+                functions = {name: Function(name, run, args.dump_samples)}
+            serve((args.host, args.serve), functions, args.concurrency, args.verbose)
+        elif args.stream and args.load:
+            # Enter load generation mode
+            print("Entering load generation mode, with %i warm workers." % args.concurrency) if args.verbose else None
+            from emulambda.loadgen import emit_load
+            worker_stats, report = emit_load(args, collect, checkpoint, profiler)
+            stats = merge_stats(worker_stats)
+            render_summary(stats, profiler, args.profile_top) if args.verbose else None
+            flush_results()
+            render_load(report, args.concurrency, args.throttle)
+        elif args.stream and args.workers > 1:
+            # Enter parallel stream mode
+            print("Entering stream mode with %i workers." % args.workers) if args.verbose else None
+            from emulambda.workers import emit_to_workers
+            worker_stats = emit_to_workers(args, collect, checkpoint, profiler)
+            render_summary(worker_stats, profiler, args.profile_top) if args.verbose else None
+            stats = merge_stats(worker_stats)
+        elif args.stream and args.asyncio:
+            # Enter asyncio stream mode. Imported here, as the asyncio engine needs Python 3.
+            from emulambda.aio import emit_to_function_async
+            print("Entering asyncio stream mode, with up to %i invocations in flight." % args.concurrency) \
+                if args.verbose else None
+            emit_to_function_async(args, lfunc, run, tally, meter, pending_init, checkpoint, policy)
+            render_summary(stats) if args.verbose else None
+        elif args.stream and args.source:
+            # Enter event source mode
+            print("Entering %s event source mode, with batches of up to %i records." % (args.source, args.batch_size)) \
+                if args.verbose else None
+            report = emit_batches(args, run, tally, checkpoint)
+            render_summary(stats, profiler, args.profile_top) if args.verbose else None
+            render_batches(report, args.source, args.batch_size, args.memory_size or 128) if args.verbose else None
+        elif args.stream:
+            # Enter stream mode
+            emit_to_function(args.verbose, args.eventfile, execute, args.start, args.end, args.sample, args.part,
+                             checkpoint, policy, indexed=True)
+            capture.flush() if capture else None
+            render_summary(stats, profiler, args.profile_top) if args.verbose else None
+            render_routes(router) if router and args.verbose else None
+        elif args.contextfile:
+            context = read_file_to_object(args.contextfile)
+            event = read_file_to_string(args.eventfile)
+            execute(parse_event(event), context)
+            render_profile(profiler, args.profile_top) if profiler and args.verbose else None
+        else:
+            # Single event mode
+            event = read_file_to_string(args.eventfile)
+            execute(parse_event(event))
+            render_profile(profiler, args.profile_top) if profiler and args.verbose else None
+
+        while reloader:
+            # Watch mode: reload the lambda when its modules change, and replay events to it
+            flush_results()
+            capture.flush() if capture else None
+            print("\nWatching %i modules of %s for changes (%s)." % (len(reloader.graph.files), args.lambdapath,
+                                                                     reloader.watcher.kind))
+            try:
+                changed = reloader.wait()
+            except KeyboardInterrupt:
+                break
+            try:
+                lfunc, reloaded, elapsed = reloader.reload(changed)
+            except Exception:
+                print("\nThere was an error reloading your function.\n")
+                traceback.print_exc()
+                continue
+            # The reloaded code starts cold
+            pending_init[:] = [elapsed * 1000]  # convert to ms
+            if cache:
+                cache.fingerprint = memo.code_fingerprint(args.lambdapath, lfunc)
+            render_reload(changed, reloaded, elapsed)
+            stats.update(new_stats(args.dump_samples))
+            if args.watch_events:
+                emit_to_function(args.verbose, args.watch_events, execute, policy=policy, indexed=True)
+                render_summary(stats, profiler, args.profile_top) if args.verbose else None
+            elif last:
+                execute(*last[0])
+    finally:
+        flush_results()
+        profiler.write(args.profile_output) if profiler and args.profile_output else None
+        checkpoint.save() if checkpoint else None
+        container.close() if container else None
+        policy.close()
+        sink.close(stats) if sink else None
+        capture.close() if capture else None
+        reloader.close() if reloader else None
+        cache.close() if cache else None
+        tracer.close() if tracer else None
+    return stats
 
 
 def parseargs():
@@ -83,8 +366,12 @@ def parseargs():
     parser = argparse.ArgumentParser(
         description='Python AWS Lambda Emulator. At present, AWS Lambda supports Python 2.7 only.')
     parser.add_argument('lambdapath',
-                        help='An import path to your function, as you would give it to AWS: `module.function`.')
-    parser.add_argument('eventfile', help='A JSON file to give as the `event` argument to the function.')
+                        help='An import path to your function, as you would give it to AWS: `module.function`. Or a '
+                             'manifest of several functions (a SAM template, or a JSON or YAML list of handlers) to '
+                             'route events to by --route-field.')
+    parser.add_argument('eventfile', help='A JSON file to give as the `event` argument to the function. Not used '
+                                          'with --serve.',
+                        nargs='?')
     parser.add_argument('contextfile', help='A JSON file to give as the `context` argument to the function.',
                         nargs='?')
     # TODO -- investigate if stream can be auto-detected
@@ -92,12 +379,326 @@ def parseargs():
                         action='store_true')
     parser.add_argument('-r', '--role', help='ARN of the role to execute your Lambda function (your user must have AssumeRole priviledge and your user ARN must be in Lambda\'s execution role TrustedPolicy).',
                         type=str)
-    parser.add_argument('-t', '--timeout', help='Execution timeout in seconds. Default is 300, the AWS maximum.',
-                        type=int,
+    parser.add_argument('--sts-endpoint', help='STS endpoint URL to assume `--role` through, e.g. a local stub. '
+                                               'Default is AWS.',
+                        type=str)
+    parser.add_argument('-t', '--timeout', help='Execution timeout in seconds, e.g. 0.5. Default is 300, the AWS '
+                                                'maximum.',
+                        type=float,
                         default=300)
+    parser.add_argument('--start', help='Stream mode only. First line of the stream to run (1-based).',
+                        type=int,
+                        default=1)
+    parser.add_argument('--end', help='Stream mode only. Last line of the stream to run.',
+                        type=int)
+    parser.add_argument('--sample', help='Stream mode only. Run every Nth line of the stream.',
+                        type=int,
+                        default=1,
+                        metavar='N')
+    parser.add_argument('--part', help='Stream mode only. Run only part K of the stream file split into N byte ranges, '
+                                       'e.g. 2/4, to share a file between parallel consumers.',
+                        type=_part,
+                        metavar='K/N')
+    parser.add_argument('--checkpoint', help='Stream mode only. File to record progress in. If it exists, the run '
+                                             'resumes after the line it records.')
+    parser.add_argument('-w', '--workers', help='Stream mode only. Number of worker processes to fan events out to. '
+                                              'Each worker imports the function once. Default is 1 (no workers).',
+                        type=int,
+                        default=1)
+    parser.add_argument('--chunk-size', help='Parallel stream mode only. Number of events sent to a worker at a time.',
+                        type=int,
+                        default=16)
+    parser.add_argument('--unordered', help='Parallel stream mode only. Render results as they finish rather than '
+                                            'in input order.',
+                        action='store_true')
+    parser.add_argument('--asyncio', help='Stream mode only. Run up to --concurrency invocations at once on an event '
+                                          'loop. Coroutine functions are awaited; others run on a thread pool.',
+                        action='store_true')
+    parser.add_argument('--replay-field', help='Asyncio stream and event source modes only. Field of each event '
+                                               'holding its arrival time (epoch seconds or ISO 8601), to replay events '
+                                               'at their recorded rate, or to close batches by --batch-window.')
+    parser.add_argument('--load', help='Stream mode only. Generate load: events arrive at a `fixed` --rate, as a '
+                                       '`poisson` process of that rate, or at the times of --replay-field (`replay`), '
+                                       'whether or not earlier invocations have finished, and run on --concurrency '
+                                       'warm workers.',
+                        choices=ARRIVALS)
+    parser.add_argument('--rate', help='Load generation mode only. Events per second, for fixed and Poisson arrivals.',
+                        type=float)
+    parser.add_argument('--throttle', help='Load generation mode only. What happens to events arriving with '
+                                           '--concurrency invocations running: they `queue` (default) for a free '
+                                           'worker, or are rejected (`reject`), as synchronous invocations are.',
+                        choices=THROTTLING,
+                        default='queue')
+    parser.add_argument('--seed', help='Load generation and memoization modes only. Seed of the Poisson process, or of '
+                                       'the choice of hits to --memo-verify, for repeatable runs.',
+                        type=int)
+    parser.add_argument('--source', help='Stream mode only. Take each line as a raw record of this event source, and '
+                                         'invoke the function with batches of them, as Lambda polls the source.',
+                        choices=SOURCES)
+    parser.add_argument('--batch-size', help='Event source mode only. Largest number of records in a batch. Default '
+                                             'is 10.',
+                        type=int,
+                        default=10)
+    parser.add_argument('--batch-window', help='Event source mode only. Seconds a batch stays open for more records '
+                                               'after its first, by the arrival times of --replay-field.',
+                        type=float,
+                        metavar='SECONDS')
+    parser.add_argument('--max-attempts', help='Event source mode only. Deliveries of a failed record before it is '
+                                               'dropped. Default is 3.',
+                        type=int,
+                        default=3)
+    parser.add_argument('--partition-key', help='Event source mode only. Field of each record to use as the Kinesis '
+                                                'partition key or the DynamoDB key. Default is the line number.',
+                        metavar='FIELD')
+    parser.add_argument('--route-field', help='Manifest mode only. Field of each event naming the function (or '
+                                              'handler) to route it to. Default is `function`.',
+                        default='function',
+                        metavar='FIELD')
+    parser.add_argument('--recycle-invokes', help='Run the function in a container subprocess, and recycle it (cold '
+                                                  'start a fresh one) after this many invocations.',
+                        type=int)
+    parser.add_argument('--recycle-idle', help='Run the function in a container subprocess, and recycle it (cold start '
+                                               'a fresh one) after it has been idle for this many seconds.',
+                        type=float)
+    parser.add_argument('--fork-server', help='Import the function once in a zygote container, and run every '
+                                              'invocation in a child forked from it, so that no invocation can leak '
+                                              'state into the next or crash the run.',
+                        action='store_true')
+    parser.add_argument('--fork-batch', help='Fork server mode only. Number of invocations each forked child runs. '
+                                             'Default is 1.',
+                        type=int,
+                        default=1,
+                        metavar='N')
+    parser.add_argument('--memory-size', help='Run the function in a container held to the memory and CPU share of '
+                                              'this memory size in MB, e.g. 128, as configured for the function.',
+                        type=_memory_size,
+                        metavar='MB')
+    parser.add_argument('--memory-sweep', help='Stream mode only. Run the stream at each of these memory sizes, '
+                                               'e.g. 128,256,512, and print a cost and latency table.',
+                        type=_memory_sizes,
+                        metavar='MB,MB,...')
+    parser.add_argument('-m', '--memory', help='Memory measurement backend. `rusage` (default) is the cheapest, but '
+                                               'reports the process high-water mark. `proc` resets the Linux peak RSS '
+                                               'before every invocation. `tracemalloc` measures Python allocations.',
+                        choices=BACKENDS,
+                        default='rusage')
+    parser.add_argument('--gc', help='When to force a full garbage collection: `always` (default) before every '
+                                     'invocation, `never`, `every-N` (e.g. every-100) invocations, or `adaptive`, only '
+                                     'when the memory backend measures every invocation separately, and then only the '
+                                     'young generations unless the oldest is near its threshold. Collection times '
+                                     'are shown in the summary.',
+                        type=parse_policy,
+                        default='always',
+                        metavar='POLICY')
+    parser.add_argument('--metrics', help='Write a record per invocation, and the summary of the run, to this file '
+                                          'for machines to read. Not available with --serve or --memory-sweep.',
+                        metavar='FILE')
+    parser.add_argument('--metrics-format', help='Format of the --metrics file: `jsonl`, `csv` (with the summary in '
+                                                 'a .summary.csv file beside it) or a `prometheus` textfile. By '
+                                                 'default, .csv and .prom files are CSV and Prometheus, and others '
+                                                 'JSONL.',
+                        choices=METRICS_FORMATS)
+    parser.add_argument('--log-file', help='Capture what the function prints and logs, and write it to this file with '
+                                           'START, END and REPORT lines, as in CloudWatch Logs. Not available with '
+                                           '--workers, --load, --asyncio, --serve or containers.',
+                        metavar='FILE')
+    parser.add_argument('--trace', help='Append a record of the wall time, CPU time, context switches and block I/O '
+                                        'of every invocation to this binary trace file. Summarize and compare traces '
+                                        'with `emulambda trace-report FILE...`.',
+                        metavar='FILE')
+    parser.add_argument('--dump-samples', help='Stream mode only. Keep every raw timing sample and print them in the '
+                                               'summary. Uses memory proportional to the stream.',
+                        action='store_true')
+    parser.add_argument('--profile', help='Profile the function\'s CPU time, across every invocation. `cprofile` '
+                                          'traces every call; `sample` samples the stack, with less overhead. The hot '
+                                          'functions are shown in the summary. Not available with --asyncio, --serve '
+                                          'or containers.',
+                        choices=PROFILERS)
+    parser.add_argument('--profile-output', help='File to write the profile to: pstats for `cprofile`, collapsed '
+                                                 'stacks (for flame graphs) for `sample`.',
+                        metavar='FILE')
+    parser.add_argument('--profile-top', help='Number of hot functions, or slowest imports, to show. Default is 10.',
+                        type=int,
+                        default=10,
+                        metavar='N')
+    parser.add_argument('--profile-interval', help='Milliseconds between stack samples of the `sample` profiler. '
+                                                   'Default is 5.',
+                        type=float,
+                        default=5,
+                        metavar='MS')
+    parser.add_argument('--import-profile', help='Record the tree of modules imported while loading the function, '
+                                                 'and show the slowest in verbose mode. Not available with '
+                                                 'containers.',
+                        action='store_true')
+    parser.add_argument('--lazy-imports', help='Defer running each Python module imported while loading and running '
+                                               'the function until it is first used, to measure what lazy imports '
+                                               'would save from the cold start.',
+                        action='store_true')
+    parser.add_argument('--startup-report', help='Show how long emulambda took to start, phase by phase, against how '
+                                                 'long the function took to import. Not available with containers.',
+                        action='store_true')
+    parser.add_argument('--watch', help='After running, watch the modules of the function, and when they change, '
+                                        'reload them and the modules importing them (leaving other modules loaded), '
+                                        'and replay the last event, or --watch-events. Runs until interrupted.',
+                        action='store_true')
+    parser.add_argument('--watch-events', help='Watch mode only. LDJSON file of events to replay after every reload, '
+                                               'instead of the last event.',
+                        metavar='FILE')
+    parser.add_argument('--watch-interval', help='Watch mode only. Seconds between checks for changes, where inotify '
+                                                 'is not available. Default is 0.5.',
+                        type=float,
+                        default=0.5,
+                        metavar='SECONDS')
+    parser.add_argument('--memoize', help='Return the result of an earlier invocation with the same event (by a hash '
+                                          'of the normalized event and of the function\'s code) instead of running '
+                                          'the function again. Only for deterministic functions. Hits are left out of '
+                                          'the statistics, metrics and logs, and summarized on their own.',
+                        action='store_true')
+    parser.add_argument('--memo-size', help='Memoization mode only. Most results to keep in memory, dropping the '
+                                            'least recently used. Default is %i.' % memo.DEFAULT_SIZE,
+                        type=int,
+                        default=memo.DEFAULT_SIZE,
+                        metavar='N')
+    parser.add_argument('--memo-store', help='SQLite file to keep memoized results in across runs, as well as in '
+                                             'memory. Implies --memoize.',
+                        metavar='FILE')
+    parser.add_argument('--memo-verify', help='Memoization mode only. Fraction of hits, between 0 and 1, to run anyway '
+                                              'and compare with the memoized result, to detect nondeterminism.',
+                        type=_fraction,
+                        default=0.0)
+    parser.add_argument('--serve', help='Serve the AWS Lambda Invoke API on this port, instead of running events. '
+                                        'Statistics are served at /stats.',
+                        type=int,
+                        metavar='PORT')
+    parser.add_argument('--host', help='Server mode only. Address to listen on. Default is 127.0.0.1.',
+                        default='127.0.0.1')
+    parser.add_argument('--concurrency', help='Server, asyncio and load generation modes only. Maximum number of '
+                                              'concurrent invocations, as with reserved concurrency. Default is 10.',
+                        type=int,
+                        default=10)
+    parser.add_argument('--function-name', help='Server mode only. Name to serve the function under. By default, it '
+                                                'is served under any name.')
+    parser.add_argument('--json', help='JSON library for events and results. Default is `auto`: orjson or ujson if '
+                                       'installed, or else the standard library.',
+                        choices=serializer.BACKENDS,
+                        default='auto')
     parser.add_argument('-v', '--verbose', help='Verbose mode. Provides exact function run, timing, etc.',
                         action='store_true')
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.eventfile is None and args.serve is None:
+        parser.error('eventfile is required, unless serving with --serve')
+    if (args.memory_size or args.memory_sweep) and (USING_WINDOWS or args.workers > 1):
+        parser.error('--memory-size and --memory-sweep need containers, which cannot be throttled on Windows or used '
+                     'with --workers')
+    if args.memory_sweep and not args.stream:
+        parser.error('--memory-sweep runs a stream, so it needs --stream')
+    if args.fork_server and (not hasattr(os, 'fork') or args.workers > 1):
+        parser.error('--fork-server needs os.fork(), and cannot be used with --workers')
+    args.containers = bool(args.recycle_invokes or args.recycle_idle is not None or args.memory_size or
+                           args.memory_sweep or args.fork_server)
+    args.manifest = is_manifest(args.lambdapath)
+    if args.manifest and (args.containers or args.workers > 1 or args.load or args.asyncio or args.source):
+        parser.error('a manifest\'s functions share this process, one invocation at a time, so it cannot be used '
+                     'with containers, --workers, --load, --asyncio or --source')
+    if args.watch and (args.manifest or args.containers or args.workers > 1 or args.load or args.asyncio or
+                       args.source or args.serve is not None):
+        parser.error('--watch reloads the one function imported in this process, so it cannot be used with a '
+                     'manifest, containers, --workers, --load, --asyncio, --source or --serve')
+    args.memoize = args.memoize or bool(args.memo_store)
+    if args.memoize and (args.manifest or args.containers or args.workers > 1 or args.load or args.asyncio or
+                         args.source or args.serve is not None):
+        parser.error('--memoize keeps the results of the one function run in this process, one invocation at a time, '
+                     'so it cannot be used with a manifest, containers, --workers, --load, --asyncio, --source or '
+                     '--serve')
+    if args.memoize and args.memo_size < 1:
+        parser.error('--memo-size must be at least 1')
+    if args.manifest and args.function_name:
+        parser.error('a manifest\'s functions are served under their own names, so --function-name cannot be used')
+    if args.profile and (args.asyncio or args.serve is not None or args.containers):
+        parser.error('--profile needs invocations to run one at a time in this process, or in --workers')
+    if args.source and (not args.stream or args.workers > 1 or args.asyncio):
+        parser.error('--source invokes the function with batches of a stream, one at a time, so it needs --stream, '
+                     'and cannot be used with --workers or --asyncio')
+    if args.load and (not args.stream or args.workers > 1 or args.asyncio or args.source or args.containers):
+        parser.error('--load runs a stream on its own pool of workers, so it needs --stream, and cannot be used with '
+                     '--workers, --asyncio, --source or containers')
+    if args.load in ('fixed', 'poisson') and not (args.rate and args.rate > 0):
+        parser.error('--load %s needs a --rate above 0' % args.load)
+    if args.load == 'replay' and not args.replay_field:
+        parser.error('--load replay needs --replay-field')
+    if args.part and args.eventfile == '-':
+        parser.error('--part splits a file into byte ranges, so it cannot be used with stdin')
+    if args.batch_window and not args.replay_field:
+        parser.error('--batch-window closes batches by the arrival times of records, so it needs --replay-field')
+    if args.metrics and (args.serve is not None or args.memory_sweep):
+        parser.error('--metrics records invocations of an event file, so it cannot be used with --serve or '
+                     '--memory-sweep')
+    if args.log_file and (args.workers > 1 or args.load or args.asyncio or args.serve is not None or args.containers):
+        parser.error('--log-file captures output of invocations running one at a time in this process')
+    if args.trace and (USING_WINDOWS or args.workers > 1 or args.load or args.asyncio or args.serve is not None or
+                       args.containers or args.source):
+        parser.error('--trace measures invocations of single events running one at a time in this process, through '
+                     'getrusage(), so it cannot be used on Windows, with containers, --workers, --load, --asyncio, '
+                     '--source or --serve')
+    if args.import_profile and args.containers:
+        parser.error('--import-profile records the import in this process, so it cannot be used with containers')
+    if args.startup_report and args.containers:
+        parser.error('--startup-report times the import in this process, so it cannot be used with containers')
+    return args
+
+
+def _part(value):
+    """
+    Parse a K/N argument.
+    :return: (k, n) tuple of ints.
+    """
+    try:
+        k, n = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not of the form K/N" % value)
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError("K must be between 1 and N in %s" % value)
+    return k, n
+
+
+def _fraction(value):
+    """
+    Parse a fraction argument, between 0 and 1.
+    :return: float.
+    """
+    try:
+        fraction = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not a number" % value)
+    if not 0 <= fraction <= 1:
+        raise argparse.ArgumentTypeError("%s is not between 0 and 1" % value)
+    return fraction
+
+
+def _memory_size(value):
+    """
+    Parse a memory size argument, within the sizes Lambda allows.
+    :return: Size in MB, as int.
+    """
+    try:
+        memory_size = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not a number of MB" % value)
+    if not 128 <= memory_size <= 10240:
+        raise argparse.ArgumentTypeError("Memory size must be between 128 and 10240 MB, not %s" % value)
+    return memory_size
+
+
+def _memory_sizes(value):
+    """
+    Parse a comma-separated list of memory sizes.
+    :return: List of sizes in MB.
+    """
+    return [_memory_size(size) for size in value.split(',')]
+
+
+# Functions already imported, by path, so that each is only resolved once however many times it is asked for.
+_handlers = dict()
 
 
 def import_lambda(path):
@@ -106,9 +707,11 @@ def import_lambda(path):
     :param path: Path to function, given as [file-name].[function-name]
     :return: Python function
     """
+    path = str(path)
+    if path in _handlers:
+        return _handlers[path]
     try:
         # Parse path into module and function name.
-        path = str(path)
         if ('/' in path or '\\' in path) and path.count('.') >= 2:
             raise ValueError()
         spath = path.split('.')
@@ -117,11 +720,21 @@ def import_lambda(path):
         # Import the module and get the function.
         if '/' in path or '\\' in path:
             file_name = '{}.py'.format(module)
-            loaded_module = imp.load_source(function, file_name)
+            spec = importlib.util.spec_from_file_location(lambda_module(path), file_name)
+            if spec is None:
+                raise IOError("No such file: %s" % file_name)
+            loaded_module = importlib.util.module_from_spec(spec)
+            sys.modules[spec.name] = loaded_module
+            try:
+                spec.loader.exec_module(loaded_module)
+            except BaseException:
+                del sys.modules[spec.name]
+                raise
         else:
             import_module(module)
             loaded_module = sys.modules[module]
-        return getattr(loaded_module, function)
+        _handlers[path] = getattr(loaded_module, function)
+        return _handlers[path]
     except (AttributeError, TypeError) as e:
         print("\nOops! There was a problem finding your function.\n")
         raise e
@@ -129,6 +742,46 @@ def import_lambda(path):
         print("You must follow the form of [file-name].[function-name].")
         sys.exit(1)
 
+
+def lambda_module(path):
+    """
+    :param path: Path to function, given as [file-name].[function-name]
+    :return: Name of the module `import_lambda()` imports the function from. Functions in files outside sys.path are
+             imported as a module named after the function.
+    """
+    path = str(path)
+    module, _, function = path.rpartition('.')
+    return function if '/' in path or '\\' in path else module
+
+
+def forget_lambda(path):
+    """
+    Forget a function imported by `import_lambda()`, so that it is resolved again, e.g. after its module is reloaded.
+    :param path: Path to function, given as [file-name].[function-name]
+    :return: Void.
+    """
+    _handlers.pop(str(path), None)
+
+class LambdaContext(object):
+    """
+    A Lambda context object. Attributes are whatever was given in the context file, if any.
+    More info: http://docs.aws.amazon.com/lambda/latest/dg/python-context-object.html
+    """
+    def __init__(self, attributes=None):
+        self.__dict__.update(attributes or {})
+
+    def get_remaining_time_in_millis(self):
+        """
+        :return: Milliseconds left before the invocation times out.
+        """
+        return remaining_millis()
+
+
+class JSON2Object(LambdaContext):
+    def __init__(self, jsonfile):
+        super(JSON2Object, self).__init__(parse_event(jsonfile))
+
+
 def read_file_to_object(filename):
     """
     Deserialize JSON into Python Object to be compliant with Lambda Context Object.
@@ -136,11 +789,6 @@ def read_file_to_object(filename):
     :param filename: A valid path to a file
     :return: Object.
     """
-
-    class JSON2Object(object):
-        def __init__(self, jsonfile):
-            self.__dict__ = parse_event(jsonfile)
-
     jsonfile = read_file_to_string(filename)
     return JSON2Object(jsonfile)
 
@@ -168,28 +816,23 @@ def parse_event(eventstring):
     :return: An Event object (which is an arbitrary dictionary).
     """
     try:
-        return json.loads(eventstring)
+        return serializer.loads(eventstring)
     except ValueError as e:
         print("There was a problem parsing your JSON event.")
-        print(e.message)
+        print(str(e))
         raise e
 
 def create_boto3_default_session(roleARN):
     """
-    Invoke STS to Assume the given role and create a default boto3 session
+    Set up a default boto3 session under the given role, assuming it through STS only when there are no cached
+    credentials for it or they are about to expire.
     :param roleARN: The IAM rolename to assume.  TrustedPolicy must include the following principals
                     ["lambda.amazonaws.com", "arn:aws:iam:<YOUR ACCOUNT ID>::user/<YOUR USER>"]
     """
-    print("Going to assume role %s" % roleARN)
-    stsClient = boto3.client("sts")
-    creds = stsClient.assume_role(RoleArn=roleARN,RoleSessionName='emulambda',)
-    print("Setting up the default session")
-    boto3.setup_default_session(aws_access_key_id=creds['Credentials']['AccessKeyId'],
-                                aws_secret_access_key=creds['Credentials']['SecretAccessKey'],
-                                aws_session_token=creds['Credentials']['SessionToken'])
+    credentials.default_cache.setup_default_session(roleARN)
 
 
-def invoke_lambda(lfunc, event, context, t, roleARN):
+def invoke_lambda(lfunc, event, context, t, roleARN, profiler=None):
     """
     Invoke an AWS Lambda-compatible function.
     :param lfunc: The lambda compatible function (def f(event, context))
@@ -197,25 +840,30 @@ def invoke_lambda(lfunc, event, context, t, roleARN):
     :param context: A context object
     :param t: Timeout. If this function does not complete in this time, execution will fail.
     :param roleRN: the ARN to Lambda's function execution role.  Your IAM user must be in the role's TrustedPolicy
+    :param profiler: A profiler to run the function under, from `get_profiler()`.
     :return: Function result (type dependent on function implementation), execution time as int.
     """
-
-    @timeout(t)
-    def _invoke_lambda(l, e, c):
-        # TODO investigate suitability of timeit here
-        s = time.time()
-        r = l(e, c)
-        x = (time.time() - s) * 1000  # convert to ms
-        return r, x
+    if context is None:
+        context = LambdaContext()
 
     try:
         if roleARN:
             create_boto3_default_session(roleARN)
 
-        return _invoke_lambda(lfunc, event, context)
+        with Deadline(t):
+            if profiler is None:
+                return _invoke_lambda(lfunc, event, context)
+            profiler.start()
+            try:
+                return _invoke_lambda(lfunc, event, context)
+            finally:
+                profiler.stop()
     except TimeoutError:
-        print("Your lambda timed out! (Timeout was %is)\n" % t)
+        print("Your lambda timed out! (Timeout was %gs)\n" % t)
         return "EMULAMBDA: TIMEOUT ERROR", -1
+    except MemoryError:
+        print("Your lambda ran out of memory!\n")
+        return "EMULAMBDA: OUT OF MEMORY ERROR", -1
     except BaseException:
         # While this is normally a too-broad exception, since we cannot know the lambda's errors ahead of time, this is appropriate here.
         print(
@@ -224,30 +872,43 @@ def invoke_lambda(lfunc, event, context, t, roleARN):
         return "EMULAMBDA: LAMBDA ERROR", -1
 
 
-def emit_to_function(verbose, stream, func):
+def _invoke_lambda(l, e, c):
+    s = time.perf_counter_ns()
+    r = l(e, c)
+    x = (time.perf_counter_ns() - s) / 1e6  # convert to ms
+    return r, x
+
+
+def emit_to_function(verbose, stream, func, start=1, end=None, step=1, part=None, checkpoint=None, policy=None,
+                     indexed=False):
     """
     Emit lines from a stream to a function. Each line must contain a JSON string, and the function must take the resulting object.
-    :param stream: A file-like object providing a LDJSON stream.
+    :param stream: A path to a LDJSON file, or '-' for stdin.
     :param func: A function to invoke with objects from the stream.
+    :param start: First line to emit (1-based).
+    :param end: Last line to emit, inclusive. None for the end of the stream.
+    :param step: Emit every `step`th line.
+    :param part: (k, n) to emit only the kth of n byte ranges of a file.
+    :param checkpoint: A Checkpoint to resume from and record progress in.
+    :param policy: A GCPolicy to collect garbage by. None to force a full collection before every event.
+    :param indexed: Also pass the function the line number of each object, as a third argument.
     :return: Void.
     """
     print("Entering stream mode.") if verbose else None
-    i = 1
     try:
-        with sys.stdin if stream is '-' else open(stream, 'r') as event_stream:
-            for line in event_stream:
-                gc.collect()  # force GC between each run to get quality memory usage sample
-                print(
-                    "\nObject %i %s" % (i, line.rstrip()[:65] + ('...' if len(line) > 65 else ''))) if verbose else None
-                i += 1
-                func(json.loads(line), None)
+        for i, line in read_events(stream, start, end, step, part, checkpoint):
+            policy.before() if policy else gc.collect()
+            print(
+                "\nObject %i %s" % (i, line.rstrip()[:65] + ('...' if len(line) > 65 else ''))) if verbose else None
+            func(serializer.loads(line), None, i) if indexed else func(serializer.loads(line), None)
+            checkpoint.done(i) if checkpoint else None
     except ValueError as e:
         print("There was a problem parsing your JSON event.")
-        print(e.message)
+        print(str(e))
         raise e
     except IOError as e:
         print("There was a problem parsing your JSON event.")
-        print(e.message)
+        print(str(e))
         raise e
 
 
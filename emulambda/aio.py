@@ -0,0 +1,135 @@
+"""
+Asyncio stream mode. Many invocations are in flight at once, up to a concurrency limit (like a function's reserved
+concurrency), optionally dispatched at the arrival times recorded in the events themselves. Synchronous lambdas run on
+a thread pool; coroutine lambdas are awaited directly.
+"""
+from __future__ import print_function
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import time
+import traceback
+
+import emulambda
+from emulambda.eventfile import parse_timestamp, read_events
+
+
+class AsyncContext(emulambda.LambdaContext):
+    """
+    Context for coroutine lambdas, which share a thread, so each keeps its own deadline.
+    """
+    def __init__(self, expires):
+        super(AsyncContext, self).__init__()
+        self._expires = expires
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._expires - time.time()) * 1000))
+
+
+def emit_to_function_async(args, lfunc, run, func, meter, pending_init, checkpoint=None, policy=None):
+    """
+    Emit lines from a LDJSON stream to a lambda, with many invocations in flight.
+    :param args: Argument namespace from `parseargs()`; `eventfile` is the stream, `concurrency` the limit.
+    :param lfunc: The lambda, or None if it runs elsewhere (e.g. in a container).
+    :param run: A function taking (event, context) and returning (result, exec_clock, exec_rss, exec_init), used for
+                synchronous lambdas.
+    :param func: A function taking (index, line, result, exec_clock, exec_rss, exec_init), called as invocations
+                 finish.
+    :param meter: Memory meter for coroutine lambdas.
+    :param pending_init: List holding the cold start time of a coroutine lambda, until its first invocation.
+    :param checkpoint: A Checkpoint to resume from and record progress in.
+    :param policy: A GCPolicy to collect garbage by, between batches of events. None to never force a collection.
+    :return: Void.
+    """
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(max_workers=args.concurrency)
+    try:
+        loop.run_until_complete(_emit(args, lfunc, run, func, executor, meter, pending_init, checkpoint, policy))
+    finally:
+        executor.shutdown(wait=True)
+        loop.close()
+
+
+async def _emit(args, lfunc, run, func, executor, meter, pending_init, checkpoint, policy):
+    loop = asyncio.get_event_loop()
+    slots = asyncio.Semaphore(args.concurrency)
+    coroutine = asyncio.iscoroutinefunction(lfunc)
+    in_flight = set()
+    start = first = None
+
+    async def invoke(i, line, event):
+        try:
+            if coroutine:
+                try:
+                    outcome = await _invoke_coroutine(lfunc, event, args.timeout, meter)
+                    outcome += (pending_init.pop() if pending_init else None,)
+                except asyncio.TimeoutError:
+                    print("Your lambda timed out! (Timeout was %gs)\n" % args.timeout)
+                    outcome = ("EMULAMBDA: TIMEOUT ERROR", -1, 0, None)
+            else:
+                # The deadline of a synchronous lambda is enforced in its thread, from when the thread picks it up,
+                # and the slot is only freed once the thread is done with it.
+                outcome = await loop.run_in_executor(executor, run, event, None)
+        finally:
+            slots.release()
+        func(i, line, *outcome)
+        checkpoint.done(i) if checkpoint else None
+
+    events = read_events(args.eventfile, args.start, args.end, args.sample, args.part, checkpoint)
+    async for i, line in _read_lines(events, policy):
+        event = emulambda.parse_event(line)
+        if args.replay_field:
+            arrival = parse_timestamp(event.get(args.replay_field)) if isinstance(event, dict) else None
+            if arrival is not None:
+                if first is None:
+                    start, first = loop.time(), arrival
+                delay = start + (arrival - first) - loop.time()
+                await asyncio.sleep(delay) if delay > 0 else None
+        await slots.acquire()
+        task = loop.create_task(invoke(i, line, event))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+    if in_flight:
+        await asyncio.wait(in_flight)
+
+
+async def _invoke_coroutine(lfunc, event, t, meter):
+    """
+    Await a coroutine lambda under an asyncio deadline.
+    :return: Function result, execution time in ms and execution RSS.
+    """
+    context = AsyncContext(time.time() + t)
+    meter.start()
+    try:
+        s = time.perf_counter_ns()
+        r = await asyncio.wait_for(lfunc(event, context), t)
+        x = (time.perf_counter_ns() - s) / 1e6  # convert to ms
+    except asyncio.TimeoutError:
+        raise
+    except Exception:
+        # While this is normally a too-broad exception, since we cannot know the lambda's errors ahead of time, this is appropriate here.
+        print(
+            "\nThere was an error running your function. Ensure it has a signature like `async def lambda_handler (event, context)`.\n")
+        traceback.print_exc()
+        r, x = "EMULAMBDA: LAMBDA ERROR", -1
+    return r, x, meter.stop()
+
+
+async def _read_lines(events, policy=None, batch=256):
+    """
+    Read lines without blocking the event loop. Lines are read on the loop's default executor, which lambdas cannot
+    starve, a batch at a time.
+    :param events: Iterator of (line number, line), from `read_events()`.
+    :param policy: A GCPolicy to collect garbage by, or None.
+    :return: Async iterator of (line number, line).
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        lines = await loop.run_in_executor(None, list, itertools.islice(events, batch))
+        if not lines:
+            break
+        # Collect between batches rather than events, to keep the loop responsive
+        policy.before(len(lines)) if policy else None
+        for i, line in lines:
+            yield i, line
+
@@ -0,0 +1,282 @@
+"""
+Benchmarks of handler latency and emulator overhead, and a regression gate. Built-in handlers (and any others given)
+are run through each execution path of emulambda, in this process as from the command line, and their latency and
+memory percentiles are saved to a JSON baseline. A later run compares against the baseline, and fails when a metric
+has regressed beyond a threshold, and (for latency) the difference is statistically significant.
+"""
+from __future__ import print_function
+import argparse
+import collections
+import contextlib
+import math
+import os
+import sys
+import tempfile
+import time
+
+import emulambda
+from emulambda import serializer
+from emulambda.render import size
+
+# Execution paths, as command line arguments.
+PATHS = collections.OrderedDict([
+    ('serial', []),
+    ('workers', ['--workers', '2']),
+    ('asyncio', ['--asyncio']),
+    ('container', ['--recycle-invokes', '1000000000']),
+    ('fork-server', ['--fork-server']),
+])
+# Paths running one invocation at a time, for which wall time per event less handler time is the emulator's overhead.
+SEQUENTIAL = ('serial', 'container', 'fork-server')
+HANDLERS = collections.OrderedDict([
+    ('noop', 'emulambda.bench.noop'),
+    ('cpu', 'emulambda.bench.cpu'),
+    ('alloc', 'emulambda.bench.alloc'),
+])
+# Raw latency samples kept in a baseline per benchmark, for significance tests.
+MAX_SAMPLES = 2000
+# Growth in peak memory below this many bytes is noise, whatever the threshold.
+MEMORY_SLACK = 256 * 1024
+# Growth in latency below this many ms is noise, whatever the threshold; microsecond handlers jitter by more than 10%.
+LATENCY_SLACK = 0.05
+
+
+def noop(event, context):
+    return None
+
+
+def cpu(event, context):
+    return sum(i * i for i in range(20000))
+
+
+def alloc(event, context):
+    return len([{'index': i, 'name': str(i)} for i in range(20000)])
+
+
+def run(lambdapath, path, eventfile, memory):
+    """
+    Run a stream through emulambda, in this process, with its output discarded.
+    :param lambdapath: Path to the handler.
+    :param path: Execution path, from PATHS.
+    :param eventfile: LDJSON stream.
+    :param memory: Memory backend.
+    :return: Dictionary of results.
+    """
+    argv = sys.argv
+    sys.argv = [argv[0], lambdapath, eventfile, '-s', '--dump-samples', '--memory', memory] + PATHS[path]
+    try:
+        with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+            s = time.time()
+            stats = emulambda.main()
+            wall = time.time() - s
+    finally:
+        sys.argv = argv
+    clock = stats['clock']
+    events = clock.count + stats['errors']
+    per_event = wall * 1000 / events if events else 0  # convert to ms
+    samples = clock.samples or list()
+    return {'events': events,
+            'errors': stats['errors'],
+            'throughput': events / wall if wall else 0,
+            'mean': clock.mean,
+            'p50': clock.percentile(50),
+            'p99': clock.percentile(99),
+            'rss': stats['rss'].max,
+            'overhead': per_event - clock.mean if path in SEQUENTIAL else None,
+            'samples': samples[::int(math.ceil(len(samples) / float(MAX_SAMPLES)))] if samples else samples}
+
+
+def run_all(handlers, paths, count, eventfile=None, memory='rusage', verbose=False):
+    """
+    Run every handler through every path.
+    :param handlers: Dictionary of name to handler path.
+    :param paths: Names of paths, from PATHS.
+    :param count: Number of events to run, for handlers without an event file.
+    :param eventfile: LDJSON stream to run instead of `count` empty events.
+    :param memory: Memory backend.
+    :param verbose: Print progress.
+    :return: Dictionary of results, keyed 'handler/path'.
+    """
+    stream = None
+    if eventfile is None:
+        stream = tempfile.NamedTemporaryFile('w', suffix='.ldjson', delete=False)
+        for i in range(count):
+            stream.write('{"index": %i}\n' % i)
+        stream.close()
+        eventfile = stream.name
+    results = collections.OrderedDict()
+    try:
+        for name, lambdapath in handlers.items():
+            for path in paths:
+                print('Running %s through %s...' % (name, path)) if verbose else None
+                results['%s/%s' % (name, path)] = run(lambdapath, path, eventfile, memory)
+    finally:
+        if stream is not None:
+            for leftover in (stream.name, stream.name + '.idx'):
+                os.remove(leftover) if os.path.exists(leftover) else None
+    return results
+
+
+def mann_whitney(a, b):
+    """
+    One-sided Mann-Whitney U test of whether samples `a` tend to be larger than samples `b`, by the normal
+    approximation with a correction for ties.
+    :return: p-value.
+    """
+    n1, n2 = len(a), len(b)
+    if not n1 or not n2:
+        return 1.0
+    ranked = sorted([(x, 0) for x in a] + [(x, 1) for x in b])
+    n = n1 + n2
+    rank_sum, ties, i = 0.0, 0, 0
+    while i < n:
+        j = i
+        while j < n and ranked[j][0] == ranked[i][0]:
+            j += 1
+        rank = (i + j + 1) / 2.0  # average of the 1-based ranks i+1..j
+        rank_sum += rank * sum(1 for k in range(i, j) if ranked[k][1] == 0)
+        ties += (j - i) ** 3 - (j - i)
+        i = j
+    u = rank_sum - n1 * (n1 + 1) / 2.0
+    sigma = math.sqrt(n1 * n2 / 12.0 * ((n + 1) - ties / float(n * (n - 1)))) if n > 1 else 0
+    if sigma == 0:
+        return 0.0 if u > n1 * n2 / 2.0 else 1.0
+    z = (u - n1 * n2 / 2.0 - 0.5) / sigma
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def compare(baseline, results, threshold=0.1, memory_threshold=0.1, alpha=0.01, latency_slack=LATENCY_SLACK):
+    """
+    Compare results against a baseline.
+    :param baseline: Results from a previous run, as from `run_all()`.
+    :param results: Results of this run.
+    :param threshold: Latency growth (e.g. 0.1 for 10%) at which p50 or p99 has regressed, if significant.
+    :param memory_threshold: Peak memory growth at which memory has regressed.
+    :param alpha: Significance level of the latency test.
+    :param latency_slack: Latency growth in ms which a regression must also exceed.
+    :return: List of (benchmark, metric, baseline value, value, relative change, p-value or None, regressed).
+    """
+    rows = list()
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        old = baseline[key]
+        p = mann_whitney(result['samples'], old['samples'])
+        for metric in ('p50', 'p99'):
+            change = result[metric] / old[metric] - 1 if old[metric] else 0
+            regressed = change > threshold and result[metric] - old[metric] > latency_slack and p < alpha
+            rows.append((key, metric, old[metric], result[metric], change, p, regressed))
+        change = result['rss'] / float(old['rss']) - 1 if old['rss'] else 0
+        regressed = result['rss'] - old['rss'] > max(memory_threshold * old['rss'], MEMORY_SLACK)
+        rows.append((key, 'rss', old['rss'], result['rss'], change, None, regressed))
+    return rows
+
+
+def render_results(results):
+    """
+    Render benchmark results.
+    :return: Void.
+    """
+    print('%-24s %8s %10s %10s %10s %10s %12s' % ('Benchmark', 'Events', 'p50', 'p99', 'Peak RSS', 'Overhead',
+                                                  'Events/s'))
+    for key, r in results.items():
+        print('%-24s %8i %8.3fms %8.3fms %10s %10s %12.1f' % (
+            key, r['events'], r['p50'] or 0, r['p99'] or 0, size(r['rss'] or 0),
+            '%.3fms' % r['overhead'] if r['overhead'] is not None else '-', r['throughput']))
+
+
+def render_comparison(rows):
+    """
+    Render a comparison against a baseline.
+    :return: Void.
+    """
+    print('\n%-24s %6s %12s %12s %8s %8s' % ('Benchmark', 'Metric', 'Baseline', 'Now', 'Change', 'p'))
+    for key, metric, old, new, change, p, regressed in rows:
+        format_value = size if metric == 'rss' else (lambda ms: '%.3fms' % ms)
+        print('%-24s %6s %12s %12s %+7.1f%% %8s%s' % (
+            key, metric, format_value(old), format_value(new), change * 100, '%.4f' % p if p is not None else '-',
+            '  REGRESSED' if regressed else ''))
+
+
+def main():
+    args = parseargs()
+    handlers = collections.OrderedDict((name, HANDLERS[name]) for name in args.handlers)
+    for path in args.handler or list():
+        handlers[path] = path
+    results = run_all(handlers, args.paths, args.count, args.events, args.memory, args.verbose)
+    render_results(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            f.write(serializer.dumps(results))
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = serializer.loads(f.read())
+        rows = compare(baseline, results, args.threshold / 100.0, args.memory_threshold / 100.0, args.alpha,
+                       args.latency_slack)
+        render_comparison(rows)
+        if any(row[-1] for row in rows):
+            print('\nPerformance has regressed.')
+            sys.exit(1)
+
+
+def parseargs():
+    """
+    Parse command line arguments.
+    :return: Argument namespace (access members with dot).
+    """
+    parser = argparse.ArgumentParser(description='Benchmark handlers through emulambda, and gate on regressions.')
+    parser.add_argument('--handlers', help='Built-in handlers to run, comma-separated. Default is all of %s.' %
+                                           ','.join(HANDLERS),
+                        type=_choices(HANDLERS),
+                        default=list(HANDLERS))
+    parser.add_argument('--handler', help='Also run this handler, given as `module.function`. May be repeated.',
+                        action='append')
+    parser.add_argument('--paths', help='Execution paths to run through, comma-separated. Default is all of %s.' %
+                                        ','.join(PATHS),
+                        type=_choices(PATHS),
+                        default=[path for path in PATHS if path != 'fork-server' or hasattr(os, 'fork')])
+    parser.add_argument('-n', '--count', help='Number of events per benchmark. Default is 1000.',
+                        type=int,
+                        default=1000)
+    parser.add_argument('--events', help='LDJSON stream to run, instead of empty events.')
+    parser.add_argument('-m', '--memory', help='Memory measurement backend, as for emulambda. Default is `proc` on '
+                                               'Linux, which measures every invocation, or else `rusage`.',
+                        default='proc' if sys.platform.startswith('linux') else 'rusage')
+    parser.add_argument('--save', help='Save the results as a baseline to this JSON file.',
+                        metavar='FILE')
+    parser.add_argument('--compare', help='Compare the results to the baseline in this JSON file, and exit with '
+                                          'status 1 if any has regressed.',
+                        metavar='FILE')
+    parser.add_argument('--threshold', help='Growth of p50 or p99 latency, in percent, to count as a regression if '
+                                            'significant. Default is 10.',
+                        type=float,
+                        default=10)
+    parser.add_argument('--latency-slack', help='Growth of p50 or p99 latency, in ms, which a regression must also '
+                                                'exceed, as tiny latencies jitter by large percentages. Default is '
+                                                '%g.' % LATENCY_SLACK,
+                        type=float,
+                        default=LATENCY_SLACK,
+                        metavar='MS')
+    parser.add_argument('--memory-threshold', help='Growth of peak memory, in percent, to count as a regression. '
+                                                   'Default is 10.',
+                        type=float,
+                        default=10)
+    parser.add_argument('--alpha', help='Significance level of the Mann-Whitney U test on latency. Default is 0.01.',
+                        type=float,
+                        default=0.01)
+    parser.add_argument('-v', '--verbose', help='Print progress.',
+                        action='store_true')
+    return parser.parse_args()
+
+
+def _choices(options):
+    """
+    :return: Argument type parsing a comma-separated list of the given options.
+    """
+    def parse(value):
+        chosen = value.split(',')
+        for choice in chosen:
+            if choice not in options:
+                raise argparse.ArgumentTypeError("%s is not one of %s" % (choice, ', '.join(options)))
+        return chosen
+    return parse
@@ -0,0 +1,182 @@
+"""
+Container lifecycle emulation. A container is a fresh subprocess which imports the lambda (a cold start) and then
+serves warm invocations until it is recycled, either after a number of invocations or after sitting idle.
+"""
+from __future__ import print_function
+import multiprocessing
+import os
+import threading
+import time
+
+import emulambda
+from emulambda import credentials
+from emulambda.gcpolicy import GCPolicy, record_gc
+from emulambda.importtime import enable_lazy_imports
+from emulambda.memory import get_meter
+from emulambda.tiers import Throttle, limit_address_space
+
+
+class Container(object):
+    """
+    A lambda container living in its own interpreter. The subprocess is started lazily, on the first invocation after
+    creation or recycling, so every container's first invocation is reported as cold. Like a real container, it runs
+    one invocation at a time.
+    """
+    def __init__(self, args, max_invokes=None, max_idle=None, memory_size=None, stats=None):
+        """
+        :param args: Argument namespace from `parseargs()`.
+        :param max_invokes: Recycle the container after this many invocations. None to never recycle on count.
+        :param max_idle: Recycle the container when it has been idle for this many seconds. None to never recycle.
+        :param memory_size: Hold the container to the memory and CPU share of this memory size in MB, as configured
+                            for a function. None for no limits.
+        :param stats: Dictionary from `new_stats()` to record the container's garbage collection times in, or None.
+        """
+        self.args = args
+        self.max_invokes = max_invokes
+        self.max_idle = max_idle
+        self.memory_size = memory_size
+        self.stats = stats
+        self.last_gc = None
+        self.throttle = None
+        self.process = None
+        self.conn = None
+        self.invokes = 0
+        self.last_invoke = None
+        self.starts = 0
+        self.lock = threading.Lock()
+
+    def invoke(self, event, context):
+        """
+        Invoke the lambda in the container, starting or recycling the container first if needed.
+        :param event: An event object.
+        :param context: A context object. Must be picklable.
+        :return: Function result, execution time in ms, execution RSS, and init time in ms (None for warm invokes).
+        """
+        with self.lock:
+            return self._invoke(event, context)
+
+    def _invoke(self, event, context):
+        if self.process and self.max_idle is not None and time.time() - self.last_invoke > self.max_idle:
+            self.close()
+        exec_init = None
+        self.last_gc = None
+        if not self.process:
+            exec_init = self._start()
+        try:
+            self.conn.send((event, context))
+            result, exec_clock, exec_rss, collections = self.conn.recv()
+        except (EOFError, OSError):
+            return self._died(), -1, 0, exec_init
+        record_gc(self.stats, collections) if self.stats is not None else None
+        self.last_gc = sum(ms for forced, ms in collections if not forced)
+        self.invokes += 1
+        self.last_invoke = time.time()
+        if self.max_invokes is not None and self.invokes >= self.max_invokes:
+            self.close()
+        return result, exec_clock, exec_rss, exec_init
+
+    def close(self):
+        """
+        Shut the container down. The next invocation will cold start a new one.
+        :return: Void.
+        """
+        if self.process:
+            self.conn.send(None)
+            self._reap()
+
+    def _died(self):
+        """
+        Clean up after a container which exited mid-invocation, e.g. killed for running out of memory. As on Lambda,
+        the next invocation starts a fresh one.
+        :return: Error result of the invocation.
+        """
+        process = self.process
+        oom = self.throttle.oom_killed() if self.throttle else False
+        self._reap()
+        print("\nThe container exited during the invocation, with %s.\n" % (
+            'signal %i' % -process.exitcode if process.exitcode < 0 else 'status %i' % process.exitcode))
+        return "EMULAMBDA: OUT OF MEMORY ERROR" if oom else "EMULAMBDA: RUNTIME ERROR"
+
+    def _reap(self):
+        """
+        Wait for the container process to exit, and release it.
+        :return: Void.
+        """
+        self.throttle.close() if self.throttle else None
+        self.process.join()
+        self.throttle.remove() if self.throttle else None
+        self.conn.close()
+        self.process = None
+        self.conn = None
+        self.throttle = None
+        self.invokes = 0
+
+    def _body(self):
+        """
+        :return: Function run by the container process, taking (args, conn, memory_size).
+        """
+        return _serve
+
+    def _start(self):
+        # A spawned interpreter shares no imported modules with us, so the import is a true cold start.
+        ctx = multiprocessing.get_context('spawn')
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=self._body(), args=(self.args, child, self.memory_size))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.throttle = Throttle(self.process.pid, self.memory_size) if self.memory_size else None
+        try:
+            kind, payload = self.conn.recv()
+        except EOFError:
+            kind, payload = 'error', RuntimeError("The container exited while importing the function.")
+        if kind == 'error':
+            self._reap()
+            raise payload
+        self.starts += 1
+        return payload
+
+
+def load(args, conn, memory_size=None):
+    """
+    Set up a container process and import the lambda, reporting the import time, or the error, to the parent.
+    :param args: Argument namespace from `parseargs()`.
+    :param conn: Connection to the parent.
+    :param memory_size: Memory size in MB to limit the process to, or None.
+    :return: The lambda and a memory meter, or None if the import failed.
+    """
+    # Lead a process group, so that a throttle also holds back any processes we fork.
+    os.setpgrp() if hasattr(os, 'setpgrp') else None
+    credentials.default_cache.endpoint_url = args.sts_endpoint
+    meter = get_meter(args.memory)
+    limit_address_space(memory_size) if memory_size else None
+    enable_lazy_imports() if args.lazy_imports else None
+    try:
+        s = time.time()
+        lfunc = emulambda.import_lambda(args.lambdapath)
+        exec_init = (time.time() - s) * 1000  # convert to ms
+    except BaseException as e:
+        conn.send(('error', e))
+        return None
+    conn.send(('ready', exec_init))
+    return lfunc, meter
+
+
+def _serve(args, conn, memory_size=None):
+    """
+    Container process body. Imports the lambda, then serves invocations until told to stop.
+    """
+    loaded = load(args, conn, memory_size)
+    if loaded is None:
+        return
+    lfunc, meter = loaded
+    policy = GCPolicy(args.gc, meter)
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        event, context = message
+        policy.before()
+        meter.start()
+        result, exec_clock = emulambda.invoke_lambda(lfunc, event, context, args.timeout, args.role)
+        conn.send((result, exec_clock, meter.stop(), policy.drain()))
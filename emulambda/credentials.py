@@ -0,0 +1,100 @@
+"""
+Cache of assumed-role credentials. Rather than calling STS for every invocation, a boto3 session is kept per role ARN
+and re-used until its credentials are about to expire. boto3 takes a few hundred milliseconds to import, so it is only
+imported once a role is assumed.
+"""
+from __future__ import print_function
+import datetime
+
+# Refresh credentials this many seconds ahead of the Expiration that STS gives us.
+REFRESH_MARGIN = 300
+
+
+_session_class = None
+
+
+def caching_session(**kwargs):
+    """
+    Build a boto3 session which hands back the same client for repeated `client()` calls with the same arguments, as a
+    Lambda container re-using module-level clients would.
+    :param kwargs: Arguments of `boto3.Session`.
+    :return: boto3.Session.
+    """
+    global _session_class
+    if _session_class is None:
+        import boto3
+
+        class CachingSession(boto3.Session):
+            def __init__(self, *args, **kwargs):
+                super(CachingSession, self).__init__(*args, **kwargs)
+                self._clients = dict()
+
+            def client(self, *args, **kwargs):
+                try:
+                    key = (args, tuple(sorted(kwargs.items())))
+                    hash(key)
+                except TypeError:
+                    return super(CachingSession, self).client(*args, **kwargs)
+                if key not in self._clients:
+                    self._clients[key] = super(CachingSession, self).client(*args, **kwargs)
+                return self._clients[key]
+
+        _session_class = CachingSession
+    return _session_class(**kwargs)
+
+
+class CredentialCache(object):
+    """
+    Assumed-role sessions, keyed by role ARN.
+    """
+    def __init__(self, refresh_margin=REFRESH_MARGIN, endpoint_url=None):
+        """
+        :param refresh_margin: Seconds ahead of expiration at which credentials are refreshed.
+        :param endpoint_url: STS endpoint to use instead of AWS, e.g. a local stub.
+        """
+        self.refresh_margin = refresh_margin
+        self.endpoint_url = endpoint_url
+        self.sessions = dict()
+        self.sts_calls = 0
+        self._sts = None
+
+    def session(self, roleARN):
+        """
+        Get a session for the given role, assuming it through STS if there is no cached session or it is about to
+        expire.
+        :param roleARN: The IAM role to assume.
+        :return: boto3.Session.
+        """
+        cached = self.sessions.get(roleARN)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if cached and (cached[1] - now).total_seconds() > self.refresh_margin:
+            return cached[0]
+
+        print("Going to assume role %s" % roleARN)
+        import boto3
+        # The endpoint may be set after construction, e.g. from the command line; a client for another is stale.
+        if self._sts is None or self._sts[0] != self.endpoint_url:
+            self._sts = self.endpoint_url, boto3.client("sts", endpoint_url=self.endpoint_url)
+        creds = self._sts[1].assume_role(RoleArn=roleARN, RoleSessionName='emulambda',)['Credentials']
+        self.sts_calls += 1
+        session = caching_session(aws_access_key_id=creds['AccessKeyId'],
+                                  aws_secret_access_key=creds['SecretAccessKey'],
+                                  aws_session_token=creds['SessionToken'])
+        self.sessions[roleARN] = (session, creds['Expiration'])
+        return session
+
+    def setup_default_session(self, roleARN):
+        """
+        Make the session for the given role boto3's default session, so that `boto3.client()` and friends in the
+        lambda use it.
+        :param roleARN: The IAM role to assume.
+        :return: Void.
+        """
+        import boto3
+        session = self.session(roleARN)
+        if boto3.DEFAULT_SESSION is not session:
+            print("Setting up the default session")
+            boto3.DEFAULT_SESSION = session
+
+
+default_cache = CredentialCache()
@@ -0,0 +1,255 @@
+"""
+Random access to LDJSON event files. A file is opened through mmap, with a sidecar index of line offsets
+(`<file>.idx`) which is built on first use and re-used until the file changes. This allows slicing a stream, resuming
+it from a checkpoint, and splitting it into ranges for parallel consumers without reading it from the start.
+"""
+from array import array
+from bisect import bisect_left
+import datetime
+import itertools
+import mmap
+import os
+import struct
+import sys
+import threading
+
+INDEX_MAGIC = b'EMLIDX01'
+# Magic, file size, file mtime in ns, line count; 32 bytes, keeping the offsets which follow 8-byte aligned. The
+# offsets are little-endian too, like the header, so an index is valid whichever machine wrote it.
+INDEX_HEADER = struct.Struct('<8sQQQ')
+
+
+class EventFile(object):
+    """
+    A memory-mapped LDJSON file and its line index.
+    """
+    def __init__(self, path):
+        """
+        :param path: Path to a LDJSON file.
+        """
+        self.path = path
+        self.index_path = path + '.idx'
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else b''
+        self._index = None
+        self.offsets = self._load_index(st) or self._build_index(st)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def line(self, i):
+        """
+        :param i: 1-based line number.
+        :return: The line, as a string.
+        """
+        return self.data[self.offsets[i - 1]:self.offsets[i]].decode('utf-8')
+
+    def lines(self, start=1, end=None, step=1):
+        """
+        :param start: First line number (1-based).
+        :param end: Last line number, inclusive. None for the end of the file.
+        :param step: Take every `step`th line.
+        :return: Iterator of (line number, line). Blank lines are skipped.
+        """
+        end = len(self) if end is None else min(end, len(self))
+        for i in range(max(start, 1), end + 1, step):
+            line = self.line(i)
+            if line.strip():
+                yield i, line
+
+    def ranges(self, n):
+        """
+        Split the file into at most n contiguous ranges of lines, of roughly equal size in bytes.
+        :param n: Number of ranges.
+        :return: List of (first line, last line), 1-based and inclusive.
+        """
+        if len(self) == 0:
+            return list()
+        size = self.offsets[-1]
+        bounds = [0] + [bisect_left(self.offsets, size * k // n, 0, len(self)) for k in range(1, n)] + [len(self)]
+        return [(a + 1, b) for a, b in zip(bounds, bounds[1:]) if b > a]
+
+    def close(self):
+        """
+        Unmap the file and its index.
+        :return: Void.
+        """
+        if isinstance(self.offsets, memoryview):
+            self.offsets.release()
+        for mapped in (self._index, self.data):
+            mapped.close() if isinstance(mapped, mmap.mmap) else None
+        self._index = None
+
+    def _load_index(self, st):
+        try:
+            with open(self.index_path, 'rb') as f:
+                index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return None
+        if len(index) < INDEX_HEADER.size:
+            index.close()
+            return None
+        magic, size, mtime, count = INDEX_HEADER.unpack_from(index)
+        if magic != INDEX_MAGIC or size != st.st_size or mtime != st.st_mtime_ns or \
+                len(index) != INDEX_HEADER.size + (count + 1) * 8:
+            index.close()
+            return None
+        if sys.byteorder == 'big':
+            offsets = array('Q', memoryview(index)[INDEX_HEADER.size:].tobytes())
+            offsets.byteswap()
+            index.close()
+            return offsets
+        self._index = index
+        return memoryview(index)[INDEX_HEADER.size:].cast('Q')
+
+    def _build_index(self, st):
+        offsets = array('Q', [0])
+        find = self.data.find
+        pos = find(b'\n') if st.st_size else -1
+        while pos != -1:
+            offsets.append(pos + 1)
+            pos = find(b'\n', pos + 1)
+        if offsets[-1] != st.st_size:
+            offsets.append(st.st_size)  # last line has no newline
+        try:
+            tmp = '%s.%i.tmp' % (self.index_path, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, st.st_size, st.st_mtime_ns, len(offsets) - 1))
+                if sys.byteorder == 'big':
+                    swapped = array('Q', offsets)
+                    swapped.byteswap()
+                    swapped.tofile(f)
+                else:
+                    offsets.tofile(f)
+            os.replace(tmp, self.index_path)
+        except (IOError, OSError):
+            pass  # e.g. a read-only directory; the index is simply not kept
+        return offsets
+
+
+def read_events(stream, start=1, end=None, step=1, part=None, checkpoint=None):
+    """
+    Read numbered lines from a LDJSON file, or '-' for stdin. Files are read through their index; stdin is read one
+    line at a time, so it is never buffered whole.
+    :param stream: Path to a file, or '-'.
+    :param start: First line number (1-based).
+    :param end: Last line number, inclusive. None for the end of the stream.
+    :param step: Take every `step`th line.
+    :param part: (k, n) to read only the kth (1-based) of n byte ranges of a file, not stdin. None for the whole file.
+    :param checkpoint: A Checkpoint. Lines up to the checkpoint are skipped, and lines are registered with it as they
+                       are read.
+    :return: Iterator of (line number, line). Blank lines are skipped.
+    """
+    events = EventFile(stream) if stream != '-' else None
+    try:
+        if part is not None:
+            ranges = events.ranges(part[1])
+            first, last = ranges[part[0] - 1] if part[0] <= len(ranges) else (1, 0)
+            # Keep the lines of the slice which fall in this part.
+            start = max(start, start + -(-(first - start) // step) * step)
+            end = last if end is None else min(end, last)
+        if checkpoint is not None and checkpoint.last >= start:
+            # Carry on from the first line after the checkpoint which the slice would have taken.
+            start += ((checkpoint.last - start) // step + 1) * step
+        if events is None:
+            numbered = itertools.islice(enumerate(sys.stdin, 1), start - 1, end, step)
+            lines = ((i, line) for i, line in numbered if line.strip())
+        else:
+            lines = events.lines(start, end, step)
+        for i, line in lines:
+            checkpoint.started(i) if checkpoint is not None else None
+            yield i, line
+    finally:
+        events.close() if events is not None else None
+
+
+class Checkpoint(object):
+    """
+    Progress through a stream, saved to a file so that a crashed run can be resumed. Events may finish out of order;
+    the saved position is the last line before which every event has finished. The file also records the slice of the
+    stream the run was taking, as resuming with another slice would skip lines it never ran.
+    """
+    def __init__(self, path, every=100, start=1, end=None, step=1, part=None):
+        """
+        :param path: Checkpoint file. If it exists, the run resumes after the line it records.
+        :param every: Save after this many events have finished.
+        :param start: First line number of the slice the run takes.
+        :param end: Last line number of the slice, or None for the end of the stream.
+        :param step: Step of the slice.
+        :param part: (k, n) part of the file the run takes, or None.
+        :raises ValueError: If the checkpoint file was made for another slice.
+        """
+        self.path = path
+        self.every = every
+        self.slice = _slice(start, end, step, part)
+        try:
+            with open(path, 'r') as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError):
+            lines = list()
+        self.last = int(lines[0].strip() or 0) if lines else 0
+        # Checkpoints written before slices were recorded have none to check.
+        if len(lines) > 1 and lines[1].strip() != self.slice:
+            raise ValueError("Checkpoint %s was made for a run with %s, not %s; delete it to start over." %
+                             (path, lines[1].strip(), self.slice))
+        self.resumed = self.last
+        self.outstanding = set()
+        self.dispatched = self.last
+        self.finished = 0
+        self.lock = threading.Lock()
+
+    def started(self, i):
+        with self.lock:
+            self.outstanding.add(i)
+            self.dispatched = i
+
+    def done(self, i):
+        with self.lock:
+            self.outstanding.discard(i)
+            self.finished += 1
+            due = self.finished % self.every == 0
+        self.save() if due else None
+
+    def save(self):
+        """
+        Write the checkpoint atomically.
+        :return: Void.
+        """
+        with self.lock:
+            self.last = min(self.outstanding) - 1 if self.outstanding else self.dispatched
+            tmp = '%s.%i.tmp' % (self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write('%i\n%s\n' % (self.last, self.slice))
+            os.replace(tmp, self.path)
+
+
+def _slice(start, end, step, part):
+    """
+    :return: The slice of a stream, as the arguments giving it.
+    """
+    return '--start %i --end %s --sample %i --part %s' % (start, 'last' if end is None else '%i' % end, step,
+                                                         '%i/%i' % tuple(part) if part else 'all')
+
+
+def parse_timestamp(value):
+    """
+    Parse a recorded time, e.g. the arrival time of an event.
+    :param value: Epoch seconds, or an ISO 8601 string.
+    :return: Epoch seconds as float, or None.
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        parsed = datetime.datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
@@ -0,0 +1,145 @@
+"""
+Fork server. A zygote container imports the lambda once, then forks a child for every invocation (or every batch of
+invocations). Children share the zygote's warm pages copy-on-write, so they start without re-importing anything, and
+nothing an invocation does to its interpreter (leaking memory, changing globals, crashing it) outlives its child.
+"""
+from __future__ import print_function
+import gc
+import os
+import pickle
+import select
+import signal
+import sys
+
+import emulambda
+from emulambda.container import Container, load
+from emulambda.gcpolicy import GCPolicy
+from emulambda.memory import get_meter
+
+# Seconds a child may overrun its timeout before it is killed, e.g. when stuck in C code which the timeout cannot
+# interrupt.
+GRACE = 5
+
+
+class ForkServer(Container):
+    """
+    A container which runs invocations in children forked from it. Every child serves `args.fork_batch` invocations,
+    one at a time, then exits; a child which crashes only fails the invocation it was running.
+    """
+    def _body(self):
+        return _zygote
+
+
+def _zygote(args, conn, memory_size=None):
+    """
+    Zygote process body. Imports the lambda, then relays invocations to forked children until told to stop.
+    """
+    loaded = load(args, conn, memory_size)
+    if loaded is None:
+        return
+    lfunc = loaded[0]
+    # Keep what the import allocated out of the collector's reach, so that children collecting do not copy its pages.
+    gc.collect()
+    gc.freeze() if hasattr(gc, 'freeze') else None
+    child = None
+    try:
+        while True:
+            message = conn.recv()
+            if message is None:
+                break
+            child = child or Child(args, lfunc, conn)
+            conn.send(child.invoke(message))
+            if child.pid is None or child.invokes >= args.fork_batch:
+                child.close()
+                child = None
+    finally:
+        child.close() if child else None
+
+
+class Child(object):
+    """
+    A forked child serving invocations over a pair of pipes.
+    """
+    def __init__(self, args, lfunc, conn):
+        """
+        :param args: Argument namespace from `parseargs()`.
+        :param lfunc: The lambda.
+        :param conn: The zygote's connection to its parent, which the child must not use.
+        """
+        self.args = args
+        self.invokes = 0
+        events_r, events_w = os.pipe()
+        results_r, results_w = os.pipe()
+        sys.stdout.flush()  # or the child would write out our buffered output again
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            os.close(events_w)
+            os.close(results_r)
+            conn.close()
+            status = 0
+            try:
+                _serve_child(args, lfunc, os.fdopen(events_r, 'rb'), os.fdopen(results_w, 'wb'))
+            except BaseException:
+                status = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        os.close(events_r)
+        os.close(results_w)
+        self.events = os.fdopen(events_w, 'wb')
+        self.results = os.fdopen(results_r, 'rb')
+
+    def invoke(self, message):
+        """
+        Run an invocation in the child.
+        :param message: (event, context).
+        :return: Function result, execution time in ms, execution RSS and garbage collection log.
+        """
+        self.invokes += 1
+        try:
+            pickle.dump(message, self.events, pickle.HIGHEST_PROTOCOL)
+            self.events.flush()
+            if not select.select([self.results], [], [], self.args.timeout + GRACE)[0]:
+                os.kill(self.pid, signal.SIGKILL)
+            return pickle.load(self.results)
+        except (EOFError, OSError, pickle.UnpicklingError):
+            return self._crashed()
+
+    def close(self):
+        """
+        Let the child finish, and reap it.
+        :return: Void.
+        """
+        self.events.close()
+        self.results.close()
+        if self.pid is not None:
+            os.waitpid(self.pid, 0)
+            self.pid = None
+
+    def _crashed(self):
+        pid, status, rusage = os.wait4(self.pid, 0)
+        self.pid = None
+        print("\nThe invocation's process exited with %s.\n" % (
+            'signal %i' % os.WTERMSIG(status) if os.WIFSIGNALED(status) else 'status %i' % os.WEXITSTATUS(status)))
+        return "EMULAMBDA: RUNTIME ERROR", -1, 0, list()
+
+
+def _serve_child(args, lfunc, events, results):
+    """
+    Forked child body. Serves invocations until the zygote closes its pipe.
+    """
+    # A child's memory starts out smaller than the zygote's, as it shares most pages without having touched them.
+    meter = get_meter(args.memory)
+    policy = GCPolicy(args.gc, meter)
+    while True:
+        try:
+            event, context = pickle.load(events)
+        except EOFError:
+            return
+        policy.before()
+        meter.start()
+        result, exec_clock = emulambda.invoke_lambda(lfunc, event, context, args.timeout, args.role)
+        pickle.dump((result, exec_clock, meter.stop(), policy.drain()), results, pickle.HIGHEST_PROTOCOL)
+        results.flush()
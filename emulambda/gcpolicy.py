@@ -0,0 +1,139 @@
+"""
+Garbage collection policies. By default a full collection is forced before every invocation, so that garbage left by
+the previous invocation does not count towards the next one's memory, but on a large heap that collection can cost
+more than the function does, and Lambda forces none. A policy decides when to collect, and times every collection,
+forced or automatic, through `gc.callbacks`.
+"""
+import argparse
+import gc
+import time
+
+POLICIES = ('always', 'never', 'every-N', 'adaptive')
+# The adaptive policy collects the oldest generation once it is this far towards its automatic collection threshold.
+PRESSURE = 0.5
+
+
+def parse_policy(value):
+    """
+    Parse a garbage collection policy argument.
+    :param value: One of POLICIES, with a number for N, e.g. every-100.
+    :return: The policy, as given.
+    """
+    if value in POLICIES and value != 'every-N':
+        return value
+    kind, _, n = value.partition('-')
+    if kind != 'every' or not n.isdigit() or int(n) < 1:
+        raise argparse.ArgumentTypeError("%s is not one of always, never, every-N (e.g. every-100) or adaptive" % value)
+    return value
+
+
+class GCPolicy(object):
+    """
+    Forces collections before invocations, as a policy asks, and times every collection in this process. Collection
+    times in ms are added to the 'gc' (automatic) and 'forced_gc' (forced) OnlineStats of a statistics dictionary, or,
+    without one, logged until drained (e.g. to send them from a container to its parent). `last` is the time spent in
+    automatic collections since invocations last started, i.e. within the latest one when they run one at a time.
+    """
+    def __init__(self, policy='always', meter=None, stats=None, timed=True):
+        """
+        :param policy: One of POLICIES.
+        :param meter: Memory meter of the invocations. The adaptive policy only collects for meters which measure
+                      every invocation separately, which garbage from an earlier invocation would skew.
+        :param stats: Dictionary from `new_stats()` to record collection times in, or None to log them.
+        :param timed: Time automatic collections. False for a process which does not run the lambda itself.
+        """
+        self.policy = policy
+        self.every = int(policy.partition('-')[2]) if policy.startswith('every-') else None
+        self.meter = meter
+        self.stats = stats
+        self.log = list()
+        self.last = 0.0
+        self.invocations = 0
+        self.forcing = False
+        self.started = None
+        self.timed = timed and hasattr(gc, 'callbacks')
+        gc.callbacks.append(self._callback) if self.timed else None
+
+    def before(self, n=1):
+        """
+        Collect, if the policy says so, before running invocations.
+        :param n: Number of invocations about to run, e.g. a batch.
+        :return: Void.
+        """
+        self.last = 0.0
+        seen, self.invocations = self.invocations, self.invocations + n
+        if self.policy == 'always':
+            self._collect()
+        elif self.every is not None:
+            self._collect() if self.invocations // self.every > seen // self.every else None
+        elif self.policy == 'adaptive' and getattr(self.meter, 'per_invocation', False):
+            generation = adaptive_generation()
+            self._collect(generation) if generation is not None else None
+
+    def drain(self):
+        """
+        :return: List of (forced, ms) for the collections logged since the last drain.
+        """
+        log, self.log = self.log, list()
+        return log
+
+    def close(self):
+        """
+        Stop timing collections.
+        :return: Void.
+        """
+        if self.timed and self._callback in gc.callbacks:
+            gc.callbacks.remove(self._callback)
+
+    def _collect(self, generation=2):
+        self.forcing = True
+        try:
+            if self.timed:
+                gc.collect(generation)
+            else:
+                s = time.time()
+                gc.collect(generation)
+                self._record(True, (time.time() - s) * 1000)  # convert to ms
+        finally:
+            self.forcing = False
+
+    def _callback(self, phase, info):
+        if phase == 'start':
+            self.started = time.time()
+        elif self.started is not None:
+            self._record(self.forcing, (time.time() - self.started) * 1000)  # convert to ms
+            self.started = None
+
+    def _record(self, forced, ms):
+        self.last += 0 if forced else ms
+        if self.stats is None:
+            self.log.append((forced, ms))
+        else:
+            record_gc(self.stats, [(forced, ms)])
+
+
+def adaptive_generation():
+    """
+    Choose the youngest generation holding what earlier invocations left behind. Objects allocated since the last
+    collection are in generation 0, and those promoted by collections since are in generation 1; the oldest generation
+    is only collected once it is under pressure, i.e. the generation 1 collections since its own are near the
+    threshold at which Python would collect it anyway, likely during an invocation.
+    :return: Generation to collect, or None if nothing has been allocated since the last collection.
+    """
+    counts, thresholds = gc.get_count(), gc.get_threshold()
+    if len(counts) > 2 and len(thresholds) > 2 and thresholds[2] and counts[2] >= thresholds[2] * PRESSURE:
+        return 2
+    if counts[1] > 0:
+        return 1
+    return 0 if counts[0] > 0 else None
+
+
+def record_gc(stats, log):
+    """
+    Store collection times in a statistics dictionary.
+    :param stats: Dictionary from `new_stats()`.
+    :param log: List of (forced, ms), as from `GCPolicy.drain()`.
+    :return: Void.
+    """
+    for forced, ms in log:
+        stats['forced_gc' if forced else 'gc'].add(ms)
@@ -0,0 +1,156 @@
+"""
+Import-time profiling and lazy imports, to see what a function's cold start is made of and what deferring its imports
+would save. Both work as finders at the front of `sys.meta_path`, which hand out the specs of the finders behind them
+with a different loader: one timing the module's execution, or one deferring it until an attribute is first used.
+"""
+import importlib.machinery
+import importlib.util
+import sys
+import threading
+import time
+
+
+def _find_spec(skip, name, path, target):
+    """
+    Find a module with the finders after `skip` on `sys.meta_path`.
+    :return: ModuleSpec, or None.
+    """
+    finders = sys.meta_path
+    for finder in finders[finders.index(skip) + 1:] if skip in finders else finders:
+        find_spec = getattr(finder, 'find_spec', None)
+        spec = find_spec(name, path, target) if find_spec else None
+        if spec is not None:
+            return spec
+    return None
+
+
+class ImportNode(object):
+    """
+    A module in the import tree, with the time taken to find and execute it, including the modules it imported.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.cumulative = 0.0
+        self.children = list()
+
+    @property
+    def own(self):
+        """
+        :return: Seconds spent in this module itself, not in the modules it imported.
+        """
+        return max(0.0, self.cumulative - sum(child.cumulative for child in self.children))
+
+    def walk(self, depth=0):
+        """
+        :return: Iterator of (depth, node), depth first, in import order.
+        """
+        yield depth, self
+        for child in self.children:
+            for pair in child.walk(depth + 1):
+                yield pair
+
+
+class _TimedLoader(object):
+    """
+    Wraps a loader to time module execution, and to nest the modules imported meanwhile under the module.
+    """
+    def __init__(self, loader, node, recorder):
+        self.loader = loader
+        self.node = node
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        # The module should see its real loader, e.g. to read its resources.
+        module.__loader__ = module.__spec__.loader = self.loader
+        self.recorder.stack.append(self.node)
+        s = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.node.cumulative += time.perf_counter() - s
+            self.recorder.stack.pop()
+
+
+class ImportRecorder(object):
+    """
+    Records the import tree of everything imported by one thread while it is started, like `python -X importtime`.
+    Modules which were already imported cost nothing and are not recorded.
+    """
+    def __init__(self):
+        self.root = ImportNode(None)
+        self.stack = [self.root]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.current_thread().ident
+        sys.meta_path.insert(0, self)
+
+    def stop(self):
+        sys.meta_path.remove(self)
+
+    @property
+    def total(self):
+        """
+        :return: Seconds spent importing.
+        """
+        return sum(child.cumulative for child in self.root.children)
+
+    def modules(self):
+        """
+        :return: List of every ImportNode recorded, depth first, in import order.
+        """
+        return [node for depth, node in self.root.walk()][1:]
+
+    def slowest(self, n):
+        """
+        :param n: Number of modules.
+        :return: List of the n ImportNodes with the most time of their own.
+        """
+        return sorted(self.modules(), key=lambda node: node.own, reverse=True)[:n]
+
+    def find_spec(self, name, path, target=None):
+        if threading.current_thread().ident != self.thread:
+            return None
+        node = ImportNode(name)
+        s = time.perf_counter()
+        spec = _find_spec(self, name, path, target)
+        node.cumulative = time.perf_counter() - s
+        if spec is None:
+            return None
+        self.stack[-1].children.append(node)
+        if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+            spec.loader = _TimedLoader(spec.loader, node, self)
+        return spec
+
+
+class LazyImporter(object):
+    """
+    Defers the execution of modules loaded from Python source until an attribute of them is first used, through
+    `importlib.util.LazyLoader`. Extension and built-in modules load as usual.
+    """
+    LAZY_LOADERS = (importlib.machinery.SourceFileLoader, importlib.machinery.SourcelessFileLoader)
+
+    def find_spec(self, name, path, target=None):
+        spec = _find_spec(self, name, path, target)
+        if spec is not None and isinstance(spec.loader, self.LAZY_LOADERS):
+            spec.loader = importlib.util.LazyLoader(spec.loader)
+        return spec
+
+
+def enable_lazy_imports():
+    """
+    Make every later import of a Python module lazy, for the rest of the process.
+    :return: The LazyImporter installed.
+    """
+    for finder in sys.meta_path:
+        if isinstance(finder, LazyImporter):
+            return finder  # e.g. inherited by a forked worker
+    importer = LazyImporter()
+    sys.meta_path.insert(0, importer)
+    return importer
@@ -0,0 +1,145 @@
+"""
+Load generation. Stream mode runs events back to back, so it says nothing of latency under a real arrival rate. Here
+events arrive open-loop, at a fixed rate, as a Poisson process, or at their recorded arrival times, whether or not
+earlier invocations have finished, and are run on a pool of warm worker processes. As with a function's reserved
+concurrency, no more than `--concurrency` invocations run at once; the rest are throttled, or queue for a free worker.
+"""
+from __future__ import print_function
+import collections
+import random
+import time
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from emulambda import serializer
+from emulambda.eventfile import parse_timestamp, read_events
+from emulambda.stats import OnlineStats
+
+ARRIVALS = ('fixed', 'poisson', 'replay')
+THROTTLING = ('queue', 'reject')
+
+
+def schedule(events, arrivals, rate=None, field=None, seed=None):
+    """
+    Give each event an arrival time.
+    :param events: Iterator of (line number, line), from `read_events()`.
+    :param arrivals: One of ARRIVALS.
+    :param rate: Events per second, for fixed and Poisson arrivals.
+    :param field: Field of each event holding its arrival time (epoch seconds or ISO 8601), for replayed arrivals.
+                  Events without one arrive with the event before.
+    :param seed: Seed of the Poisson process, or None.
+    :return: Iterator of (line number, line, seconds after the first arrival).
+    """
+    rng = random.Random(seed)
+    due, first = 0.0, None
+    for i, line in events:
+        if arrivals == 'replay':
+            event = serializer.loads(line)
+            arrival = parse_timestamp(event.get(field)) if isinstance(event, dict) else None
+            if arrival is not None:
+                first = arrival if first is None else first
+                due = max(due, arrival - first)
+        yield i, line, due
+        if arrivals == 'fixed':
+            due += 1.0 / rate
+        elif arrivals == 'poisson':
+            due += rng.expovariate(rate)
+
+
+def emit_load(args, func, checkpoint=None, profiler=None):
+    """
+    Run a LDJSON stream on a pool of `args.concurrency` warm worker processes, at the arrival times of `schedule()`.
+    :param args: Argument namespace from `parseargs()`; `load` is the arrival process, `rate` and `replay_field` its
+                 settings, `concurrency` the cap, and `throttle` what happens to events over it.
+    :param func: A function taking (index, line, result, exec_clock, exec_rss, exec_init, exec_gc), invoked in this
+                 process per result.
+    :param checkpoint: A Checkpoint to resume from and record progress in.
+    :param profiler: A profiler to gather the workers' profiles in.
+    :return: Per-worker statistics dictionaries, and a dictionary of 'latency' and 'queue' OnlineStats (in ms, from
+             arrival to result and to dispatch), 'offered', 'completed' and 'throttled' counts, 'elapsed' seconds and
+             'peak' concurrency.
+    """
+    # Imported here, so that importing this module for its settings does not load multiprocessing.
+    import multiprocessing
+    from emulambda.workers import work
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=work, args=(args, tasks, results)) for _ in range(args.concurrency)]
+    for p in procs:
+        p.daemon = True
+        p.start()
+    report = {'latency': OnlineStats(), 'queue': OnlineStats(), 'offered': 0, 'completed': 0, 'throttled': 0,
+              'elapsed': 0.0, 'peak': 0}
+    stats = list()
+    ready = [0]
+    in_flight = dict()
+    backlog = collections.deque()
+
+    def dispatch(i, line, arrival):
+        in_flight[i] = arrival, time.time()
+        report['peak'] = max(report['peak'], len(in_flight))
+        tasks.put([(i, line)])
+
+    def receive(timeout):
+        """
+        Handle the next message from the workers, if one comes within the timeout.
+        """
+        try:
+            kind, payload = results.get(timeout=max(timeout, 0.001))
+        except Empty:
+            if any(p.exitcode not in (None, 0) for p in procs):
+                raise RuntimeError("A worker process died unexpectedly.")
+            return
+        if kind == 'error':
+            raise payload
+        elif kind == 'ready':
+            ready[0] += 1
+        elif kind == 'profile':
+            profiler.absorb(payload)
+        elif kind == 'stats':
+            stats.append(payload)
+        else:
+            now = time.time()
+            for r in payload:
+                arrival, dispatched = in_flight.pop(r[0])
+                report['latency'].add((now - arrival) * 1000)  # convert to ms
+                report['queue'].add((dispatched - arrival) * 1000)
+                report['completed'] += 1
+                func(*r)
+                checkpoint.done(r[0]) if checkpoint else None
+            while backlog and len(in_flight) < args.concurrency:
+                dispatch(*backlog.popleft())
+
+    try:
+        # Start the clock once every worker is warm, so that imports do not hold up the first arrivals.
+        while ready[0] < len(procs):
+            receive(1)
+        events = read_events(args.eventfile, args.start, args.end, args.sample, args.part, checkpoint)
+        start = time.time()
+        for i, line, due in schedule(events, args.load, args.rate, args.replay_field, args.seed):
+            while start + due > time.time():
+                receive(start + due - time.time())
+            report['offered'] += 1
+            if len(in_flight) < args.concurrency:
+                dispatch(i, line, start + due)
+            elif args.throttle == 'queue':
+                backlog.append((i, line, start + due))
+            else:
+                report['throttled'] += 1
+                checkpoint.done(i) if checkpoint else None
+        while in_flight or backlog:
+            receive(1)
+        report['elapsed'] = time.time() - start
+        for _ in procs:
+            tasks.put(None)
+        while len(stats) < len(procs):
+            receive(1)
+    finally:
+        for p in procs:
+            if p.is_alive() and len(stats) < len(procs):
+                p.terminate()
+            p.join()
+    return stats, report
@@ -0,0 +1,144 @@
+"""
+Log capture. While an invocation runs, what the function writes to stdout and stderr, and what it logs through
+`logging`, is kept in memory instead of interleaving with the results. It is then written to a log file in the form of
+CloudWatch Logs, between START, END and REPORT lines, a batch of invocations at a time.
+"""
+import logging
+import sys
+import time
+import uuid
+
+import emulambda
+from emulambda.memory import RusageMeter
+from emulambda.render import billing_bucket
+
+# Invocations whose logs are written to the file at a time.
+BATCH = 64
+# Format of `logging` records, as in the Lambda Python runtime.
+FORMAT = '[%(levelname)s]\t%(asctime)s.%(msecs)03dZ\t%(aws_request_id)s\t%(message)s\n'
+
+
+class LogBuffer(object):
+    """
+    Text stream which keeps what is written to it.
+    """
+    def __init__(self):
+        self.parts = list()
+
+    def write(self, s):
+        self.parts.append(s)
+        return len(s)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+
+class BufferHandler(logging.Handler):
+    """
+    Logging handler writing records to a LogBuffer, formatted as by the Lambda runtime.
+    """
+    def __init__(self, buffer, request_id):
+        super(BufferHandler, self).__init__()
+        self.buffer = buffer
+        self.request_id = request_id
+        self.setFormatter(logging.Formatter(FORMAT, '%Y-%m-%dT%H:%M:%S'))
+        self.formatter.converter = time.gmtime
+
+    def emit(self, record):
+        record.aws_request_id = self.request_id
+        try:
+            self.buffer.write(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class LogCapture(object):
+    """
+    Captures the output of invocations in this process, one at a time, and writes it to a log file. Bytes and lines
+    logged per invocation are added to the 'log_bytes' and 'log_lines' OnlineStats of a statistics dictionary, and the
+    time taken to write each batch to the file, in ms, to 'log_write'.
+    """
+    def __init__(self, path, stats=None):
+        """
+        :param path: Log file to write.
+        :param stats: Dictionary from `new_stats()` to record log volume in, or None.
+        """
+        self.file = open(path, 'w')
+        self.stats = stats
+        self.pending = list()
+        self.buffer = None
+        self.handler = None
+        self.streams = None
+        self.request_id = None
+
+    def start(self):
+        """
+        Start capturing the output of an invocation.
+        :return: Request ID of the invocation.
+        """
+        self.request_id = str(uuid.uuid4())
+        self.buffer = LogBuffer()
+        self.handler = BufferHandler(self.buffer, self.request_id)
+        logging.getLogger().addHandler(self.handler)
+        self.streams = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = self.buffer
+        return self.request_id
+
+    def stop(self, exec_clock, exec_rss, exec_init=None):
+        """
+        Stop capturing, and queue the output of the invocation with its START, END and REPORT lines.
+        :param exec_clock: Execution time in ms, -1 for aborted invocations.
+        :param exec_rss: Execution RSS in bytes, relative to the process before the invocation. The REPORT line gives
+                         the absolute peak RSS of the process instead, as Lambda gives the peak of its sandbox.
+        :param exec_init: Cold start (import) time in ms, or None if the invocation was warm.
+        :return: Void.
+        """
+        peak = emulambda.get_memory_usage() * RusageMeter.scale
+        sys.stdout, sys.stderr = self.streams
+        logging.getLogger().removeHandler(self.handler)
+        output = self.buffer.getvalue()
+        if output and not output.endswith('\n'):
+            output += '\n'
+        report = 'REPORT RequestId: %s\tDuration: %.2f ms\tBilled Duration: %i ms\tMax Memory Used: %i MB' % (
+            self.request_id, max(exec_clock, 0), billing_bucket(max(exec_clock, 0)), peak / (1024 * 1024))
+        report += '\tInit Duration: %.2f ms' % exec_init if exec_init is not None else ''
+        self.pending.append('START RequestId: %s Version: $LATEST\n%sEND RequestId: %s\n%s\n' % (
+            self.request_id, output, self.request_id, report))
+        if self.stats is not None:
+            self.stats['log_bytes'].add(len(output.encode('utf-8')))
+            self.stats['log_lines'].add(output.count('\n'))
+        self.buffer = self.handler = self.streams = None
+        self.flush() if len(self.pending) >= BATCH else None
+
+    def flush(self):
+        """
+        Write the queued invocations to the log file.
+        :return: Void.
+        """
+        if not self.pending:
+            return
+        s = time.time()
+        self.file.write(''.join(self.pending))
+        self.file.flush()
+        self.stats['log_write'].add((time.time() - s) * 1000) if self.stats is not None else None  # convert to ms
+        del self.pending[:]
+
+    def close(self):
+        """
+        Write out what is queued, and close the log file.
+        :return: Void.
+        """
+        try:
+            self.flush()
+        finally:
+            self.file.close()
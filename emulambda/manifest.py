@@ -0,0 +1,211 @@
+"""
+Manifests of several functions. A SAM template, or a JSON or YAML list of handlers, is loaded into one emulator: every
+function is imported into the same interpreter, so libraries they share are imported once, and each event is routed to
+a function by a field of the event. Every function keeps its own timeout, memory size and statistics.
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+
+import emulambda
+from emulambda import serializer
+from emulambda.stats import new_stats, record_stats
+
+EXTENSIONS = ('.json', '.yaml', '.yml', '.template')
+FUNCTION_TYPES = ('AWS::Serverless::Function', 'AWS::Lambda::Function')
+
+
+class Route(object):
+    """
+    A function of a manifest, with its settings, and once loaded, the function itself and its statistics.
+    """
+    def __init__(self, name, handler, timeout=None, memory_size=None, code_uri=None):
+        """
+        :param name: Name events are routed to the function by.
+        :param handler: Import path of the function, as `module.function`.
+        :param timeout: Execution timeout in seconds, or None for the default.
+        :param memory_size: Configured memory size in MB, or None.
+        :param code_uri: Directory the function's code is in, put on sys.path, or None.
+        """
+        self.name = name
+        self.handler = handler
+        self.timeout = timeout
+        self.memory_size = memory_size
+        self.code_uri = code_uri
+        self.func = None
+        self.pending_init = list()
+        self.modules = 0
+        self.stats = None
+        self.over_memory = 0
+
+
+def is_manifest(path):
+    """
+    :param path: The `lambdapath` argument.
+    :return: Whether it names a manifest file rather than a function.
+    """
+    return os.path.splitext(path)[1] in EXTENSIONS and os.path.isfile(path)
+
+
+def load_manifest(path):
+    """
+    Read the functions of a manifest. A SAM (or CloudFormation) template gives its Python functions, under their
+    logical IDs, with the Handler, CodeUri, Timeout and MemorySize of their properties or of the template's Globals.
+    Otherwise, the manifest is a list of {"name", "handler", "timeout", "memory_size", "code_uri"} objects, of which
+    only "handler" is required, or a dictionary of names to such objects or to handlers.
+    :param path: Manifest file; JSON, or YAML if PyYAML is installed. Code directories are relative to it.
+    :return: List of Routes.
+    """
+    document = _read(path)
+    base = os.path.dirname(os.path.abspath(path))
+    if isinstance(document, dict) and isinstance(document.get('Resources'), dict):
+        routes = _template_routes(document, base)
+    elif isinstance(document, dict):
+        routes = [_entry_route(dict(entry, name=name) if isinstance(entry, dict) else {'name': name, 'handler': entry},
+                               base) for name, entry in document.items()]
+    elif isinstance(document, list):
+        routes = [_entry_route(entry if isinstance(entry, dict) else {'handler': entry}, base) for entry in document]
+    else:
+        raise ValueError("Manifest %s is neither a SAM template nor a list of functions." % path)
+    if not routes:
+        raise ValueError("Manifest %s has no Python functions." % path)
+    names, modules = set(), dict()
+    for route in routes:
+        if route.name in names:
+            raise ValueError("Manifest %s has two functions named %s." % (path, route.name))
+        names.add(route.name)
+        # Functions share one module cache, so a module name can only come from one code directory.
+        module = route.handler.rsplit('.', 1)[0]
+        if modules.setdefault(module, route.code_uri) != route.code_uri:
+            raise ValueError("Functions of manifest %s import module %s from different code directories, %s and %s." %
+                             (path, module, modules[module], route.code_uri))
+    return routes
+
+
+def _read(path):
+    """
+    :return: The parsed manifest.
+    """
+    with open(path, 'r') as f:
+        text = f.read()
+    if os.path.splitext(path)[1] == '.json':
+        return serializer.loads(text)
+    try:
+        import yaml
+    except ImportError:
+        try:
+            return serializer.loads(text)
+        except ValueError:
+            raise ValueError("PyYAML is needed to read YAML manifest %s." % path)
+
+    class TemplateLoader(yaml.SafeLoader):
+        pass
+
+    # Intrinsic functions, e.g. !Ref and !GetAtt, cannot be resolved here; settings given by them are left to defaults.
+    TemplateLoader.add_multi_constructor('!', lambda loader, suffix, node: None)
+    return yaml.load(text, TemplateLoader)
+
+
+def _template_routes(template, base):
+    """
+    :return: Routes for the Python functions of a SAM or CloudFormation template.
+    """
+    defaults = (template.get('Globals') or {}).get('Function') or {}
+    routes = list()
+    for name, resource in template['Resources'].items():
+        if not isinstance(resource, dict) or resource.get('Type') not in FUNCTION_TYPES:
+            continue
+        # Settings given by unresolved intrinsic functions fall back to the Globals.
+        properties = dict(defaults, **dict((key, value) for key, value in (resource.get('Properties') or {}).items()
+                                           if value is not None))
+        runtime = properties.get('Runtime')
+        if isinstance(runtime, str) and not runtime.startswith('python'):
+            continue
+        if not isinstance(properties.get('Handler'), str):
+            raise ValueError("Function %s of the template has no Handler." % name)
+        code_uri = properties.get('CodeUri')
+        routes.append(Route(name, properties['Handler'], _number(properties.get('Timeout')),
+                            _number(properties.get('MemorySize')),
+                            os.path.join(base, code_uri) if isinstance(code_uri, str) else None))
+    return routes
+
+
+def _entry_route(entry, base):
+    """
+    :return: Route for an entry of a list or dictionary manifest.
+    """
+    if not isinstance(entry.get('handler'), str):
+        raise ValueError("Manifest entry %s has no handler." % serializer.dumps(entry))
+    code_uri = entry.get('code_uri')
+    return Route(entry.get('name') or entry['handler'], entry['handler'], _number(entry.get('timeout')),
+                 _number(entry.get('memory_size')), os.path.join(base, code_uri) if code_uri else None)
+
+
+def _number(value):
+    """
+    :return: A numeric setting, or None if it is missing or not a number (e.g. an unresolved !Ref).
+    """
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+
+class Router(object):
+    """
+    The functions of a manifest, loaded into this process, and the routing of events to them.
+    """
+    def __init__(self, routes, field, timeout=300, dump_samples=False):
+        """
+        :param routes: List of Routes.
+        :param field: Field of each event naming the function (or handler) to route it to.
+        :param timeout: Timeout in seconds of functions without their own.
+        :param dump_samples: Keep raw samples in the statistics of each function.
+        """
+        self.routes = routes
+        self.field = field
+        self.unrouted = 0
+        self._names = dict()
+        for route in routes:
+            route.timeout = timeout if route.timeout is None else route.timeout
+            route.stats = new_stats(dump_samples)
+            self._names.setdefault(route.handler, route)
+        self._names.update((route.name, route) for route in routes)
+
+    def __iter__(self):
+        return iter(self.routes)
+
+    def load(self):
+        """
+        Import every function, timing each import as the cold start of its function. Functions imported later
+        re-use the modules imported by those before.
+        :return: Void.
+        """
+        for route in self.routes:
+            if route.code_uri and route.code_uri not in sys.path:
+                sys.path.insert(0, route.code_uri)
+            modules, s = len(sys.modules), time.time()
+            route.func = emulambda.import_lambda(route.handler)
+            route.pending_init = [(time.time() - s) * 1000]  # convert to ms
+            route.modules = len(sys.modules) - modules
+
+    def route(self, event):
+        """
+        :param event: An event object.
+        :return: The Route the event is for, or None if it names no function. With one function, every event is
+                 for it.
+        """
+        if len(self.routes) == 1:
+            return self.routes[0]
+        name = event.get(self.field) if isinstance(event, dict) else None
+        route = self._names.get(name) if isinstance(name, str) else None
+        if route is None:
+            self.unrouted += 1
+        return route
+
+    def record(self, route, exec_clock, exec_rss, exec_init=None):
+        """
+        Store the statistics of an invocation of a function.
+        :return: Void.
+        """
+        record_stats(route.stats, exec_clock, exec_rss, exec_init)
+        if route.memory_size and exec_rss > route.memory_size * 1024 * 1024:
+            route.over_memory += 1
@@ -0,0 +1,161 @@
+"""
+Memoization of results. Captured streams often repeat events byte for byte (retries, health checks), and a
+deterministic function gives the same result for the same event, so it need only run once per distinct event. Results
+are kept by a hash of the normalized event and a fingerprint of the function's code, in a bounded LRU cache, and
+optionally in a SQLite file which persists across runs; the results of code which has since changed are never used,
+as its fingerprint differs. A fraction of hits can be run anyway, and their results compared, to catch functions which
+are not deterministic after all.
+"""
+import collections
+import hashlib
+import json
+import marshal
+import random
+
+import emulambda
+
+# Results kept in memory, by default.
+DEFAULT_SIZE = 1024
+# Results written to the store are committed in batches of this many.
+BATCH = 256
+
+
+def normalize(value):
+    """
+    :param value: An event or result.
+    :return: Canonical JSON of it, with sorted keys and no whitespace.
+    :raises TypeError: If it cannot be serialized as JSON.
+    """
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+def code_fingerprint(lambdapath, func):
+    """
+    Fingerprint the code of a function: the source of its modules (those which watch mode would reload), or for a
+    function without any, e.g. from an installed package, its bytecode.
+    :param lambdapath: Path given for the lambda, which must have been imported.
+    :param func: The function.
+    :return: Hex digest.
+    """
+    from emulambda.reload import ModuleGraph
+    digest = hashlib.sha256(str(lambdapath).encode('utf-8'))
+    files = ModuleGraph(emulambda.lambda_module(lambdapath)).files
+    for name in sorted(files):
+        digest.update(b'\0' + name.encode('utf-8') + b'\0')
+        with open(files[name], 'rb') as f:
+            digest.update(f.read())
+    code = getattr(func, '__code__', None)
+    if not files and code is not None:
+        digest.update(marshal.dumps(code))
+    return digest.hexdigest()
+
+
+class Memo(object):
+    """
+    Results of a function, by event.
+    """
+    def __init__(self, fingerprint, size=DEFAULT_SIZE, path=None, verify=0.0, seed=None):
+        """
+        :param fingerprint: Fingerprint of the function's code, from `code_fingerprint()`.
+        :param size: Most results to keep in memory; the least recently used are dropped.
+        :param path: SQLite file to keep results in across runs, or None.
+        :param verify: Fraction of hits to run anyway, to compare their results.
+        :param seed: Seed of the choice of hits to verify, or None.
+        """
+        self.fingerprint = fingerprint
+        self.size = size
+        self.verify = verify
+        self.cache = collections.OrderedDict()
+        self.rng = random.Random(seed)
+        self.db = None
+        self.pending = 0
+        if path:
+            import sqlite3
+            self.db = sqlite3.connect(path)
+            self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT, clock REAL, '
+                            'rss INTEGER)')
+
+    def key(self, event):
+        """
+        :param event: An event object.
+        :return: Key of the event's result, or None if the event cannot be normalized.
+        """
+        try:
+            normalized = normalize(event)
+        except (TypeError, ValueError):
+            return None
+        return hashlib.sha256((self.fingerprint + '\n' + normalized).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        :param key: Key from `key()`.
+        :return: (result, exec_clock, exec_rss) of the invocation memoized, or None if there is none.
+        """
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.cache.move_to_end(key)
+        elif self.db is not None:
+            row = self.db.execute('SELECT result, clock, rss FROM results WHERE key = ?', (key,)).fetchone()
+            if row:
+                entry = json.loads(row[0]), row[1], row[2]
+                self._keep(key, entry)
+        return entry
+
+    def put(self, key, result, exec_clock, exec_rss):
+        """
+        Memoize the result of a successful invocation. Results which do not survive a round trip through JSON (e.g.
+        with tuples, or keys which are not strings) are not memoized, as a hit would return something else.
+        :param key: Key from `key()`.
+        :param result: Result of the invocation.
+        :param exec_clock: Execution time in ms.
+        :param exec_rss: Execution RSS in bytes.
+        :return: Void.
+        """
+        try:
+            text = normalize(result)
+        except (TypeError, ValueError):
+            return
+        # Keep a copy, which the function cannot change later through a reference it kept.
+        copy = json.loads(text)
+        if copy != result:
+            return
+        self._keep(key, (copy, exec_clock, exec_rss))
+        if self.db is not None:
+            self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', (key, text, exec_clock, exec_rss))
+            self.pending += 1
+            self.flush() if self.pending >= BATCH else None
+
+    def sample(self):
+        """
+        :return: Whether to verify a hit.
+        """
+        return bool(self.verify) and self.rng.random() < self.verify
+
+    def flush(self):
+        """
+        Commit the results written to the store.
+        :return: Void.
+        """
+        if self.db is not None and self.pending:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+
+    def _keep(self, key, entry):
+        self.cache[key] = entry
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+
+def same(a, b):
+    """
+    :return: Whether two results are equal, as JSON.
+    """
+    try:
+        return normalize(a) == normalize(b)
+    except (TypeError, ValueError):
+        return a == b
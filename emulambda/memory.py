@@ -0,0 +1,93 @@
+"""
+Memory measurement backends. Each meter is created before the lambda is imported, and brackets every invocation with
+`start()` and `stop()`; `stop()` returns the peak memory of the invocation in bytes, relative to the process at
+creation time. `per_invocation` tells whether a meter measures each invocation separately, rather than the process.
+"""
+import os
+import sys
+
+import emulambda
+
+BACKENDS = ('rusage', 'proc', 'tracemalloc')
+
+
+def get_meter(backend):
+    """
+    Build a memory meter.
+    :param backend: One of BACKENDS.
+    :return: A meter object with `start()` and `stop()` methods.
+    """
+    if backend == 'rusage':
+        return RusageMeter()
+    elif backend == 'proc':
+        return ProcMeter()
+    elif backend == 'tracemalloc':
+        return TracemallocMeter()
+    raise ValueError("Unknown memory backend %s; choose one of %s." % (backend, ', '.join(BACKENDS)))
+
+
+class RusageMeter(object):
+    """
+    Process peak RSS from getrusage(). Nearly free, but a high-water mark: once an invocation has peaked, every later
+    invocation reports at least as much.
+    """
+    # ru_maxrss is in kilobytes on Linux, and in bytes on OS X. The Windows fallback reports bytes.
+    scale = 1 if sys.platform in ('darwin', 'win32') else 1024
+    per_invocation = False
+
+    def __init__(self):
+        self.baseline = emulambda.get_memory_usage() * self.scale
+
+    def start(self):
+        pass
+
+    def stop(self):
+        return emulambda.get_memory_usage() * self.scale - self.baseline
+
+
+class ProcMeter(object):
+    """
+    Peak RSS from VmHWM in /proc/self/status, which is reset to the current RSS before every invocation by writing to
+    /proc/self/clear_refs. Linux only; costs two small file operations per invocation.
+    """
+    per_invocation = True
+
+    def __init__(self):
+        if not os.access('/proc/self/clear_refs', os.W_OK):
+            raise ValueError("The proc memory backend needs a writable /proc/self/clear_refs (Linux 4.0+).")
+        self.baseline = self._read('VmRSS:')
+
+    def start(self):
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')  # reset the peak RSS to the current RSS
+
+    def stop(self):
+        return self._read('VmHWM:') - self.baseline
+
+    @staticmethod
+    def _read(field):
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+
+class TracemallocMeter(object):
+    """
+    Peak of the memory allocated by Python during the invocation, from tracemalloc. Counts Python allocations only,
+    and slows allocation-heavy functions down considerably.
+    """
+    per_invocation = True
+
+    def __init__(self):
+        import tracemalloc
+        self.tracemalloc = tracemalloc
+        tracemalloc.start()
+        self.baseline = tracemalloc.get_traced_memory()[0]
+
+    def start(self):
+        self.tracemalloc.reset_peak()
+
+    def stop(self):
+        return self.tracemalloc.get_traced_memory()[1] - self.baseline
@@ -0,0 +1,198 @@
+"""
+Machine-readable metrics. A sink writes a record per invocation (line number, duration, billed duration, peak memory,
+garbage collection time, error type and cold or warm start) to a file, in batches, and the summary of the run in the
+same format when it is closed, so that nothing has to scrape the human-readable output.
+"""
+import csv
+import os
+
+from emulambda import serializer
+from emulambda.render import billing_bucket
+from emulambda.stats import new_stats, record_stats, summarize_stats
+
+FORMATS = ('jsonl', 'csv', 'prometheus')
+FIELDS = ('index', 'duration_ms', 'billed_ms', 'peak_rss_bytes', 'gc_ms', 'error', 'cold', 'init_ms')
+# Records are written out in batches of this many.
+BATCH = 256
+# Statistics of a run, in summaries.
+SUMMARIZED = ('clock', 'rss', 'init', 'cold', 'warm', 'gc', 'forced_gc')
+
+
+def get_sink(path, kind=None):
+    """
+    Build a metrics sink.
+    :param path: File to write to.
+    :param kind: One of FORMATS, or None to go by the extension of `path` (.csv, .prom; anything else is jsonl).
+    :return: A sink with `record()` and `close()` methods.
+    """
+    if kind is None:
+        extension = os.path.splitext(path)[1]
+        kind = 'csv' if extension == '.csv' else 'prometheus' if extension == '.prom' else 'jsonl'
+    if kind == 'jsonl':
+        return JSONLSink(path)
+    elif kind == 'csv':
+        return CSVSink(path)
+    elif kind == 'prometheus':
+        return PrometheusSink(path)
+    raise ValueError("Unknown metrics format %s; choose one of %s." % (kind, ', '.join(FORMATS)))
+
+
+def error_type(result, exec_clock):
+    """
+    :param result: Result of an invocation.
+    :param exec_clock: Execution time, -1 for aborted invocations.
+    :return: Kind of error, e.g. 'timeout' for "EMULAMBDA: TIMEOUT ERROR", or None if the invocation succeeded.
+    """
+    if exec_clock >= 0:
+        return None
+    if isinstance(result, str) and result.startswith('EMULAMBDA: ') and result.endswith(' ERROR'):
+        return result[len('EMULAMBDA: '):-len(' ERROR')].lower().replace(' ', '_')
+    return 'unknown'
+
+
+class Sink(object):
+    """
+    Base of the file sinks. Records are kept until a batch is full, and then written out together.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'w')
+        self.pending = list()
+
+    def record(self, index, result, exec_clock, exec_rss, exec_init=None, exec_gc=None):
+        """
+        Record an invocation.
+        :param index: Line number of the event (1-based).
+        :param result: Result of the invocation.
+        :param exec_clock: Execution time in ms, -1 for aborted invocations.
+        :param exec_rss: Execution RSS in bytes.
+        :param exec_init: Cold start (import) time in ms, or None if the invocation was warm.
+        :param exec_gc: Time spent in automatic garbage collection in ms, or None if unknown.
+        :return: Void.
+        """
+        failed = exec_clock < 0
+        self.pending.append({'index': index,
+                             'duration_ms': None if failed else exec_clock,
+                             'billed_ms': None if failed else billing_bucket(exec_clock),
+                             'peak_rss_bytes': exec_rss,
+                             'gc_ms': exec_gc,
+                             'error': error_type(result, exec_clock),
+                             'cold': exec_init is not None,
+                             'init_ms': exec_init})
+        self.flush() if len(self.pending) >= BATCH else None
+
+    def flush(self):
+        """
+        Write out the pending records.
+        :return: Void.
+        """
+        self.write(self.pending) if self.pending else None
+        del self.pending[:]
+
+    def close(self, stats=None):
+        """
+        Write out the pending records and the summary of the run, and close the file.
+        :param stats: Dictionary from `new_stats()`, or None to leave out the summary.
+        :return: Void.
+        """
+        try:
+            self.flush()
+            self.summarize(summarize_stats(dict((key, stats[key]) for key in SUMMARIZED)), stats['errors']) \
+                if stats else None
+        finally:
+            self.file.close()
+
+
+class JSONLSink(Sink):
+    """
+    A JSON object per line: one of type "invocation" per invocation, then one of type "summary".
+    """
+    def write(self, records):
+        self.file.write(''.join(serializer.dumps(dict(record, type='invocation')) + '\n' for record in records))
+
+    def summarize(self, summary, errors):
+        self.file.write(serializer.dumps(dict(summary, type='summary', errors=errors)) + '\n')
+
+
+class CSVSink(Sink):
+    """
+    A row per invocation. The summary goes to a second CSV file beside it, with `.summary` before the extension, as
+    its columns differ.
+    """
+    def __init__(self, path):
+        super(CSVSink, self).__init__(path)
+        self.path = path
+        self.writer = csv.DictWriter(self.file, FIELDS, lineterminator='\n')
+        self.writer.writeheader()
+
+    def write(self, records):
+        self.writer.writerows(records)
+
+    def summarize(self, summary, errors):
+        stem, extension = os.path.splitext(self.path)
+        with open(stem + '.summary' + (extension or '.csv'), 'w') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            columns = ('count', 'mean', 'stddev', 'min', 'max', 'p50', 'p90', 'p99', 'p99.9')
+            writer.writerow(('metric',) + columns)
+            for key in SUMMARIZED:
+                writer.writerow((key,) + tuple(summary[key][column] for column in columns))
+            writer.writerow(('errors', errors) + ('',) * (len(columns) - 1))
+
+
+class PrometheusSink(Sink):
+    """
+    A Prometheus textfile (e.g. for the node exporter's textfile collector). Prometheus scrapes totals rather than
+    events, so invocations are folded into statistics, and the file is rewritten with them after every batch. It is
+    replaced atomically, so a scrape never sees half of it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.pending = list()
+        self.stats = new_stats()
+        self.errors = dict()
+        self.billed = 0
+        self.gc = 0.0
+
+    def record(self, index, result, exec_clock, exec_rss, exec_init=None, exec_gc=None):
+        record_stats(self.stats, exec_clock, exec_rss, exec_init)
+        self.billed += billing_bucket(exec_clock) if exec_clock >= 0 else 0
+        self.gc += exec_gc or 0
+        self.pending.append(error_type(result, exec_clock))
+        self.flush() if len(self.pending) >= BATCH else None
+
+    def write(self, records):
+        for error in records:
+            self.errors[error] = self.errors.get(error, 0) + 1
+        self._publish(self.stats, self.gc)
+
+    def close(self, stats=None):
+        self.flush()
+        # Prefer the statistics of the run, which also time collections made between invocations.
+        gc = stats['gc'] if stats else None
+        self._publish(stats or self.stats, gc.mean * gc.count if gc and gc.count else self.gc)
+
+    def _publish(self, stats, gc):
+        lines = list()
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP emulambda_%s %s' % (name, help))
+            lines.append('# TYPE emulambda_%s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                lines.append('emulambda_%s%s%s %r' % (name, suffix, labels, float(value or 0)))
+
+        metric('invocations_total', 'counter', 'Invocations, by error type ("none" for successes).',
+               [('', '{error="%s"}' % (error or 'none'), n) for error, n in sorted(self.errors.items(), key=str)])
+        metric('cold_starts_total', 'counter', 'Invocations which cold started a container.',
+               [('', '', stats['init'].count)])
+        metric('billed_ms_total', 'counter', 'Billed duration, by billing bucket.', [('', '', self.billed)])
+        metric('gc_ms_total', 'counter', 'Time spent in automatic garbage collection.', [('', '', gc)])
+        for name, key, help in (('duration_ms', 'clock', 'Execution time.'),
+                                ('peak_rss_bytes', 'rss', 'Peak memory of an invocation.'),
+                                ('init_ms', 'init', 'Cold start (import) time.')):
+            samples = stats[key]
+            metric(name, 'summary', help,
+                   [('', '{quantile="%s"}' % q, samples.percentile(q * 100)) for q in (0.5, 0.9, 0.99)] +
+                   [('_sum', '', samples.mean * samples.count), ('_count', '', samples.count)])
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(temporary, self.path)
@@ -0,0 +1,304 @@
+"""
+Opt-in CPU profiling of invocations. A profiler is started and stopped around every invocation of a run, aggregating
+across all of them. `cprofile` traces every call (exact, but heavy for call-intensive code) and writes pstats output;
+`sample` records the invoking thread's stack every few milliseconds and writes collapsed stacks, as read by
+flamegraph.pl and speedscope. Both report their own overhead, so that the numbers can be judged.
+"""
+import collections
+import cProfile
+import os
+import sys
+import threading
+import time
+
+KINDS = ('cprofile', 'sample')
+
+# Frames from this package are emulator overhead, not the lambda's.
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_profiler(kind, interval=0.005):
+    """
+    Build a profiler.
+    :param kind: One of KINDS.
+    :param interval: Seconds between samples, for the sampling profiler.
+    :return: A profiler.
+    """
+    if kind == 'cprofile':
+        return CProfiler()
+    elif kind == 'sample':
+        return SamplingProfiler(interval)
+    raise ValueError("Unknown profiler %s; choose one of %s." % (kind, ', '.join(KINDS)))
+
+
+def _calibrate(profiler, rounds=5):
+    """
+    Estimate the relative slowdown a profiler causes, by timing a call-heavy workload with and without it. Real
+    lambdas usually make fewer calls per unit of work, so this is an upper bound.
+    :return: Overhead as a fraction of unprofiled time.
+    """
+    def fib(n):
+        return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+    def best(wrapped):
+        times = list()
+        for _ in range(rounds):
+            s = time.perf_counter()
+            profiler.start() if wrapped else None
+            fib(18)
+            profiler.stop() if wrapped else None
+            times.append(time.perf_counter() - s)
+        return min(times)
+
+    bare = best(False)
+    return max(0.0, best(True) / bare - 1)
+
+
+def _emulator(key, callers):
+    """
+    :param key: (file, line, function) of a cProfile entry.
+    :param callers: Its callers, keyed the same way.
+    :return: Whether the entry is the emulator's own code, or a builtin only the emulator called (e.g. its clock).
+    """
+    if key[0] == '~':
+        return bool(callers) and all(caller[0].startswith(_PACKAGE_DIR) for caller in callers)
+    return key[0].startswith(_PACKAGE_DIR)
+
+
+def _label(code):
+    return '%s:%i(%s)' % (os.path.basename(code.co_filename), code.co_firstlineno, code.co_name)
+
+
+class _StatsData(object):
+    # pstats.Stats loads anything with create_stats() and a stats dictionary.
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class _Profiler(object):
+    """
+    Bookkeeping common to profilers: how many invocations were profiled, and for how long.
+    """
+    def __init__(self):
+        self._started = None
+        self.reset()
+
+    def start(self):
+        """
+        Start profiling an invocation, in the thread which runs it.
+        :return: Void.
+        """
+        self._started = time.perf_counter()
+        self._enable()
+
+    def stop(self):
+        """
+        Stop profiling the invocation.
+        :return: Void.
+        """
+        self._disable()
+        self.elapsed += time.perf_counter() - self._started
+        self.invocations += 1
+
+    def reset(self):
+        """
+        Discard everything profiled so far.
+        :return: Void.
+        """
+        self.invocations = 0
+        self.elapsed = 0.0
+
+
+class CProfiler(_Profiler):
+    """
+    Deterministic profiler, on cProfile.
+    """
+    kind = 'cprofile'
+
+    def __init__(self):
+        super(CProfiler, self).__init__()
+        # Tracing slows every call down, by a fixed cost the profile cannot show, so it is measured up front.
+        self.overhead = _calibrate(self)
+        self.reset()
+
+    def _enable(self):
+        self.profile.enable()
+
+    def _disable(self):
+        self.profile.disable()
+
+    def reset(self):
+        super(CProfiler, self).reset()
+        self.profile = cProfile.Profile()
+        self.absorbed = list()
+
+    def export(self):
+        """
+        :return: Picklable profile data, for `absorb()` in another process.
+        """
+        self.profile.create_stats()
+        return self.invocations, self.elapsed, self.profile.stats
+
+    def absorb(self, data):
+        """
+        Add profile data exported by another profiler of the same kind.
+        :return: Void.
+        """
+        self.invocations += data[0]
+        self.elapsed += data[1]
+        self.absorbed.append(data[2])
+
+    def stats(self):
+        """
+        :return: pstats.Stats of every invocation, or None if nothing was profiled.
+        """
+        import pstats  # slow to import, and only needed once a run is over
+        self.profile.create_stats()
+        sources = [s for s in [self.profile.stats] + self.absorbed if s]
+        if not sources:
+            return None
+        stats = pstats.Stats(_StatsData(sources[0]), stream=sys.stdout)
+        for s in sources[1:]:
+            stats.add(_StatsData(s))
+        return stats
+
+    def hot(self, n):
+        """
+        :param n: Number of functions.
+        :return: List of (label, self share, self seconds, cumulative seconds) for the n functions with the most time of
+                 their own, excluding the emulator's.
+        """
+        stats = self.stats()
+        if stats is None:
+            return list()
+        rows = [(key, value) for key, value in stats.stats.items() if not _emulator(key, value[4])]
+        total = sum(value[2] for key, value in rows) or 1
+        rows.sort(key=lambda row: row[1][2], reverse=True)
+        return [('%s:%i(%s)' % (os.path.basename(key[0]), key[1], key[2]), value[2] / total, value[2], value[3])
+                for key, value in rows[:n]]
+
+    def write(self, path):
+        """
+        Write pstats output, e.g. for snakeviz, or gprof2dot to make a call graph.
+        :return: Void.
+        """
+        stats = self.stats()
+        stats.dump_stats(path) if stats is not None else None
+
+
+class SamplingProfiler(_Profiler):
+    """
+    Statistical profiler. A daemon thread samples the stack of the thread running the invocation, down to the
+    invocation itself, at a fixed interval of wall-clock time, so time spent waiting shows up as well as CPU time.
+    """
+    kind = 'sample'
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.target = None
+        self.active = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name='emulambda-sampler')
+        self.thread.daemon = True
+        self.thread.start()
+        super(SamplingProfiler, self).__init__()
+
+    def _enable(self):
+        self.target = threading.current_thread().ident
+        # A busy thread only yields the interpreter every switch interval, which would hold samples of it back.
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(self.switch_interval, self.interval / 10))
+        self.active.set()
+
+    def _disable(self):
+        self.active.clear()
+        sys.setswitchinterval(self.switch_interval)
+
+    def reset(self):
+        super(SamplingProfiler, self).reset()
+        with self.lock:
+            self.stacks = collections.Counter()
+            self.samples = 0
+            self.sampler_time = 0.0
+
+    @property
+    def overhead(self):
+        """
+        :return: Time the sampler held the interpreter for, as a fraction of the time profiled.
+        """
+        return self.sampler_time / self.elapsed if self.elapsed else 0.0
+
+    def export(self):
+        """
+        :return: Picklable profile data, for `absorb()` in another process.
+        """
+        with self.lock:
+            return self.invocations, self.elapsed, self.samples, self.sampler_time, dict(self.stacks)
+
+    def absorb(self, data):
+        """
+        Add profile data exported by another profiler of the same kind.
+        :return: Void.
+        """
+        with self.lock:
+            self.invocations += data[0]
+            self.elapsed += data[1]
+            self.samples += data[2]
+            self.sampler_time += data[3]
+            self.stacks.update(data[4])
+
+    def hot(self, n):
+        """
+        :param n: Number of functions.
+        :return: List of (label, self share, self seconds, cumulative seconds) for the n functions found most often at
+                 the top of the stack. Seconds are estimated from shares of the time profiled.
+        """
+        own = collections.Counter()
+        cumulative = collections.Counter()
+        with self.lock:
+            for stack, count in self.stacks.items():
+                frames = stack.split(';')
+                own[frames[-1]] += count
+                for frame in set(frames):
+                    cumulative[frame] += count
+            total = float(self.samples) or 1
+            elapsed = self.elapsed
+        return [(label, count / total, count / total * elapsed, cumulative[label] / total * elapsed)
+                for label, count in own.most_common(n)]
+
+    def write(self, path):
+        """
+        Write collapsed stacks, one `frame;frame;frame count` line per distinct stack, for flame graphs.
+        :return: Void.
+        """
+        with self.lock, open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %i\n' % (stack, count))
+
+    def _run(self):
+        due = None
+        while True:
+            if not self.active.is_set():
+                self.active.wait()
+                due = time.perf_counter()
+            # Sample on a fixed schedule, so that time spent waiting for the interpreter counts towards the interval.
+            due += self.interval
+            delay = due - time.perf_counter()
+            time.sleep(delay) if delay > 0 else None
+            if not self.active.is_set():
+                continue
+            s = time.perf_counter()
+            frame = sys._current_frames().get(self.target)
+            stack = list()
+            while frame is not None and frame.f_code.co_name != '_invoke_lambda':
+                stack.append(_label(frame.f_code))
+                frame = frame.f_back
+            with self.lock:
+                if stack and frame is not None:
+                    self.stacks[';'.join(reversed(stack))] += 1
+                    self.samples += 1
+                self.sampler_time += time.perf_counter() - s
+            due = max(due, s)
@@ -0,0 +1,310 @@
+"""
+Hot reload, for watch mode. The modules of a function (those it imports, directly or not, from outside the standard
+library and installed packages) are watched for changes, with inotify on Linux or else by polling their modification
+times. When one changes, it is reloaded along with the modules importing it, in dependency order, while every other
+module (heavy dependencies included) stays loaded, and the function is resolved again.
+"""
+from __future__ import print_function
+import ast
+import ctypes
+import importlib
+import os
+import select
+import struct
+import sys
+import sysconfig
+import time
+
+import emulambda
+
+# inotify events of a file being written, or replaced by a rename, as editors save.
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_NONBLOCK = os.O_NONBLOCK
+_EVENT = struct.Struct('iIII')
+# Seconds to wait for more changes after the first, as one save can write several files.
+SETTLE = 0.05
+
+# Modules in these directories are never reloaded.
+_INSTALLED = tuple(set(os.path.realpath(path) + os.sep for key, path in sysconfig.get_paths().items()
+                       if key in ('stdlib', 'platstdlib', 'purelib', 'platlib')))
+
+
+def get_watcher(interval=0.5):
+    """
+    Build a file watcher: inotify where the C library has it, or else polling.
+    :param interval: Seconds between polls, for the polling watcher.
+    :return: A watcher with `watch()`, `wait()` and `close()` methods.
+    """
+    try:
+        return InotifyWatcher()
+    except (AttributeError, OSError):
+        return PollingWatcher(interval)
+
+
+class InotifyWatcher(object):
+    """
+    Watches the directories of files through inotify, which also sees files replaced by a rename.
+    """
+    kind = 'inotify'
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = dict()
+        self.paths = set()
+
+    def watch(self, paths):
+        """
+        :param paths: Files to watch, replacing any watched before.
+        :return: Void.
+        """
+        self.paths = set(paths)
+        for directory in set(os.path.dirname(path) for path in self.paths):
+            wd = self.libc.inotify_add_watch(self.fd, directory.encode(sys.getfilesystemencoding()),
+                                             IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+            self.directories[wd] = directory if wd >= 0 else None
+
+    def wait(self, timeout=None):
+        """
+        Wait for watched files to change.
+        :param timeout: Seconds to wait, or None to wait until one does.
+        :return: Set of the paths which changed; empty if none did before the timeout.
+        """
+        changed = set()
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            if not select.select([self.fd], [], [], SETTLE if changed else remaining)[0]:
+                return changed
+            changed.update(self._read())
+
+    def _read(self):
+        """
+        :return: The watched paths named by the pending inotify events.
+        """
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError:
+            return set()
+        paths, offset = set(), 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+            offset += _EVENT.size + length
+            directory = self.directories.get(wd)
+            path = os.path.join(directory, name.decode(sys.getfilesystemencoding())) if directory else None
+            paths.add(path) if path in self.paths else None
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """
+    Polls the modification times of files.
+    """
+    kind = 'polling'
+
+    def __init__(self, interval=0.5):
+        """
+        :param interval: Seconds between polls.
+        """
+        self.interval = interval
+        self.mtimes = dict()
+
+    def watch(self, paths):
+        self.mtimes = dict((path, _mtime(path)) for path in paths)
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            changed = set(path for path, mtime in self.mtimes.items() if _mtime(path) != mtime)
+            if changed:
+                time.sleep(SETTLE)
+                changed = set(path for path, mtime in self.mtimes.items() if _mtime(path) != mtime)
+                self.mtimes.update((path, _mtime(path)) for path in changed)
+                return changed
+            if deadline is not None and time.time() >= deadline:
+                return changed
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+def _mtime(path):
+    """
+    :return: Modification time of a file, or None if it is gone.
+    """
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _source(module):
+    """
+    :return: Source file of a module which may be reloaded, or None for built-in, compiled and installed modules.
+    """
+    path = getattr(module, '__file__', None)
+    if not path or not path.endswith('.py'):
+        return None
+    path = os.path.realpath(path)
+    return None if path.startswith(_INSTALLED) else path
+
+
+def _imports(name, path):
+    """
+    Find the modules a module's source imports, and the packages they are in.
+    :param name: Name of the module.
+    :param path: Its source file.
+    :return: Set of module names.
+    """
+    package = name if os.path.basename(path) == '__init__.py' else name.rpartition('.')[0]
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), path)
+    found = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            found.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            base = node.module or ''
+            if node.level:
+                parts = package.split('.') if package else []
+                parts = parts[:len(parts) - node.level + 1]
+                base = '.'.join(parts + ([node.module] if node.module else []))
+            found.add(base)
+            found.update('%s.%s' % (base, alias.name) if base else alias.name for alias in node.names)
+    # Importing a.b.c imports a and a.b too.
+    return set('.'.join(imported.split('.')[:i + 1]) for imported in found for i in range(imported.count('.') + 1))
+
+
+class ModuleGraph(object):
+    """
+    The modules a module imports, directly or not, which may be reloaded, and what each of them imports.
+    """
+    def __init__(self, root):
+        """
+        :param root: Name of the module at the top.
+        """
+        self.root = root
+        self.files = dict()
+        self.imports = dict()
+        self.scan()
+
+    def scan(self):
+        """
+        Find the modules again, e.g. after a reload which may have changed the imports.
+        :return: Void.
+        """
+        self.files, self.imports = dict(), dict()
+        pending = [self.root]
+        while pending:
+            name = pending.pop()
+            path = _source(sys.modules.get(name)) if name not in self.files else None
+            if path is None:
+                continue
+            self.files[name] = path
+            try:
+                self.imports[name] = _imports(name, path)
+            except (IOError, SyntaxError, ValueError):
+                self.imports[name] = set()
+            pending.extend(self.imports[name])
+        for name in self.imports:
+            self.imports[name] = set(imported for imported in self.imports[name] if imported in self.files and
+                                     imported != name)
+
+    def affected(self, changed):
+        """
+        :param changed: Names of modules which changed.
+        :return: List of those modules and every module importing them, directly or not, each after the modules it
+                 imports.
+        """
+        dependents = dict()
+        for name, imported in self.imports.items():
+            for dependency in imported:
+                dependents.setdefault(dependency, set()).add(name)
+        affected, pending = set(), list(changed)
+        while pending:
+            name = pending.pop()
+            if name not in affected:
+                affected.add(name)
+                pending.extend(dependents.get(name, ()))
+        order, visiting = list(), set()
+
+        def visit(name):
+            if name in order or name in visiting:
+                return
+            visiting.add(name)
+            for dependency in sorted(self.imports.get(name, set()) & affected):
+                visit(dependency)
+            order.append(name)
+
+        for name in sorted(affected):
+            visit(name)
+        return order
+
+
+class Reloader(object):
+    """
+    Watches the modules of a function, and reloads those which change.
+    """
+    def __init__(self, lambdapath, watcher):
+        """
+        :param lambdapath: Path given for the lambda, which must have been imported.
+        :param watcher: A watcher from `get_watcher()`.
+        """
+        self.lambdapath = lambdapath
+        self.watcher = watcher
+        self.graph = ModuleGraph(emulambda.lambda_module(lambdapath))
+        watcher.watch(self.graph.files.values())
+
+    def wait(self, timeout=None):
+        """
+        Wait for modules of the function to change.
+        :param timeout: Seconds to wait, or None to wait until one does.
+        :return: List of the names of the modules which changed.
+        """
+        changed = self.watcher.wait(timeout)
+        return sorted(name for name, path in self.graph.files.items() if path in changed)
+
+    def reload(self, changed):
+        """
+        Reload changed modules and the modules importing them, and resolve the function again. If a module fails to
+        reload, e.g. with a syntax error, the exception is raised, and the modules stay watched to try again.
+        :param changed: Names of the modules which changed.
+        :return: The function, the names of the modules reloaded, in order, and the seconds taken.
+        """
+        s = time.time()
+        order = self.graph.affected(changed)
+        importlib.invalidate_caches()
+        try:
+            for name in order:
+                _reload(sys.modules[name])
+            emulambda.forget_lambda(self.lambdapath)
+            func = emulambda.import_lambda(self.lambdapath)
+        finally:
+            self.graph.scan()
+            self.watcher.watch(self.graph.files.values())
+        return func, order, time.time() - s
+
+    def close(self):
+        self.watcher.close()
+
+
+def _reload(module):
+    """
+    Run a module's source again, in the same module object. Like `importlib.reload()`, but from the file it was loaded
+    from, rather than wherever the module's name is found now, so that modules of `path/file.function` lambda paths,
+    imported from outside sys.path, reload too.
+    """
+    spec = module.__spec__
+    if spec is None or not hasattr(spec.loader, 'exec_module'):
+        importlib.reload(module)
+    else:
+        spec.loader.exec_module(module)
@@ -1,11 +1,34 @@
 from __future__ import print_function
 import math
-import numpy
+import sys
+import threading
 
-from hurry.filesize import size
+from emulambda import serializer
+from emulambda.stats import merge_stats
 
 __author__ = 'dominiczippilli'
 
+# Results are written to stdout in batches of this many lines, unless verbose.
+RESULT_BATCH = 256
+
+_results = list()
+_results_lock = threading.Lock()
+
+# Byte units, as in hurry.filesize's traditional system.
+_UNITS = ((1024 ** 5, 'P'), (1024 ** 4, 'T'), (1024 ** 3, 'G'), (1024 ** 2, 'M'), (1024, 'K'), (1, 'B'))
+
+
+def size(n):
+    """
+    Format a number of bytes, rounding down to the largest whole unit, as hurry.filesize does.
+    :param n: Bytes.
+    :return: String, e.g. '12M' for 12.5MB.
+    """
+    for factor, suffix in _UNITS:
+        if n >= factor:
+            break
+    return str(int(n / factor)) + suffix
+
 
 def billing_bucket(t):
     """
@@ -16,48 +39,328 @@ def billing_bucket(t):
     return int(math.ceil(t / 100.0)) * 100
 
 
-def render_result(verbose, lambdapath, result, exec_clock, exec_rss):
+def render_result(verbose, lambdapath, result, exec_clock, exec_rss, exec_init=None, memoized=False):
     """
     Render the result of a lambda execution, with profiling info if verbose.
     :param lambdapath: Path given for the lambda.
     :param result: Result of the execution.
     :param exec_clock: Execution clock time.
     :param exec_rss: Execution RSS.
+    :param exec_init: Cold start (import) time, if this execution was the first in its container.
+    :param memoized: Whether the result was memoized rather than executed, its timing being that of the execution
+                     memoized.
     :return: Void.
     """
     if verbose:
-        print('Executed %s' % lambdapath)
+        flush_results()
+        print('Memoized %s (not executed; as of the execution memoized)' % lambdapath if memoized else
+              'Executed %s' % lambdapath)
         print('Estimated...')
+        if exec_init is not None:
+            print('...cold start init time:\t\t %ims' % exec_init)
         print('...execution clock time:\t\t %ims (%ims billing bucket)' % (exec_clock, billing_bucket(exec_clock)))
         print('...execution peak RSS memory:\t\t %s (%i bytes)' % (size(exec_rss), exec_rss))
         print('----------------------RESULT----------------------')
-    print(str(result))
+        print(serializer.dumps(result))
+    else:
+        with _results_lock:
+            _results.append(serializer.dumps(result))
+            full = len(_results) >= RESULT_BATCH
+        flush_results() if full else None
 
 
-def render_summary(stats):
+def flush_results():
+    """
+    Write out the results which are waiting for a full batch.
+    :return: Void.
+    """
+    with _results_lock:
+        if _results:
+            sys.stdout.write('\n'.join(_results) + '\n')
+            sys.stdout.flush()
+            del _results[:]
+
+
+def render_summary(stats, profiler=None, top=10):
     """
     Render summary of an event stream run.
-    :param stats: Dictionary('clock':list()<float>, 'rss':list()<int>)
+    :param stats: Dictionary from `new_stats()`, or a list of them (one per worker).
+    :param profiler: Profiler of the run, to show its hot functions.
+    :param top: Number of hot functions to show.
     :return: Void.
     """
     print('\nSummary profile from stream execution:')
-    print('Samples: %i' % len(stats['clock']))
-    if -1 in stats['clock']:
-        print('(ERRORS DETECTED: Removing timing samples from aborted invocations.)')
-        stats['clock'] = [x for x in stats['clock'] if x > 0]
-        print('New sample size: %i' % len(stats['clock']))
-    median = sorted(stats['clock'])[math.trunc(len(stats['clock']) / 2)]
-    print(stats['clock'])
-    print('Clock time:\n'
-          '\tMin: %ims, Max: %ims, Median: %ims, Median Billing Bucket: %ims, Rounded Standard Deviation: %sms' % (
-              min(stats['clock']),
-              max(stats['clock']),
-              median,
-              billing_bucket(median),
-              math.trunc(math.ceil(numpy.std(stats['clock'], ddof=1)))
-          )) if len(stats['clock']) > 0 else print("No valid timing samples!")
+    if isinstance(stats, list):
+        print('Workers: %i' % len(stats))
+        stats = merge_stats(stats)
+    clock = stats['clock']
+    print('Samples: %i' % (clock.count + stats['errors']))
+    if stats['errors']:
+        print('(ERRORS DETECTED: Removing timing samples from %i aborted invocations.)' % stats['errors'])
+        print('New sample size: %i' % clock.count)
+    if clock.samples is not None:
+        print(clock.samples)
+    if clock.count > 0:
+        median = clock.percentile(50)
+        print('Clock time:\n'
+              '\tMin: %ims, Max: %ims, Mean: %ims, Median: %ims, Median Billing Bucket: %ims, '
+              'Rounded Standard Deviation: %sms\n'
+              '\tp90: %ims, p99: %ims, p99.9: %ims' % (
+                  clock.min,
+                  clock.max,
+                  clock.mean,
+                  median,
+                  billing_bucket(median),
+                  math.trunc(math.ceil(clock.stddev())),
+                  clock.percentile(90),
+                  clock.percentile(99),
+                  clock.percentile(99.9)
+              ))
+    else:
+        print("No valid timing samples!")
+    rss = stats['rss']
     print('Peak resident set size (memory):\n'
-          '\tMin: %s, Max: %s' % (
-              size(min(stats['rss'])),
-              size(max(stats['rss']))
-          ))
\ No newline at end of file
+          '\tMin: %s, Max: %s, Median: %s, p99: %s' % (
+              size(rss.min),
+              size(rss.max),
+              size(rss.percentile(50)),
+              size(rss.percentile(99))
+          )) if rss.count > 0 else None
+    print('Cold starts: %i' % stats['init'].count)
+    for label, key in (('Init duration', 'init'),
+                       ('Cold invocation (init + execution)', 'cold'),
+                       ('Warm invocation', 'warm')):
+        print('%s:\n\t%s' % (label, _distribution(stats[key]))) if stats[key].count > 0 else None
+    render_gc(stats)
+    render_logs(stats)
+    render_memo(stats)
+    render_profile(profiler, top) if profiler else None
+
+
+def render_gc(stats):
+    """
+    Render the time spent collecting garbage, automatically (e.g. within the function) and forced by the policy.
+    :param stats: Dictionary from `new_stats()`.
+    :return: Void.
+    """
+    automatic, forced = stats['gc'], stats['forced_gc']
+    if not automatic.count and not forced.count:
+        return
+    print('Garbage collection:')
+    if automatic.count:
+        clock = stats['clock']
+        total = automatic.mean * automatic.count
+        share = total / (clock.mean * clock.count) if clock.count and clock.mean else 0
+        print('\tAutomatic: %i collections, %.1fms total (%.1f%% of execution clock time), '
+              'Median: %.2fms, p99: %.2fms, Max: %.2fms' % (
+                  automatic.count, total, share * 100, automatic.percentile(50), automatic.percentile(99),
+                  automatic.max))
+    if forced.count:
+        print('\tForced by policy: %i collections, %.1fms total, Median: %.2fms, Max: %.2fms' % (
+            forced.count, forced.mean * forced.count, forced.percentile(50), forced.max))
+
+
+def render_memo(stats):
+    """
+    Render the results served from memoization, which are left out of every other statistic, and their verification.
+    :param stats: Dictionary from `new_stats()`.
+    :return: Void.
+    """
+    hits, saved = stats['memo_hit'], stats['memo_saved']
+    if not hits.count and not stats['memo_verified']:
+        return
+    print('Memoization:')
+    if hits.count:
+        print('\tHits: %i, Lookup Median: %.3fms, p99: %.3fms, Execution clock time saved: %.1fms' % (
+            hits.count, hits.percentile(50), hits.percentile(99), saved.mean * saved.count))
+    if stats['memo_verified']:
+        print('\tVerified: %i hits re-executed, %i with a different result%s' % (
+            stats['memo_verified'], stats['memo_mismatches'],
+            ' (NONDETERMINISM DETECTED)' if stats['memo_mismatches'] else ''))
+
+
+def render_logs(stats):
+    """
+    Render the volume of captured logs, and the time taken to write them.
+    :param stats: Dictionary from `new_stats()`.
+    :return: Void.
+    """
+    logged, lines, write = stats['log_bytes'], stats['log_lines'], stats['log_write']
+    if not logged.count:
+        return
+    print('Logs:\n'
+          '\tTotal: %s in %i lines, Per invocation: Mean: %s, p99: %s, Max: %s\n'
+          '\tWritten in %i batches, %.1fms total' % (
+              size(int(logged.mean * logged.count)), lines.mean * lines.count, size(int(logged.mean)),
+              size(int(logged.percentile(99))), size(int(logged.max)), write.count, write.mean * write.count))
+
+
+def render_profile(profiler, top=10):
+    """
+    Render the hot functions of a profiled run, and what profiling cost.
+    :param profiler: A profiler from `get_profiler()`.
+    :param top: Number of functions to show.
+    :return: Void.
+    """
+    if profiler.kind == 'cprofile':
+        print('CPU profile (cprofile, %i invocations; tracing overhead up to +%i%% on call-heavy code):' % (
+            profiler.invocations, profiler.overhead * 100))
+    else:
+        print('CPU profile (sample, %i invocations, %i samples every %gms; sampler overhead %.1f%%):' % (
+            profiler.invocations, profiler.samples, profiler.interval * 1000, profiler.overhead * 100))
+    hot = profiler.hot(top)
+    if not hot:
+        print('\tNo samples!')
+    for label, share, own, cumulative in hot:
+        print('\t%5.1f%%  self %ims  total %ims  %s' % (share * 100, own * 1000, cumulative * 1000, label))
+
+
+def render_imports(imports, lambdapath, top=10):
+    """
+    Render the import tree of a lambda, and its slowest imports.
+    :param imports: ImportRecorder of the lambda's import.
+    :param lambdapath: Path given for the lambda.
+    :param top: Number of modules to rank.
+    :return: Void.
+    """
+    modules = imports.modules()
+    print('Imported %s in %ims, loading %i modules.' % (lambdapath, imports.total * 1000, len(modules)))
+    if not modules:
+        return
+    print('Slowest imports (own time, excluding the modules they imported):')
+    for node in imports.slowest(top):
+        print('\t%6.1fms  %s' % (node.own * 1000, node.name))
+    # Leave out the long tail of the tree, which is mostly small standard library modules.
+    threshold = imports.total / 100
+    print('Import tree (cumulative time, own time; modules taking over 1% of the total):')
+    for depth, node in imports.root.walk():
+        if node is not imports.root and node.cumulative >= threshold:
+            print('\t%6.1fms %6.1fms  %s%s' % (node.cumulative * 1000, node.own * 1000, '  ' * (depth - 1), node.name))
+
+
+def render_reload(changed, reloaded, elapsed):
+    """
+    Render a reload of the lambda in watch mode.
+    :param changed: Names of the modules which changed.
+    :param reloaded: Names of the modules reloaded: those, and the modules importing them.
+    :param elapsed: Seconds taken to reload them and resolve the lambda again.
+    :return: Void.
+    """
+    print('Reloaded %i modules in %.1fms: %s (changed: %s).' % (len(reloaded), elapsed * 1000, ', '.join(reloaded),
+                                                                ', '.join(changed)))
+
+
+def render_startup(startup, lambdapath):
+    """
+    Render the time emulambda took to start, phase by phase, against the time the lambda took to import.
+    :param startup: StartupTimer, with the lambda's import as its last phase.
+    :param lambdapath: Path given for the lambda.
+    :return: Void.
+    """
+    total = startup.total
+    print('Startup of %s (share of the time to the first invocation):' % lambdapath)
+    for label, seconds, modules, _ in startup.phases:
+        print('\t%7.1fms %5.1f%%  %s (%i modules loaded)' % (seconds * 1000, seconds / total * 100 if total else 0,
+                                                          label, modules))
+    handler = startup.handler
+    print('\tEmulator: %.1fms, Function import: %.1fms, Total: %.1fms' % ((total - handler) * 1000, handler * 1000,
+                                                                            total * 1000))
+
+
+def render_routes(router):
+    """
+    Render the statistics of each function of a manifest.
+    :param router: Router of the run.
+    :return: Void.
+    """
+    width = max([len('Function')] + [len(route.name) for route in router])
+    print('\nFunctions (routed by the "%s" field of each event):' % router.field)
+    print('%-*s %8s %7s %9s %9s %9s %7s %6s %9s %8s' % (width, 'Function', 'Invokes', 'Errors', 'Median', 'p99',
+                                                        'Peak RSS', 'Memory', 'Over', 'Init', 'Modules'))
+    for route in router:
+        clock, rss, init = route.stats['clock'], route.stats['rss'], route.stats['init']
+        print('%-*s %8i %7i %9s %9s %9s %7s %6i %9s %8i' % (
+            width, route.name, clock.count + route.stats['errors'], route.stats['errors'],
+            '%ims' % clock.percentile(50) if clock.count else '-', '%ims' % clock.percentile(99) if clock.count else '-',
+            size(rss.max) if rss.count else '-', '%iMB' % route.memory_size if route.memory_size else '-',
+            route.over_memory, '%.1fms' % init.max if init.count else '-', route.modules))
+    print('Events naming no function: %i' % router.unrouted) if router.unrouted else None
+
+
+def render_load(report, concurrency, throttle):
+    """
+    Render the latency and throughput of a run under load, from `emit_load()`.
+    :param report: Dictionary of 'latency' and 'queue' OnlineStats, 'offered', 'completed', 'throttled', 'elapsed' and
+                   'peak'.
+    :param concurrency: Concurrency cap.
+    :param throttle: What happened to events over the cap: 'queue' or 'reject'.
+    :return: Void.
+    """
+    elapsed = report['elapsed']
+    print('\nLoad (concurrency cap %i, %s over it):' % (concurrency, 'queueing' if throttle == 'queue' else 'throttling'))
+    print('\tOffered: %i (%.1f/s), Completed: %i (%.1f/s), Throttled: %i' % (
+        report['offered'], report['offered'] / elapsed if elapsed else 0, report['completed'],
+        report['completed'] / elapsed if elapsed else 0, report['throttled']))
+    for label, key in (('Latency (queue and execution)', 'latency'), ('Queueing delay', 'queue')):
+        samples = report[key]
+        print('\t%s: Median: %.1fms, p90: %.1fms, p99: %.1fms, Max: %.1fms' % (
+            label, samples.percentile(50), samples.percentile(90), samples.percentile(99), samples.max)) \
+            if samples.count else None
+    print('\tPeak concurrency (containers provisioned): %i' % report['peak'])
+
+
+def render_batches(report, source, batch_size, memory_size):
+    """
+    Render the throughput and cost of delivering a stream in batches, from `emit_batches()`.
+    :param report: Dictionary of 'records', 'batches', 'failures', 'dropped', 'elapsed' and 'cost'.
+    :param source: Event source emulated.
+    :param batch_size: Largest batch size.
+    :param memory_size: Memory size in MB the cost is for.
+    :return: Void.
+    """
+    records, batches = report['records'], report['batches']
+    print('\nEvent source (%s, batches of up to %i):' % (source, batch_size))
+    print('\tRecords: %i in %i batches (mean batch size %.1f), %.1f records/s' % (
+        records, batches, float(records + report['failures']) / batches if batches else 0,
+        records / report['elapsed'] if report['elapsed'] else 0))
+    print('\tFailed deliveries: %i, Dropped after the last attempt: %i' % (report['failures'], report['dropped']))
+    print('\tCost at %iMB: $%.4f per 1M records, $%.4f per 1M invocations' % (
+        memory_size, report['cost'] / records * 1000000 if records else 0,
+        report['cost'] / batches * 1000000 if batches else 0))
+
+
+def render_sweep(rows):
+    """
+    Render the cost and latency of a stream at each memory size, from `sweep()`.
+    :param rows: List of dictionaries of 'memory_size', 'share', 'stats', 'ooms' and 'cost', per size.
+    :return: Void.
+    """
+    print('\nMemory size sweep:')
+    print('%8s %6s %9s %9s %9s %9s %8s %6s %15s' % ('Memory', 'vCPU', 'Median', 'p99', 'Billed', 'Peak RSS', 'Errors',
+                                                    'OOMs', 'Cost/1M invokes'))
+    cheapest = None
+    for row in rows:
+        clock = row['stats']['clock']
+        invokes = clock.count + row['stats']['errors']
+        per_million = row['cost'] / invokes * 1000000 if invokes else 0
+        if clock.count:
+            print('%6iMB %6.3f %7ims %7ims %7ims %9s %8i %6i %15s' % (
+                row['memory_size'], row['share'], clock.percentile(50), clock.percentile(99),
+                billing_bucket(clock.percentile(50)), size(row['stats']['rss'].max), row['stats']['errors'],
+                row['ooms'], '$%.4f' % per_million))
+        else:
+            print('%6iMB %6.3f %9s %9s %9s %9s %8i %6i %15s' % (
+                row['memory_size'], row['share'], '-', '-', '-', '-', row['stats']['errors'], row['ooms'], '-'))
+        if invokes and not row['stats']['errors'] and (cheapest is None or per_million < cheapest[1]):
+            cheapest = row['memory_size'], per_million
+    print('Cheapest size without errors: %iMB' % cheapest[0] if cheapest else 'Every size had errors.')
+
+
+def _distribution(samples):
+    """
+    Format the spread of clock samples.
+    :param samples: OnlineStats of times in ms.
+    :return: String.
+    """
+    return 'Samples: %i, Min: %ims, Max: %ims, Median: %ims, p99: %ims' % (
+        samples.count, samples.min, samples.max, samples.percentile(50), samples.percentile(99))
@@ -0,0 +1,63 @@
+"""
+JSON serialization of events and results. Uses orjson or ujson when installed, as they parse and format much faster
+than the standard library, and falls back to the `json` module otherwise.
+"""
+import json
+
+BACKENDS = ('auto', 'orjson', 'ujson', 'json')
+
+backend = None
+_loads = None
+_dumps = None
+
+
+def select(name='auto'):
+    """
+    Choose the JSON library.
+    :param name: One of BACKENDS. `auto` picks the fastest one installed.
+    :return: Name of the library in use.
+    """
+    global backend, _loads, _dumps
+    for candidate in (('orjson', 'ujson', 'json') if name == 'auto' else (name,)):
+        try:
+            if candidate == 'orjson':
+                import orjson
+                _loads, _dumps = orjson.loads, lambda o: orjson.dumps(o).decode('utf-8')
+            elif candidate == 'ujson':
+                import ujson
+                # ujson alone escapes slashes by default; output should not depend on the library installed.
+                _loads, _dumps = ujson.loads, \
+                    lambda o: ujson.dumps(o, ensure_ascii=False, escape_forward_slashes=False)
+            else:
+                _loads, _dumps = json.loads, lambda o: json.dumps(o, ensure_ascii=False)
+        except ImportError:
+            continue
+        backend = candidate
+        return backend
+    raise ValueError("JSON backend %s is not installed." % name)
+
+
+def loads(s):
+    """
+    Deserialize a JSON document.
+    :param s: JSON string.
+    :return: Object.
+    :raise ValueError: If the string is not valid JSON.
+    """
+    return _loads(s)
+
+
+def dumps(o):
+    """
+    Serialize an object to a single line of JSON. Objects which the library cannot serialize (e.g. sets, or integers
+    too large for orjson) go through the `json` module, with anything unknown written as its repr.
+    :param o: Object.
+    :return: JSON string.
+    """
+    try:
+        return _dumps(o)
+    except (TypeError, ValueError, OverflowError):
+        return json.dumps(o, ensure_ascii=False, default=repr)
+
+
+select()
@@ -0,0 +1,163 @@
+"""
+Long-running server mode, compatible with the AWS Lambda `Invoke` API, so that boto3 clients (with `endpoint_url`
+pointed at us) can invoke functions which stay loaded between requests.
+"""
+from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor
+import re
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from emulambda import serializer
+from emulambda.render import render_result
+from emulambda.stats import new_stats, record_stats, summarize_stats
+
+INVOKE_PATH = re.compile(r'^/2015-03-31/functions/([^/]+)/invocations$')
+
+
+class Function(object):
+    """
+    A function being served, with its own statistics.
+    """
+    def __init__(self, name, run, dump_samples=False):
+        """
+        :param name: Function name, as given in the Invoke path.
+        :param run: A function taking (event, context) and returning (result, exec_clock, exec_rss, exec_init).
+        :param dump_samples: Keep raw samples in the statistics.
+        """
+        self.name = name
+        self.run = run
+        self.stats = new_stats(dump_samples)
+        self.lock = threading.Lock()
+
+    def invoke(self, event, context):
+        result, exec_clock, exec_rss, exec_init = self.run(event, context)
+        with self.lock:
+            record_stats(self.stats, exec_clock, exec_rss, exec_init)
+        return result, exec_clock, exec_rss, exec_init
+
+
+class InvokeServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server with a thread per connection, and at most `concurrency` invocations running at once. Further
+    invocations wait for a slot. Asynchronous (`Event`) invocations are queued to a pool of `concurrency` threads,
+    as Lambda queues them, so that a burst of them cannot start a thread each.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, functions, concurrency, verbose=False):
+        """
+        :param address: (host, port) to listen on.
+        :param functions: Dictionary of function name to Function. A single function is served under any name.
+        :param concurrency: Maximum number of concurrent invocations.
+        :param verbose: Render every invocation.
+        """
+        HTTPServer.__init__(self, address, InvokeRequestHandler)
+        self.functions = functions
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.events = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='emulambda-event')
+        self.verbose = verbose
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.events.shutdown(wait=True, cancel_futures=True)
+
+    def lookup(self, name):
+        """
+        :param name: Function name from the Invoke path.
+        :return: Function, or None if there is no such function.
+        """
+        if name in self.functions:
+            return self.functions[name]
+        elif len(self.functions) == 1:
+            return list(self.functions.values())[0]
+        return None
+
+
+class InvokeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        match = INVOKE_PATH.match(self.path.split('?')[0])
+        if not match:
+            return self._send_error(404, 'UnknownOperationException', 'Unknown operation %s' % self.path)
+        function = self.server.lookup(match.group(1))
+        if function is None:
+            return self._send_error(404, 'ResourceNotFoundException', 'Function not found: %s' % match.group(1))
+        try:
+            event = serializer.loads(body) if body.strip() else {}
+        except ValueError as e:
+            return self._send_error(400, 'InvalidRequestContentException', 'Could not parse request body into json: '
+                                                                           '%s' % e)
+
+        invocation_type = self.headers.get('X-Amz-Invocation-Type', 'RequestResponse')
+        if invocation_type == 'DryRun':
+            return self._send(204, b'')
+        elif invocation_type == 'Event':
+            self.server.events.submit(self._invoke, function, event)
+            return self._send(202, b'')
+
+        result, exec_clock = self._invoke(function, event)
+        if exec_clock < 0:
+            payload = {'errorMessage': result, 'errorType': 'Unhandled'}
+            return self._send(200, serializer.dumps(payload).encode('utf-8'), {'X-Amz-Function-Error': 'Unhandled'})
+        self._send(200, serializer.dumps(result).encode('utf-8'))
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/stats':
+            return self._send_error(404, 'UnknownOperationException', 'Unknown operation %s' % self.path)
+        report = dict()
+        for name, function in self.server.functions.items():
+            with function.lock:
+                report[name] = summarize_stats(function.stats)
+        self._send(200, serializer.dumps(report).encode('utf-8'))
+
+    def _invoke(self, function, event):
+        with self.server.slots:
+            result, exec_clock, exec_rss, exec_init = function.invoke(event, None)
+        render_result(True, function.name, result, exec_clock, exec_rss, exec_init) if self.server.verbose else None
+        return result, exec_clock
+
+    def _send_error(self, code, error_type, message):
+        payload = serializer.dumps({'Type': 'User', 'message': message}).encode('utf-8')
+        self._send(code, payload, {'x-amzn-ErrorType': error_type})
+
+    def _send(self, code, payload, headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('X-Amz-Executed-Version', '$LATEST')
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(address, functions, concurrency, verbose=False):
+    """
+    Serve the Invoke API until interrupted.
+    :param address: (host, port) to listen on.
+    :param functions: Dictionary of function name to Function.
+    :param concurrency: Maximum number of concurrent invocations.
+    :param verbose: Render every invocation.
+    :return: Void.
+    """
+    server = InvokeServer(address, functions, concurrency, verbose)
+    print("Serving %s on http://%s:%i (up to %i concurrent invocations)." % (
+        ', '.join(functions), address[0], server.server_address[1], concurrency))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
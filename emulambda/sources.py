@@ -0,0 +1,233 @@
+"""
+Event source emulation. Lambda polls SQS queues, Kinesis streams and DynamoDB streams, and invokes a function with a
+batch of records at a time, so batch size is the main throughput knob of such a function. Each line of a LDJSON stream
+is taken as a raw record, wrapped as the source would deliver it, and gathered into batches by size, payload size and
+(with recorded arrival times) batching window. Records reported in a partial batch failure are retried as the source
+would retry them.
+"""
+from __future__ import print_function
+import base64
+import collections
+import hashlib
+import time
+import uuid
+
+from emulambda import serializer
+from emulambda.eventfile import parse_timestamp, read_events
+from emulambda.tiers import invocation_cost
+
+SOURCES = ('sqs', 'kinesis', 'dynamodb')
+REGION = 'us-east-1'
+ACCOUNT = '123456789012'
+# Largest payload of a synchronous invocation, in bytes.
+MAX_PAYLOAD = 6 * 1024 * 1024
+
+
+class Record(object):
+    """
+    A raw record on its way to the function.
+    """
+    def __init__(self, index, line, arrival=None):
+        """
+        :param index: Line number of the record (1-based).
+        :param line: The LDJSON line.
+        :param arrival: Recorded arrival time in epoch seconds, or None.
+        """
+        self.index = index
+        self.line = line
+        self.arrival = arrival
+        self.attempts = 0
+        self.wrapped = None
+        self.id = None
+
+
+def wrap(source, record, partition_key=None):
+    """
+    Shape a raw record as its source delivers it, once; the shape is kept for retries.
+    :param source: One of SOURCES.
+    :param record: Record.
+    :param partition_key: Field of the raw record to take as the Kinesis partition key or DynamoDB key, or None for the
+                          line number.
+    :return: Void.
+    """
+    body = record.line.rstrip('\n')
+    raw = serializer.loads(body)
+    key = raw.get(partition_key) if partition_key and isinstance(raw, dict) else None
+    key = record.index if key is None else key
+    arrival = record.arrival if record.arrival is not None else time.time()
+    sequence = '%021i' % record.index
+    if source == 'sqs':
+        record.id = str(uuid.uuid4())
+        record.wrapped = {
+            'messageId': record.id,
+            'receiptHandle': base64.b64encode(uuid.uuid4().bytes).decode('ascii'),
+            'body': body,
+            'attributes': {'ApproximateReceiveCount': '1',
+                           'SentTimestamp': str(int(arrival * 1000)),
+                           'SenderId': ACCOUNT,
+                           'ApproximateFirstReceiveTimestamp': str(int(time.time() * 1000))},
+            'messageAttributes': {},
+            'md5OfBody': hashlib.md5(body.encode('utf-8')).hexdigest(),
+            'eventSource': 'aws:sqs',
+            'eventSourceARN': 'arn:aws:sqs:%s:%s:emulambda' % (REGION, ACCOUNT),
+            'awsRegion': REGION}
+    elif source == 'kinesis':
+        record.id = sequence
+        record.wrapped = {
+            'kinesis': {'kinesisSchemaVersion': '1.0',
+                        'partitionKey': str(key),
+                        'sequenceNumber': sequence,
+                        'data': base64.b64encode(body.encode('utf-8')).decode('ascii'),
+                        'approximateArrivalTimestamp': arrival},
+            'eventSource': 'aws:kinesis',
+            'eventVersion': '1.0',
+            'eventID': 'shardId-000000000000:%s' % sequence,
+            'eventName': 'aws:kinesis:record',
+            'invokeIdentityArn': 'arn:aws:iam::%s:role/emulambda' % ACCOUNT,
+            'awsRegion': REGION,
+            'eventSourceARN': 'arn:aws:kinesis:%s:%s:stream/emulambda' % (REGION, ACCOUNT)}
+    elif source == 'dynamodb':
+        record.id = sequence
+        image = attribute_value(raw)['M'] if isinstance(raw, dict) else {'value': attribute_value(raw)}
+        record.wrapped = {
+            'eventID': uuid.uuid4().hex,
+            'eventName': 'INSERT',
+            'eventVersion': '1.1',
+            'eventSource': 'aws:dynamodb',
+            'awsRegion': REGION,
+            'dynamodb': {'ApproximateCreationDateTime': int(arrival),
+                         'Keys': {partition_key or 'index': attribute_value(key)},
+                         'NewImage': image,
+                         'SequenceNumber': sequence,
+                         'SizeBytes': len(body),
+                         'StreamViewType': 'NEW_IMAGE'},
+            'eventSourceARN': 'arn:aws:dynamodb:%s:%s:table/emulambda/stream/2016-01-01T00:00:00.000' % (REGION,
+                                                                                                        ACCOUNT)}
+    else:
+        raise ValueError("Unknown event source %s; choose one of %s." % (source, ', '.join(SOURCES)))
+
+
+def attribute_value(value):
+    """
+    Marshal a JSON value into a DynamoDB attribute value.
+    :return: Dictionary, e.g. {'N': '5'} for 5.
+    """
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    elif value is None:
+        return {'NULL': True}
+    elif isinstance(value, (int, float)):
+        return {'N': str(value)}
+    elif isinstance(value, dict):
+        return {'M': dict((k, attribute_value(v)) for k, v in value.items())}
+    elif isinstance(value, list):
+        return {'L': [attribute_value(v) for v in value]}
+    return {'S': str(value)}
+
+
+def failures(result, exec_clock, batch):
+    """
+    Find the records of a batch which failed.
+    :param result: Result of the invocation.
+    :param exec_clock: Execution time, -1 for aborted invocations.
+    :param batch: List of Records.
+    :return: List of the Records which failed: all of them if the invocation did, or else those reported in a partial
+             batch failure response ({"batchItemFailures": [{"itemIdentifier": ...}]}).
+    """
+    if exec_clock < 0:
+        return list(batch)
+    if not isinstance(result, dict) or not isinstance(result.get('batchItemFailures'), list):
+        return list()
+    failed = set(str(item.get('itemIdentifier')) for item in result['batchItemFailures'] if isinstance(item, dict))
+    return [record for record in batch if record.id in failed]
+
+
+def emit_batches(args, run, func, checkpoint=None):
+    """
+    Emit the records of a LDJSON stream to a lambda in batches, as an event source would, one batch at a time.
+    :param args: Argument namespace from `parseargs()`; `source` is the event source, `batch_size`, `batch_window`,
+                 `max_attempts` and `partition_key` its settings.
+    :param run: A function taking (event, context) and returning (result, exec_clock, exec_rss, exec_init).
+    :param func: A function taking (index, line, result, exec_clock, exec_rss, exec_init), called per invocation with
+                 the line number of the first record of the batch and a description of it.
+    :param checkpoint: A Checkpoint to resume from and record progress in. A record is done when it is delivered, or
+                       dropped after its last attempt.
+    :return: Dictionary of 'records', 'batches', 'failures' (failed deliveries), 'dropped', 'elapsed' (seconds) and
+             'cost' (total USD).
+    """
+    report = {'records': 0, 'batches': 0, 'failures': 0, 'dropped': 0, 'elapsed': 0.0, 'cost': 0.0}
+    memory_size = args.memory_size or 128
+    retries = collections.deque()
+    events = read_events(args.eventfile, args.start, args.end, args.sample, args.part, checkpoint)
+    waiting = None
+    s = time.time()
+    while True:
+        batch, payload = list(), 0
+        while len(batch) < args.batch_size:
+            if retries:
+                record = retries.popleft()
+            elif waiting is not None:
+                record, waiting = waiting, None
+            else:
+                try:
+                    i, line = next(events)
+                except StopIteration:
+                    break
+                record = Record(i, line, _arrival(line, args.replay_field))
+                wrap(args.source, record, args.partition_key)
+                report['records'] += 1
+            size = len(serializer.dumps(record.wrapped))
+            # A batch closes when the next record would take it past the payload limit, or arrived after its window.
+            if batch and (payload + size > MAX_PAYLOAD or _outside(batch[0], record, args.batch_window)):
+                waiting = record
+                break
+            batch.append(record)
+            payload += size
+        if not batch:
+            break
+        for record in batch:
+            record.attempts += 1
+            if args.source == 'sqs':
+                record.wrapped['attributes']['ApproximateReceiveCount'] = str(record.attempts)
+        event = {'Records': [record.wrapped for record in batch]}
+        result, exec_clock, exec_rss, exec_init = run(event, None)
+        report['batches'] += 1
+        report['cost'] += invocation_cost(memory_size, exec_clock)
+        func(batch[0].index, 'Batch of %i records from line %i' % (len(batch), batch[0].index), result, exec_clock,
+             exec_rss, exec_init)
+        failed = failures(result, exec_clock, batch)
+        report['failures'] += len(failed)
+        dropped = set(record.index for record in failed if record.attempts >= args.max_attempts)
+        report['dropped'] += len(dropped)
+        if args.source == 'sqs':
+            # Queues redeliver the failed messages, behind any others already waiting.
+            retry = [record for record in failed if record.index not in dropped]
+            retries.extend(retry)
+        else:
+            # Streams retry in order from the first failed record, holding back the records after it.
+            first = next(i for i, record in enumerate(batch) if record is failed[0]) if failed else len(batch)
+            retry = [record for record in batch[first:] if record.index not in dropped]
+            retries.extendleft(reversed(retry))
+        retrying = set(record.index for record in retry)
+        for record in batch:
+            checkpoint.done(record.index) if checkpoint and record.index not in retrying else None
+    report['elapsed'] = time.time() - s
+    return report
+
+
+def _arrival(line, field):
+    """
+    :return: Recorded arrival time of a record, from a field of the raw record, or None.
+    """
+    if not field:
+        return None
+    raw = serializer.loads(line)
+    return parse_timestamp(raw.get(field)) if isinstance(raw, dict) else None
+
+
+def _outside(first, record, window):
+    """
+    :return: Whether a record arrived after the batching window opened by the first record of a batch closed.
+    """
+    return bool(window) and first.arrival is not None and record.arrival is not None and \
+        record.arrival - first.arrival > window
@@ -0,0 +1,61 @@
+"""
+Startup timing. A short-lived emulambda process spends its time starting the interpreter, importing emulambda, setting
+up the run and importing the function before the first invocation; the startup report splits the time to the first
+invocation into these phases, so that the emulator's share can be told from the function's own cold start.
+"""
+import os
+import sys
+import time
+
+
+def process_start():
+    """
+    Find when this process started, from its age in /proc (to the kernel's clock tick, usually 10ms).
+    :return: Epoch seconds, or None where /proc is not available.
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # Fields after the command name, which may hold spaces, start with the state (field 3).
+            started = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        age = uptime - started / float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return time.time() - age
+
+
+class StartupTimer(object):
+    """
+    Phases of startup, as (label, seconds, modules loaded, whether it was the function's) tuples.
+    """
+    def __init__(self, loading, loaded):
+        """
+        :param loading: (epoch seconds, number of modules loaded) when emulambda started loading.
+        :param loaded: (epoch seconds, number of modules loaded) when it finished.
+        """
+        self.phases = list()
+        started = process_start()
+        if started is not None and started < loading[0]:
+            self.phases.append(('Interpreter startup', loading[0] - started, loading[1], False))
+        self.phases.append(('Emulambda import', loaded[0] - loading[0], loaded[1] - loading[1], False))
+        self.last = loaded
+
+    def mark(self, label, handler=False):
+        """
+        End a phase.
+        :param label: Name of the phase.
+        :param handler: Whether the phase was the function's, rather than the emulator's.
+        :return: Void.
+        """
+        now = time.time(), len(sys.modules)
+        self.phases.append((label, now[0] - self.last[0], now[1] - self.last[1], handler))
+        self.last = now
+
+    @property
+    def total(self):
+        return sum(phase[1] for phase in self.phases)
+
+    @property
+    def handler(self):
+        return sum(phase[1] for phase in self.phases if phase[3])
@@ -0,0 +1,183 @@
+"""
+Constant-memory statistics for stream runs. Samples are folded into running moments (Welford's algorithm) and a
+logarithmic histogram with bounded relative error (as in DDSketch), so neither memory use nor summary cost grows with
+the number of events.
+"""
+import math
+
+
+class OnlineStats(object):
+    """
+    Running count, mean, variance, exact min/max and approximate percentiles of a stream of samples.
+    """
+    def __init__(self, precision=0.01, keep_samples=False):
+        """
+        :param precision: Relative error of percentiles, e.g. 0.01 for 1%.
+        :param keep_samples: Also keep every raw sample, for dumping. This uses memory proportional to the stream.
+        """
+        self.precision = precision
+        self.gamma = (1 + precision) / (1 - precision)
+        self.log_gamma = math.log(self.gamma)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.zero = 0
+        self.positive = dict()
+        self.negative = dict()
+        self.samples = list() if keep_samples else None
+
+    def add(self, x):
+        """
+        Add a sample.
+        :param x: A number.
+        :return: Void.
+        """
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        self.min = x if self.min is None or x < self.min else self.min
+        self.max = x if self.max is None or x > self.max else self.max
+        if x > 1e-9:
+            i = self._bucket(x)
+            self.positive[i] = self.positive.get(i, 0) + 1
+        elif x < -1e-9:
+            i = self._bucket(-x)
+            self.negative[i] = self.negative.get(i, 0) + 1
+        else:
+            self.zero += 1
+        self.samples.append(x) if self.samples is not None else None
+
+    def merge(self, other):
+        """
+        Fold another OnlineStats (with the same precision) into this one, as if its samples had been added here.
+        :param other: OnlineStats.
+        :return: Void.
+        """
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.count = count
+        self.min = other.min if self.min is None or other.min < self.min else self.min
+        self.max = other.max if self.max is None or other.max > self.max else self.max
+        self.zero += other.zero
+        for mine, theirs in ((self.positive, other.positive), (self.negative, other.negative)):
+            for i, n in theirs.items():
+                mine[i] = mine.get(i, 0) + n
+        if self.samples is not None and other.samples is not None:
+            self.samples.extend(other.samples)
+
+    def stddev(self):
+        """
+        :return: Sample standard deviation, or 0 with fewer than two samples.
+        """
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def percentile(self, q):
+        """
+        Approximate a percentile, within the configured relative precision.
+        :param q: Percentile between 0 and 100.
+        :return: Number, or None without samples.
+        """
+        if self.count == 0:
+            return None
+        rank = q / 100.0 * (self.count - 1)
+        seen = 0
+        for i in sorted(self.negative, reverse=True):
+            seen += self.negative[i]
+            if seen > rank:
+                return self._clamp(-self._value(i))
+        seen += self.zero
+        if seen > rank:
+            return self._clamp(0)
+        for i in sorted(self.positive):
+            seen += self.positive[i]
+            if seen > rank:
+                return self._clamp(self._value(i))
+        return self.max
+
+    def summary(self):
+        """
+        :return: Dictionary of the count, mean, standard deviation, min, max and main percentiles.
+        """
+        return {'count': self.count, 'mean': self.mean, 'stddev': self.stddev(), 'min': self.min, 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99),
+                'p99.9': self.percentile(99.9)}
+
+    def _bucket(self, x):
+        return int(math.ceil(math.log(x) / self.log_gamma))
+
+    def _value(self, i):
+        return 2 * self.gamma ** i / (self.gamma + 1)
+
+    def _clamp(self, x):
+        return min(max(x, self.min), self.max)
+
+
+def new_stats(keep_samples=False):
+    """
+    Build an empty statistics dictionary.
+    :param keep_samples: Keep raw samples as well, so that they can be dumped.
+    :return: Dictionary of OnlineStats ('clock', 'rss', 'init', 'cold', 'warm', 'gc' and 'forced_gc' collection
+             times, 'log_bytes', 'log_lines' and 'log_write' for captured logs, and 'memo_hit' lookup and
+             'memo_saved' execution times of memoized results) and the 'errors', 'memo_verified' and 'memo_mismatches'
+             counts.
+    """
+    stats = dict((key, OnlineStats(keep_samples=keep_samples))
+                 for key in ('clock', 'rss', 'init', 'cold', 'warm', 'gc', 'forced_gc', 'log_bytes', 'log_lines',
+                             'log_write', 'memo_hit', 'memo_saved'))
+    stats['errors'] = 0
+    stats['memo_verified'] = 0
+    stats['memo_mismatches'] = 0
+    return stats
+
+
+def record_stats(stats, exec_clock, exec_rss, exec_init=None):
+    """
+    Store the statistics of a single invocation.
+    :param stats: Dictionary from `new_stats()`.
+    :param exec_clock: Execution clock time, -1 for aborted invocations.
+    :param exec_rss: Execution RSS.
+    :param exec_init: Cold start (import) time of the container, or None if the invocation was warm.
+    :return: Void.
+    """
+    stats['rss'].add(exec_rss)
+    if exec_clock < 0:
+        stats['errors'] += 1
+    else:
+        stats['clock'].add(exec_clock)
+    if exec_init is not None:
+        stats['init'].add(exec_init)
+        stats['cold'].add(exec_init + exec_clock) if exec_clock >= 0 else None
+    elif exec_clock >= 0:
+        stats['warm'].add(exec_clock)
+
+
+def merge_stats(stats):
+    """
+    Merge the statistics collected by several workers into a single dictionary.
+    :param stats: List of dictionaries from `new_stats()`.
+    :return: Dictionary, as from `new_stats()`.
+    """
+    merged = new_stats(keep_samples=any(s['clock'].samples is not None for s in stats))
+    for s in stats:
+        for key, value in s.items():
+            if isinstance(value, OnlineStats):
+                merged[key].merge(value)
+            else:
+                merged[key] += value
+    return merged
+
+
+def summarize_stats(stats):
+    """
+    Summarize a statistics dictionary into plain data, e.g. for JSON.
+    :param stats: Dictionary from `new_stats()`.
+    :return: Dictionary of summary dictionaries and counts.
+    """
+    return dict((key, value.summary() if isinstance(value, OnlineStats) else value) for key, value in stats.items())
@@ -0,0 +1,224 @@
+"""
+Memory size tier simulation. Lambda allocates CPU in proportion to a function's configured memory, a full vCPU at
+1769MB, and stops functions which exceed their memory. A container can be held to a tier: its address space is capped
+with setrlimit, and its CPU share through a cgroup when we are allowed to create one, or else by stopping and
+continuing it on a duty cycle.
+"""
+from __future__ import print_function
+import os
+import signal
+import threading
+
+import emulambda
+from emulambda.eventfile import read_events
+from emulambda.render import billing_bucket
+from emulambda.stats import new_stats, record_stats
+
+# Memory at which a function gets a whole vCPU.
+MB_PER_VCPU = 1769
+# On-demand x86 prices, in USD.
+GB_SECOND_PRICE = 0.0000166667
+REQUEST_PRICE = 0.0000002
+# Scheduling period of the CPU cap, in seconds.
+PERIOD = 0.02
+
+
+def cpu_share(memory_size):
+    """
+    :param memory_size: Configured memory in MB.
+    :return: Share of one CPU the function gets, e.g. 0.072 at 128MB. Above 1 for several vCPUs.
+    """
+    return memory_size / float(MB_PER_VCPU)
+
+
+def invocation_cost(memory_size, exec_clock):
+    """
+    :param memory_size: Configured memory in MB.
+    :param exec_clock: Execution time in ms.
+    :return: Price of the invocation in USD, billed by the billing bucket.
+    """
+    return billing_bucket(max(exec_clock, 0)) / 1000.0 * memory_size / 1024.0 * GB_SECOND_PRICE + REQUEST_PRICE
+
+
+def limit_address_space(memory_size):
+    """
+    Cap the address space of this process, so that allocating past the tier's memory raises MemoryError. The cap is
+    the current address space plus what the tier leaves over the current RSS, which assumes that new virtual memory
+    becomes resident; memory already used by the runtime counts against the function, as it does on Lambda.
+    :param memory_size: Configured memory in MB.
+    :return: Void.
+    """
+    import resource
+    status = _proc_status()
+    limit = memory_size * 1024 * 1024
+    if 'VmSize' in status and 'VmRSS' in status:
+        limit = status['VmSize'] + max(limit - status['VmRSS'], 0)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, resource.getrlimit(resource.RLIMIT_AS)[1]))
+
+
+def _proc_status():
+    """
+    :return: Dictionary of the memory figures of /proc/self/status, in bytes. Empty where there is no /proc.
+    """
+    status = dict()
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if value.strip().endswith('kB'):
+                    status[key] = int(value.split()[0]) * 1024
+    except (IOError, OSError):
+        pass
+    return status
+
+
+class Throttle(object):
+    """
+    Holds a process, and any processes it forks, to the CPU share (and, in a cgroup, the memory) of a tier, until
+    closed.
+    """
+    def __init__(self, pid, memory_size):
+        """
+        :param pid: Process to throttle.
+        :param memory_size: Configured memory in MB.
+        """
+        self.pid = pid
+        self.share = cpu_share(memory_size)
+        self.cgroup = _make_cgroup(pid, memory_size, self.share)
+        self.stopped = threading.Event()
+        self.thread = None
+        if self.cgroup:
+            self.kind = 'cgroup'
+        elif self.share < 1:
+            self.kind = 'duty cycle'
+            self.thread = threading.Thread(target=self._cycle)
+            self.thread.daemon = True
+            self.thread.start()
+        else:
+            self.kind = 'none'
+
+    def oom_killed(self):
+        """
+        :return: Whether the kernel killed the process for exceeding the cgroup's memory. Always False without a cgroup.
+        """
+        if not self.cgroup:
+            return False
+        try:
+            with open(os.path.join(self.cgroup, 'memory.events')) as f:
+                events = dict(line.split() for line in f)
+        except (IOError, OSError):
+            return False
+        return int(events.get('oom_kill', 0)) > 0
+
+    def close(self):
+        """
+        Stop throttling, leaving the process running.
+        :return: Void.
+        """
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            _signal(self.pid, signal.SIGCONT)
+
+    def remove(self):
+        """
+        Remove the cgroup, after the process has exited.
+        :return: Void.
+        """
+        try:
+            os.rmdir(self.cgroup) if self.cgroup else None
+        except OSError:
+            pass
+
+    def _cycle(self):
+        on, off = self.share * PERIOD, (1 - self.share) * PERIOD
+        while not self.stopped.wait(on):
+            if not _signal(self.pid, signal.SIGSTOP):
+                return
+            self.stopped.wait(off)
+            if not _signal(self.pid, signal.SIGCONT):
+                return
+
+
+def _signal(pid, sig):
+    """
+    Signal the process group led by a process, or the process alone if it does not lead one (yet).
+    :return: False if the process has exited.
+    """
+    try:
+        os.killpg(pid, sig)
+        return True
+    except OSError:
+        pass
+    try:
+        os.kill(pid, sig)
+        return True
+    except OSError:
+        return False
+
+
+def _make_cgroup(pid, memory_size, share):
+    """
+    Create a cgroup v2 holding the process to the tier's CPU quota and memory, under our own cgroup, if the cpu and
+    memory controllers are delegated to it.
+    :return: Path to the cgroup, or None if we may not create one.
+    """
+    try:
+        with open('/proc/self/cgroup') as f:
+            own = [line.strip().split('::', 1)[1] for line in f if line.startswith('0::')][0]
+        parent = os.path.join('/sys/fs/cgroup', own.lstrip('/'))
+        with open(os.path.join(parent, 'cgroup.subtree_control')) as f:
+            if not {'cpu', 'memory'} <= set(f.read().split()):
+                return None
+        path = os.path.join(parent, 'emulambda-%i' % pid)
+        os.mkdir(path)
+    except (IOError, OSError, IndexError):
+        return None
+    try:
+        period = int(PERIOD * 1000000)
+        for name, value in (('cpu.max', '%i %i' % (max(int(period * share), 1000), period)),
+                            ('memory.max', str(memory_size * 1024 * 1024)),
+                            ('memory.swap.max', '0'),
+                            ('cgroup.procs', str(pid))):
+            fd = os.open(os.path.join(path, name), os.O_WRONLY)  # never create: these are the kernel's files
+            try:
+                os.write(fd, value.encode('ascii'))
+            finally:
+                os.close(fd)
+    except (IOError, OSError):
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+        return None
+    return path
+
+
+def sweep(args, sizes):
+    """
+    Run a stream through a container at each of several memory sizes.
+    :param args: Argument namespace from `parseargs()`; `eventfile` is the stream.
+    :param sizes: Memory sizes in MB.
+    :return: List of dictionaries of 'memory_size', 'share', 'stats', 'ooms' and 'cost' (total USD), per size.
+    """
+    # Imported here, as the container modules import this one.
+    from emulambda.container import Container
+    from emulambda.forking import ForkServer
+    rows = list()
+    for memory_size in sizes:
+        print("Running the stream at %iMB." % memory_size) if args.verbose else None
+        stats = new_stats()
+        ooms, cost = 0, 0.0
+        container = (ForkServer if args.fork_server else Container)(
+            args, args.recycle_invokes, args.recycle_idle, memory_size, stats)
+        try:
+            for i, line in read_events(args.eventfile, args.start, args.end, args.sample, args.part):
+                result, exec_clock, exec_rss, exec_init = container.invoke(emulambda.parse_event(line), None)
+                record_stats(stats, exec_clock, exec_rss, exec_init)
+                ooms += result == "EMULAMBDA: OUT OF MEMORY ERROR"
+                cost += invocation_cost(memory_size, exec_clock)
+        finally:
+            container.close()
+        rows.append({'memory_size': memory_size, 'share': cpu_share(memory_size), 'stats': stats, 'ooms': ooms,
+                     'cost': cost})
+    return rows
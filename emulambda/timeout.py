@@ -1,50 +1,185 @@
-from functools import wraps
-import errno
-import os
-import sys
+"""
+Invocation deadlines with sub-second resolution.
 
+In the main thread of a process with `signal.setitimer` (i.e. not Windows), a deadline is a single ITIMER_REAL, and the
+SIGALRM handler is installed once. Anywhere else (worker threads, Windows), deadlines go on the heap of one shared
+watchdog thread, which raises TimeoutError in the thread that owns an expired deadline. An exception raised that way is
+only delivered when the thread next runs Python code, so a thread blocked in a long C call is interrupted when it
+returns.
+"""
+import ctypes
+from functools import wraps
+import heapq
+import itertools
 import signal
-#Signal module doesn't work
-if sys.platform=='win32':
-    import wtimeout
+import threading
+import time
+
 
 class TimeoutError(Exception):
     pass
 
 
+_USE_ITIMER = hasattr(signal, 'setitimer')
+_local = threading.local()
+_handler_installed = False
+
+
+class Deadline(object):
+    """
+    A deadline for the current thread, armed on entry and disarmed on exit of a `with` block.
+    """
+    def __init__(self, seconds, error_message='Timer Expired'):
+        """
+        :param seconds: Seconds (may be fractional) until TimeoutError is raised. None or 0 for no deadline.
+        :param error_message: Message of the TimeoutError.
+        """
+        self.seconds = seconds
+        self.error_message = error_message
+        self.expires = None
+        self.thread = None
+        self.fired = False
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'deadline', None)
+        if self.seconds:
+            self.expires = time.time() + self.seconds
+            self.thread = threading.current_thread()
+            _local.deadline = self
+            if _USE_ITIMER and self.thread is threading.main_thread():
+                _install_handler()
+                seconds = self.seconds
+                if self.previous is not None and self.previous.expires is not None:
+                    # An enclosing deadline which expires sooner still wins.
+                    seconds = max(min(seconds, self.previous.expires - time.time()), 1e-6)
+                signal.setitimer(signal.ITIMER_REAL, seconds)
+            else:
+                _watchdog.add(self)
+        return self
+
+    def __exit__(self, *exc):
+        if self.expires is None:
+            return False
+        itimer = self.thread is threading.main_thread() and _USE_ITIMER
+        # SIGALRM (or the watchdog's exception) may still arrive after the body has returned, and raise TimeoutError
+        # here; whatever happens, the timer is disarmed first and the enclosing deadline restored, so that no stale,
+        # expired deadline is left on the thread to time out every later invocation.
+        try:
+            if itimer:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        finally:
+            try:
+                with self.lock:
+                    self.expires, expired = None, self.fired
+                    if not itimer:
+                        _watchdog.remove(self)
+                        if expired:
+                            # Clear the exception if the watchdog raised it in this thread, but it has not been
+                            # delivered yet.
+                            _set_async_exc(self.thread.ident, None)
+            finally:
+                self.expires = None
+                _local.deadline = self.previous
+                if itimer and self.previous is not None and self.previous.expires is not None:
+                    signal.setitimer(signal.ITIMER_REAL, max(self.previous.expires - time.time(), 1e-6))
+        return False
+
+    def remaining_millis(self):
+        """
+        :return: Milliseconds left before the deadline, as int; 0 once expired.
+        """
+        expires = self.expires
+        return max(0, int((expires - time.time()) * 1000)) if expires is not None else 0
+
+
+def remaining_millis():
+    """
+    Time left before the deadline of the current thread expires, for `context.get_remaining_time_in_millis()`.
+    :return: Milliseconds as int, or None if the thread has no deadline.
+    """
+    deadline = getattr(_local, 'deadline', None)
+    return deadline.remaining_millis() if deadline is not None else None
+
+
 def timeout(seconds=2147483647, error_message='Timer Expired'):
+    """
+    Decorate a function so that it raises TimeoutError if it runs longer than the given (possibly fractional) seconds.
+    """
     def decorator(func):
-        if sys.platform=='win32':
-            def wrapper(*args, **kwargs):
-                timer=wtimeout.Ticker(seconds)
-                timer.start()
-                was_set=False
-                try:
-                    result=func(*args, **kwargs)
-                except Exception as e:
-                    timer.stop()
-                    timer.join()
-                    raise e
-                was_set=timer.consume()
-                timer.stop()
-                timer.join()
-                if (was_set):
-                   raise TimeoutError(error_message)
-                return result
-
-        else:
-            def wrapper(*args, **kwargs):
-                signal.signal(signal.SIGALRM, _handle_timeout)
-                signal.alarm(seconds)
-                try:
-                    result = func(*args, **kwargs)
-                finally:
-                    signal.alarm(0)
-                return result
-
-            def _handle_timeout(signum, frame):
-                raise TimeoutError(error_message)
-
+        def wrapper(*args, **kwargs):
+            with Deadline(seconds, error_message):
+                return func(*args, **kwargs)
         return wraps(func)(wrapper)
 
     return decorator
+
+
+def _install_handler():
+    global _handler_installed
+    if not _handler_installed:
+        signal.signal(signal.SIGALRM, _handle_timeout)
+        _handler_installed = True
+
+
+def _handle_timeout(signum, frame):
+    deadline = getattr(_local, 'deadline', None)
+    if deadline is not None and deadline.expires is not None:
+        raise TimeoutError(deadline.error_message)
+
+
+def _set_async_exc(thread_id, exc):
+    return ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id),
+                                                      ctypes.py_object(exc) if exc is not None else None)
+
+
+class _Watchdog(object):
+    """
+    One thread, started on first use, which sleeps until the earliest deadline on its heap. Disarmed deadlines are
+    left on the heap and skipped when they come up, until they outnumber the armed ones and the heap is rebuilt.
+    """
+    def __init__(self):
+        self.heap = list()
+        self.armed = 0
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def add(self, deadline):
+        with self.condition:
+            heapq.heappush(self.heap, (deadline.expires, next(self.counter), deadline))
+            self.armed += 1
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='emulambda-watchdog')
+                self.thread.daemon = True
+                self.thread.start()
+            if self.heap[0][2] is deadline:
+                self.condition.notify()
+
+    def remove(self, deadline):
+        # Called with deadline.expires already cleared, so its entry is dead.
+        with self.condition:
+            self.armed -= 1
+            if len(self.heap) > 2 * self.armed + 64:
+                self.heap = [entry for entry in self.heap if entry[2].expires == entry[0]]
+                heapq.heapify(self.heap)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.heap:
+                    self.condition.wait()
+                expires, _, deadline = self.heap[0]
+                wait = expires - time.time()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                heapq.heappop(self.heap)
+            # Taking the lock of the deadline may wait for its owner to disarm it, so release the heap first.
+            with deadline.lock:
+                if deadline.expires == expires:
+                    deadline.fired = True
+                    _set_async_exc(deadline.thread.ident, TimeoutError)
+
+
+_watchdog = _Watchdog()
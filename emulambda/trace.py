@@ -0,0 +1,335 @@
+"""
+Invocation traces. The wall time of each invocation (from perf_counter_ns) is broken down into the CPU time of the
+process and what the function waited on: voluntary context switches (blocking on I/O, locks or sleeps), involuntary
+ones (preemption), block I/O operations from getrusage(), and bytes read and written from /proc/self/io. Records are
+fixed-width unsigned 64-bit fields, buffered in an array and appended to a binary trace file, so each invocation costs
+104 bytes, and later runs append to the same file. `emulambda trace-report` summarizes traces and compares their runs.
+"""
+from __future__ import print_function
+import argparse
+import array
+import collections
+import datetime
+import os
+import struct
+import sys
+import time
+
+from emulambda import serializer
+from emulambda.render import billing_bucket, size
+
+MAGIC = b'EMUTRACE'
+VERSION = 1
+# Fields of a record, each an unsigned 64-bit integer, little-endian. `run` is the start of the run in ns since the
+# epoch, and `index` the line of the event in its stream.
+FIELDS = ('run', 'index', 'wall_ns', 'cpu_ns', 'voluntary', 'involuntary', 'inblock', 'oublock', 'read_bytes',
+          'write_bytes', 'rchar', 'wchar', 'flags')
+HEADER = struct.Struct('<8sII')  # magic, version, fields per record
+WIDTH = 8 * len(FIELDS)
+# Flags of a record.
+ERROR = 1
+COLD = 2
+NO_PROC_IO = 4
+# Records are written in batches of this many.
+BATCH = 1024
+# Fields of /proc/self/io, in the order they are recorded.
+_PROC_IO = (b'read_bytes', b'write_bytes', b'rchar', b'wchar')
+
+
+class Tracer(object):
+    """
+    Records invocations, bracketed by `start()` and `stop()`, to a trace file. Linux gives every field; elsewhere,
+    I/O bytes are recorded as 0 and flagged.
+    """
+    def __init__(self, path):
+        """
+        :param path: Trace file to append to, created if need be.
+        :raises ValueError: If the file exists, and is not a trace of this version.
+        """
+        import resource
+        self.getrusage = resource.getrusage
+        self.who = resource.RUSAGE_SELF
+        self.run = time.time_ns()
+        self.file = _open_trace(path)
+        self.records = array.array('Q')
+        try:
+            self.io = os.open('/proc/self/io', os.O_RDONLY)
+        except OSError:
+            self.io = None
+        # Bytes read from /proc/self/io by the tracer itself, which count towards rchar.
+        self.own = 0
+        self.before = None
+
+    def start(self):
+        """
+        Take the counters before an invocation; the clocks last, so as not to count reading the others.
+        :return: Void.
+        """
+        usage, io = self.getrusage(self.who), self._io()
+        self.before = (time.perf_counter_ns(), time.process_time_ns(), usage.ru_nvcsw, usage.ru_nivcsw,
+                       usage.ru_inblock, usage.ru_oublock) + io
+
+    def stop(self, index=0, error=False, cold=False):
+        """
+        Take the counters after an invocation, and record the differences.
+        :param index: Line of the event in its stream, or 0.
+        :param error: Whether the invocation failed.
+        :param cold: Whether it was the first of its container.
+        :return: Void.
+        """
+        wall, cpu = time.perf_counter_ns(), time.process_time_ns()
+        usage, io = self.getrusage(self.who), self._io()
+        after = (wall, cpu, usage.ru_nvcsw, usage.ru_nivcsw, usage.ru_inblock, usage.ru_oublock) + io
+        flags = (ERROR if error else 0) | (COLD if cold else 0) | (NO_PROC_IO if self.io is None else 0)
+        self.records.append(self.run)
+        self.records.append(index or 0)
+        self.records.extend(max(a - b, 0) for a, b in zip(after, self.before))
+        self.records.append(flags)
+        self.flush() if len(self.records) >= BATCH * len(FIELDS) else None
+
+    def _io(self):
+        """
+        :return: Bytes read from and written to storage, and read and written by any means, by the process so far.
+        """
+        if self.io is None:
+            return 0, 0, 0, 0
+        data = os.pread(self.io, 1024, 0)
+        fields = dict(line.split(b': ') for line in data.splitlines() if b': ' in line)
+        fields[b'rchar'] = int(fields.get(b'rchar', 0)) - self.own
+        self.own += len(data)
+        return tuple(int(fields.get(name, 0)) for name in _PROC_IO)
+
+    def flush(self):
+        """
+        Append the records waiting for a full batch to the file.
+        :return: Void.
+        """
+        if self.records:
+            records = self.records
+            if sys.byteorder == 'big':
+                records = array.array('Q', records)
+                records.byteswap()
+            records.tofile(self.file)
+            self.file.flush()
+            del self.records[:]
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        os.close(self.io) if self.io is not None else None
+
+
+def _open_trace(path):
+    """
+    Open a trace file to append to, writing the header of a new one.
+    :return: File object.
+    """
+    f = open(path, 'a+b')
+    f.seek(0, os.SEEK_END)
+    length = f.tell()
+    if length == 0:
+        f.write(HEADER.pack(MAGIC, VERSION, len(FIELDS)))
+        return f
+    f.seek(0)
+    _check_header(f.read(HEADER.size), path)
+    # Drop a partial record, left by a run which was killed while writing.
+    whole = HEADER.size + (length - HEADER.size) // WIDTH * WIDTH
+    f.truncate(whole) if whole != length else None
+    return f
+
+
+def _check_header(header, path):
+    """
+    :raises ValueError: If the header is not that of a trace of this version.
+    """
+    if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+        raise ValueError("%s is not an emulambda trace." % path)
+    magic, version, fields = HEADER.unpack(header)
+    if version != VERSION or fields != len(FIELDS):
+        raise ValueError("%s is a trace of another version of emulambda (version %i, %i fields)." %
+                         (path, version, fields))
+
+
+def read_trace(path):
+    """
+    Read the runs of a trace file.
+    :param path: Trace file.
+    :return: List of runs, in the order they were appended, each a dictionary of field names to arrays of values.
+    :raises ValueError: If the file is not a trace of this version.
+    """
+    with open(path, 'rb') as f:
+        _check_header(f.read(HEADER.size), path)
+        data = f.read()
+    records = array.array('Q')
+    records.frombytes(data[:len(data) // WIDTH * WIDTH])
+    records.byteswap() if sys.byteorder == 'big' else None
+    n = len(FIELDS)
+    columns = [records[i::n] for i in range(n)]
+    # Records of a run are contiguous, unless runs appended to the file at the same time.
+    runs, start = collections.OrderedDict(), 0
+    for i in range(1, len(columns[0]) + 1):
+        if i == len(columns[0]) or columns[0][i] != columns[0][start]:
+            run = runs.setdefault(columns[0][start], dict((field, array.array('Q')) for field in FIELDS))
+            for field, column in zip(FIELDS, columns):
+                run[field].extend(column[start:i])
+            start = i
+    return list(runs.values())
+
+
+def summarize(run):
+    """
+    Summarize a run of a trace.
+    :param run: Dictionary from `read_trace()`.
+    :return: Dictionary of the summary.
+    """
+    count = len(run['wall_ns'])
+    wall = sorted(ns / 1e6 for ns in run['wall_ns'])  # convert to ms
+    cpu = sorted(ns / 1e6 for ns in run['cpu_ns'])
+    # Other threads of the process may add CPU time beyond the wall time.
+    wait = sorted(max(w - c, 0) / 1e6 for w, c in zip(run['wall_ns'], run['cpu_ns']))
+    total = sum(wall)
+    summary = {
+        'run': run['run'][0] if count else None,
+        'count': count,
+        'errors': sum(1 for flags in run['flags'] if flags & ERROR),
+        'cold': sum(1 for flags in run['flags'] if flags & COLD),
+        'proc_io': not any(flags & NO_PROC_IO for flags in run['flags']),
+        'billed': sum(billing_bucket(ms) for ms in wall),
+        'cpu_share': sum(cpu) / total if total else 0.0,
+        'samples': {'wall': wall, 'cpu': cpu, 'wait': wait},
+    }
+    for name, values in summary['samples'].items():
+        summary[name] = {'total': sum(values), 'p50': _percentile(values, 50), 'p90': _percentile(values, 90),
+                         'p99': _percentile(values, 99), 'max': values[-1] if values else None}
+    for field in ('voluntary', 'involuntary', 'inblock', 'oublock', 'read_bytes', 'write_bytes', 'rchar', 'wchar'):
+        summary[field] = sum(run[field])
+    return summary
+
+
+def _percentile(values, q):
+    """
+    :param values: Sorted list.
+    :return: Nearest-rank percentile, or None without values.
+    """
+    return values[min(int(q / 100.0 * len(values)), len(values) - 1)] if values else None
+
+
+def compare(baseline, summary, alpha=0.01):
+    """
+    Compare a run with a baseline run.
+    :param baseline: Summary of the baseline, from `summarize()`.
+    :param summary: Summary of the run.
+    :param alpha: Significance level of the test that times have grown.
+    :return: List of (metric, baseline value, value, relative change or None, p-value or None, significant
+             growth). Counters are per invocation, as runs may differ in length.
+    """
+    from emulambda.bench import mann_whitney
+    rows = list()
+    for name in ('wall', 'cpu', 'wait'):
+        p = mann_whitney(summary['samples'][name], baseline['samples'][name])
+        for q in ('p50', 'p99'):
+            old, new = baseline[name][q] or 0, summary[name][q] or 0
+            rows.append(('%s %s' % (name, q), old, new, _change(old, new), p, p < alpha and new > old))
+    for field in ('voluntary', 'involuntary', 'inblock', 'oublock', 'read_bytes', 'write_bytes'):
+        old = baseline[field] / float(baseline['count']) if baseline['count'] else 0
+        new = summary[field] / float(summary['count']) if summary['count'] else 0
+        rows.append((field, old, new, _change(old, new), None, False))
+    return rows
+
+
+def _change(old, new):
+    """
+    :return: Relative change, or None if there was nothing before.
+    """
+    return new / old - 1 if old else (0.0 if not new else None)
+
+
+def render_summary(label, summary):
+    """
+    Render the summary of a run.
+    :return: Void.
+    """
+    started = datetime.datetime.fromtimestamp(summary['run'] / 1e9).strftime('%Y-%m-%d %H:%M:%S') \
+        if summary['run'] else '-'
+    print('%s, started %s: %i invocations, %i errors, %i cold' % (label, started, summary['count'], summary['errors'],
+                                                                  summary['cold']))
+    for name, title in (('wall', 'Wall'), ('cpu', 'CPU'), ('wait', 'Off CPU')):
+        times = summary[name]
+        if times['p50'] is not None:
+            print('\t%-8s Total: %.1fms, Median: %.3fms, p90: %.3fms, p99: %.3fms, Max: %.3fms' % (
+                title + ':', times['total'], times['p50'], times['p90'], times['p99'], times['max']))
+    count = float(summary['count'] or 1)
+    wall = summary['wall']['total']
+    print('\tBilled: %ims; of the wall time, %.1f%% was on CPU and %.1f%% off CPU, waiting' % (
+        summary['billed'], summary['cpu_share'] * 100, summary['wait']['total'] / wall * 100 if wall else 0))
+    print('\tContext switches per invocation: %.1f voluntary, %.1f involuntary' % (
+        summary['voluntary'] / count, summary['involuntary'] / count))
+    print('\tBlock I/O: %i reads, %i writes; %s read and %s written to storage%s' % (
+        summary['inblock'], summary['oublock'], size(summary['read_bytes']), size(summary['write_bytes']),
+        '; %s read and %s written in all' % (size(summary['rchar']), size(summary['wchar'])) if summary['proc_io']
+        else ' (/proc/self/io was not available)'))
+
+
+def render_comparison(label, rows):
+    """
+    Render the comparison of a run with the baseline.
+    :return: Void.
+    """
+    print('\n%s against the baseline:' % label)
+    print('%-16s %12s %12s %8s %8s' % ('Metric', 'Baseline', 'Now', 'Change', 'p'))
+    for metric, old, new, change, p, grown in rows:
+        format_value = (lambda ms: '%.3fms' % ms) if p is not None else \
+            (lambda n: size(int(n))) if metric.endswith('_bytes') else (lambda n: '%.1f' % n)
+        print('%-16s %12s %12s %8s %8s%s' % (metric, format_value(old), format_value(new),
+                                            '%+.1f%%' % (change * 100) if change is not None else 'new',
+                                            '%.4f' % p if p is not None else '-', '  SLOWER' if grown else ''))
+
+
+def report_main(argv=None):
+    """
+    Summarize trace files, and compare every run with the first.
+    :param argv: Arguments after `trace-report`.
+    :return: List of summaries, one per run.
+    """
+    args = parseargs(argv)
+    summaries = list()
+    for path in args.traces:
+        try:
+            runs = read_trace(path)
+        except (IOError, ValueError) as e:
+            print(str(e))
+            sys.exit(1)
+        runs = runs[-args.last:] if args.last else runs
+        summaries.extend(('%s#%i' % (path, i), summarize(run)) for i, run in enumerate(runs, 1))
+    for label, summary in summaries:
+        if args.json:
+            print(serializer.dumps(dict((key, value) for key, value in summary.items() if key != 'samples')))
+        else:
+            render_summary(label, summary)
+    if not args.json:
+        for label, summary in summaries[1:]:
+            render_comparison(label, compare(summaries[0][1], summary, args.alpha))
+    return [summary for label, summary in summaries]
+
+
+def parseargs(argv=None):
+    """
+    Parse trace-report arguments.
+    :return: Argument namespace (access members with dot).
+    """
+    parser = argparse.ArgumentParser(prog='emulambda trace-report',
+                                     description='Summarize invocation traces recorded with --trace, and compare '
+                                                 'their runs with the first.')
+    parser.add_argument('traces', help='Trace files. Each may hold several runs.',
+                        nargs='+',
+                        metavar='TRACE')
+    parser.add_argument('--last', help='Only report the last N runs of each trace.',
+                        type=int,
+                        metavar='N')
+    parser.add_argument('--alpha', help='Significance level of the Mann-Whitney U test that times have grown. '
+                                        'Default is 0.01.',
+                        type=float,
+                        default=0.01)
+    parser.add_argument('--json', help='Print a summary per run as a line of JSON, without comparisons.',
+                        action='store_true')
+    return parser.parse_args(argv)
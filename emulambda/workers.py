@@ -0,0 +1,144 @@
+"""
+Parallel stream mode. Fans LDJSON events out to a pool of pre-forked worker processes, each of which imports the
+lambda once and keeps its own statistics.
+"""
+from __future__ import print_function
+import collections
+import multiprocessing
+import threading
+import time
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+import emulambda
+from emulambda import credentials
+from emulambda.eventfile import read_events
+from emulambda.gcpolicy import GCPolicy
+from emulambda.importtime import enable_lazy_imports
+from emulambda.memory import get_meter
+from emulambda.profiler import get_profiler
+from emulambda.stats import new_stats, record_stats
+
+
+def emit_to_workers(args, func, checkpoint=None, profiler=None):
+    """
+    Emit lines from a stream to a pool of worker processes. Each line must contain a JSON string.
+    :param args: Argument namespace from `parseargs()`; `eventfile` is the stream, `workers` the pool size.
+    :param func: A function taking (index, line, result, exec_clock, exec_rss, exec_init, exec_gc), invoked in this
+                 process per result.
+    :param checkpoint: A Checkpoint to resume from and record progress in.
+    :param profiler: A profiler to gather the workers' profiles in. Workers profile with one of the same kind.
+    :return: List of per-worker statistics dictionaries.
+    """
+    tasks = multiprocessing.Queue(maxsize=args.workers * 2)
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=work, args=(args, tasks, results)) for _ in range(args.workers)]
+    for p in procs:
+        p.daemon = True
+        p.start()
+
+    # Line numbers in the order they were read, which is the order results are rendered in unless unordered.
+    order = collections.deque()
+    feeder = threading.Thread(target=_feed, args=(args, tasks, results, checkpoint, order))
+    feeder.daemon = True
+    feeder.start()
+
+    stats = list()
+    pending = dict()
+    try:
+        while len(stats) < len(procs):
+            try:
+                kind, payload = results.get(timeout=1)
+            except Empty:
+                if any(p.exitcode not in (None, 0) for p in procs):
+                    raise RuntimeError("A worker process died unexpectedly.")
+                continue
+            if kind == 'error':
+                raise payload
+            elif kind == 'profile':
+                profiler.absorb(payload)
+            elif kind == 'stats':
+                stats.append(payload)
+            elif kind == 'ready':
+                continue
+            elif args.unordered:
+                for r in payload:
+                    func(*r)
+                    checkpoint.done(r[0]) if checkpoint else None
+            else:
+                # Hold results back until every earlier event has been rendered.
+                for r in payload:
+                    pending[r[0]] = r
+                while order and order[0] in pending:
+                    i = order.popleft()
+                    func(*pending.pop(i))
+                    checkpoint.done(i) if checkpoint else None
+    finally:
+        for p in procs:
+            if p.is_alive() and len(stats) < len(procs):
+                p.terminate()
+            p.join()
+    return stats
+
+
+def _feed(args, tasks, results, checkpoint, order):
+    """
+    Read a LDJSON stream and queue its lines, with their 1-based index, in chunks. Runs in a thread of the parent.
+    """
+    try:
+        chunk = list()
+        for i, line in read_events(args.eventfile, args.start, args.end, args.sample, args.part, checkpoint):
+            order.append(i) if not args.unordered else None
+            chunk.append((i, line))
+            if len(chunk) >= args.chunk_size:
+                tasks.put(chunk)
+                chunk = list()
+        if chunk:
+            tasks.put(chunk)
+    except (IOError, ValueError) as e:
+        print("There was a problem parsing your JSON event.")
+        results.put(('error', e))
+    for _ in range(args.workers):
+        tasks.put(None)
+
+
+def work(args, tasks, results):
+    """
+    Worker process body. Imports the lambda once, then invokes it for every event of every chunk it receives. Sends
+    ('ready', None) once the lambda is imported, ('results', list of result tuples) per chunk, and its profile and
+    statistics when told to stop with None.
+    """
+    credentials.default_cache.endpoint_url = args.sts_endpoint
+    meter = get_meter(args.memory)
+    profiler = get_profiler(args.profile, args.profile_interval / 1000.0) if args.profile else None
+    enable_lazy_imports() if args.lazy_imports else None
+    s = time.time()
+    lfunc = emulambda.import_lambda(args.lambdapath)
+    pending_init = [(time.time() - s) * 1000]  # convert to ms
+    results.put(('ready', None))
+    stats = new_stats(args.dump_samples)
+    policy = GCPolicy(args.gc, meter, stats)
+    while True:
+        chunk = tasks.get()
+        if chunk is None:
+            break
+        done = list()
+        for i, line in chunk:
+            policy.before()
+            try:
+                event = emulambda.parse_event(line)
+            except ValueError as e:
+                results.put(('error', e))
+                return
+            meter.start()
+            result, exec_clock = emulambda.invoke_lambda(lfunc, event, None, args.timeout, args.role, profiler)
+            exec_rss = meter.stop()
+            exec_init = pending_init.pop() if pending_init else None
+            record_stats(stats, exec_clock, exec_rss, exec_init)
+            done.append((i, line, result, exec_clock, exec_rss, exec_init, policy.last))
+        results.put(('results', done))
+    results.put(('profile', profiler.export())) if profiler else None
+    results.put(('stats', stats))
@@ -1,11 +1,87 @@
+import argparse
 import unittest
 import sys
 import emulambda
 import emulambda.render
+import emulambda.container
+import emulambda.memory
+import emulambda.profiler
+import emulambda.importtime
+import emulambda.tiers
+import emulambda.forking
+import emulambda.eventfile
+import emulambda.stats
+import emulambda.startup
+import emulambda.credentials
+import emulambda.timeout
+import emulambda.server
+import emulambda.serializer
+import emulambda.bench
+import emulambda.gcpolicy
+import emulambda.metrics
+import emulambda.logs
+import emulambda.sources
+import emulambda.loadgen
+import emulambda.manifest
+import emulambda.reload
+import emulambda.memo
+import emulambda.trace
+import testmodule.handlers
+import boto3
 import io
+import json
+import contextlib
+import csv
+import os
+import shutil
+import tempfile
+import subprocess
+import time
+import threading
+import signal
+import gc
+import struct
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.request import Request, urlopen
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urllib2 import Request, urlopen
 __author__ = 'dominiczippilli'
 
 
+@contextlib.contextmanager
+def stream_file(lines):
+    """
+    A temporary LDJSON file of the given lines, removed with its index afterwards.
+    """
+    stream = tempfile.NamedTemporaryFile('w', suffix='.ldjson', delete=False)
+    stream.write(''.join(line + '\n' for line in lines))
+    stream.close()
+    try:
+        yield stream.name
+    finally:
+        os.remove(stream.name)
+        os.remove(stream.name + '.idx') if os.path.exists(stream.name + '.idx') else None
+
+
+def run_main(argv, lines=None):
+    """
+    Run emulambda, capturing its output.
+    :param argv: Arguments after the program name. With lines, '-' stands for a stream file of them.
+    :param lines: Lines of the stream, or None.
+    :return: (value of main(), output split on whitespace, elapsed seconds).
+    """
+    with (stream_file(lines) if lines is not None else contextlib.nullcontext('-')) as stream:
+        sys.argv = [sys.argv[0]] + [stream if arg == '-' else arg for arg in argv]
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            s = time.time()
+            stats = emulambda.main()
+            elapsed = time.time() - s
+    return stats, out.getvalue().split(), elapsed
+
+
 class EmulambdaMainTest(unittest.TestCase):
     def test_main_single_event(self):
         sys.argv = [sys.argv[0], 'example.example_handler', 'example/example.json']
@@ -143,3 +219,1198 @@ class EmulambdaBillingBucketTest(unittest.TestCase):
             assert emulambda.render.billing_bucket(99) == 100
         except BaseException as e:
             self.fail("Billing bucket is wrong.\n%s" % e.message)
+
+
+class EmulambdaWorkersTest(unittest.TestCase):
+    def run_main(self, *extra):
+        lines = ['{"key": %i}' % i for i in range(50)]
+        return run_main(['testmodule.handlers.echo', '-', '-s', '-w', '3', '--chunk-size', '4'] + list(extra),
+                        lines)[1]
+
+    def test_workers_ordered(self):
+        assert self.run_main() == [str(i) for i in range(50)]
+
+    def test_workers_unordered(self):
+        assert sorted(self.run_main('--unordered'), key=int) == [str(i) for i in range(50)]
+
+    def test_merge_stats(self):
+        a, b = emulambda.stats.new_stats(), emulambda.stats.new_stats()
+        emulambda.stats.record_stats(a, 1.0, 2)
+        emulambda.stats.record_stats(b, 3.0, 4)
+        merged = emulambda.stats.merge_stats([a, b])
+        assert merged['clock'].count == 2
+        assert merged['clock'].mean == 2.0
+        assert (merged['rss'].min, merged['rss'].max) == (2, 4)
+
+
+class EmulambdaContainerTest(unittest.TestCase):
+    def test_container_recycle(self):
+        sys.argv = [sys.argv[0], 'testmodule.handlers.echo', '-']
+        container = emulambda.container.Container(emulambda.parseargs(), max_invokes=2)
+        try:
+            inits = [container.invoke({'key': i}, None)[3] for i in range(5)]
+        finally:
+            container.close()
+        assert container.starts == 3
+        assert [i is not None for i in inits] == [True, False, True, False, True]
+
+    def test_record_stats(self):
+        stats = emulambda.stats.new_stats()
+        emulambda.stats.record_stats(stats, 10.0, 1, 100.0)
+        emulambda.stats.record_stats(stats, 5.0, 1)
+        emulambda.stats.record_stats(stats, -1, 1)
+        assert stats['init'].max == 100.0
+        assert stats['cold'].max == 110.0
+        assert stats['warm'].max == 5.0
+        assert stats['clock'].count == 2
+        assert stats['errors'] == 1
+
+
+@unittest.skipIf(sys.platform == 'win32', "Needs POSIX signals and rlimits")
+class EmulambdaTiersTest(unittest.TestCase):
+    def test_duty_cycle_throttle(self):
+        def run(memory_size):
+            p = subprocess.Popen([sys.executable, '-c', 'import time\nwhile time.process_time() < 0.2: pass'])
+            throttle = emulambda.tiers.Throttle(p.pid, memory_size) if memory_size else None
+            s = time.time()
+            p.wait()
+            throttle.close() if throttle else None
+            throttle.remove() if throttle else None
+            return time.time() - s
+
+        assert run(442) > 2 * run(None)
+
+    def test_out_of_memory(self):
+        sys.argv = [sys.argv[0], 'testmodule.handlers.allocate', '-']
+        container = emulambda.container.Container(emulambda.parseargs(), memory_size=128)
+        try:
+            assert container.invoke({'mb': 512}, None)[:2] == ("EMULAMBDA: OUT OF MEMORY ERROR", -1)
+            assert container.invoke({'mb': 1}, None)[0] == 1024 * 1024
+        finally:
+            container.close()
+
+    def test_invocation_cost(self):
+        assert emulambda.tiers.invocation_cost(1024, 50) == 0.1 * emulambda.tiers.GB_SECOND_PRICE + \
+            emulambda.tiers.REQUEST_PRICE
+        assert emulambda.tiers.cpu_share(1769) == 1
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), "Needs os.fork()")
+class EmulambdaForkServerTest(unittest.TestCase):
+    def invoke(self, path, events, *extra):
+        sys.argv = [sys.argv[0], path, '-', '--fork-server'] + list(extra)
+        server = emulambda.forking.ForkServer(emulambda.parseargs())
+        try:
+            return [server.invoke(event, None) for event in events], server.starts
+        finally:
+            server.close()
+
+    def test_invocations_are_isolated(self):
+        results, starts = self.invoke('testmodule.handlers.remember', [{}] * 4)
+        assert [r[0] for r in results] == [1, 1, 1, 1]
+        assert [r[3] is not None for r in results] == [True, False, False, False]
+        assert starts == 1
+
+    def test_batches(self):
+        results, starts = self.invoke('testmodule.handlers.remember', [{}] * 5, '--fork-batch', '2')
+        assert [r[0] for r in results] == [1, 2, 1, 2, 1]
+
+    def test_crash_fails_one_invocation(self):
+        results, starts = self.invoke('testmodule.handlers.crash', [{}, {'crash': True}, {}])
+        assert [r[0] for r in results] == ['ok', "EMULAMBDA: RUNTIME ERROR", 'ok']
+        assert starts == 1
+
+
+class EmulambdaMemoryTest(unittest.TestCase):
+    def measure(self, meter, size):
+        meter.start()
+        data = bytearray(size)
+        data[::4096] = b'x' * len(data[::4096])
+        del data
+        return meter.stop()
+
+    def test_rusage_meter(self):
+        meter = emulambda.memory.get_meter('rusage')
+        assert self.measure(meter, 1024) >= 0
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "Needs /proc")
+    def test_proc_meter_is_not_a_high_water_mark(self):
+        meter = emulambda.memory.get_meter('proc')
+        big = self.measure(meter, 64 * 1024 * 1024)
+        small = self.measure(meter, 1024)
+        assert big > 32 * 1024 * 1024
+        assert small < big / 2
+
+    def test_tracemalloc_meter(self):
+        meter = emulambda.memory.get_meter('tracemalloc')
+        try:
+            big = self.measure(meter, 8 * 1024 * 1024)
+            small = self.measure(meter, 1024)
+        finally:
+            meter.tracemalloc.stop()
+        assert big >= 8 * 1024 * 1024
+        assert small < big / 2
+
+    def test_unknown_meter(self):
+        self.assertRaises(ValueError, emulambda.memory.get_meter, 'foo')
+
+
+class EmulambdaProfilerTest(unittest.TestCase):
+    def profile(self, kind):
+        def busy(e, c):
+            s = time.time()
+            while time.time() - s < 0.05:
+                sum(range(100))
+            return e
+
+        profiler = emulambda.profiler.get_profiler(kind)
+        for i in range(3):
+            assert emulambda.invoke_lambda(busy, i, None, 5, None, profiler)[0] == i
+        return profiler
+
+    def test_cprofile(self):
+        profiler = self.profile('cprofile')
+        assert profiler.invocations == 3
+        assert profiler.overhead > 0
+        labels = [label for label, share, own, cumulative in profiler.hot(10)]
+        assert any('(busy)' in label for label in labels)
+        assert not any('_invoke_lambda' in label for label in labels)
+
+    def test_sample(self):
+        profiler = self.profile('sample')
+        assert profiler.samples > 0
+        assert profiler.hot(1)[0][0].endswith('(busy)')
+        path = tempfile.mktemp()
+        try:
+            profiler.write(path)
+            with open(path) as f:
+                stack, count = f.readline().rsplit(' ', 1)
+        finally:
+            os.remove(path)
+        assert stack.split(';')[0].endswith('(busy)')
+        assert int(count) > 0
+
+    def test_absorb(self):
+        a, b = self.profile('sample'), emulambda.profiler.get_profiler('sample')
+        b.absorb(a.export())
+        assert (b.invocations, b.samples) == (a.invocations, a.samples)
+
+
+class EmulambdaImportTimeTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        sys.path.insert(0, self.path)
+        with open(os.path.join(self.path, 'emulambda_test_outer.py'), 'w') as f:
+            f.write('import emulambda_test_inner\nLOADED = True\n')
+        with open(os.path.join(self.path, 'emulambda_test_inner.py'), 'w') as f:
+            f.write('import time\ntime.sleep(0.05)\n')
+
+    def tearDown(self):
+        sys.path.remove(self.path)
+        shutil.rmtree(self.path)
+        for name in ('emulambda_test_outer', 'emulambda_test_inner'):
+            sys.modules.pop(name, None)
+
+    def test_import_tree(self):
+        imports = emulambda.importtime.ImportRecorder()
+        imports.start()
+        try:
+            import emulambda_test_outer
+        finally:
+            imports.stop()
+        outer, = imports.root.children
+        inner, = outer.children
+        assert (outer.name, inner.name) == ('emulambda_test_outer', 'emulambda_test_inner')
+        assert inner.own >= 0.05 > outer.own
+        assert outer.cumulative >= inner.cumulative
+        assert imports.slowest(1) == [inner]
+        assert not isinstance(emulambda_test_outer.__loader__, emulambda.importtime._TimedLoader)
+
+    def test_lazy_imports(self):
+        importer = emulambda.importtime.enable_lazy_imports()
+        try:
+            s = time.time()
+            import emulambda_test_inner
+            assert time.time() - s < 0.05
+            s = time.time()
+            emulambda_test_inner.time
+            assert time.time() - s >= 0.05
+        finally:
+            sys.meta_path.remove(importer)
+
+
+class EmulambdaStartupTest(unittest.TestCase):
+    def test_deferred_imports(self):
+        modules = subprocess.check_output([sys.executable, '-c', 'import sys, emulambda; print(" ".join(sys.modules))'],
+                                          cwd=os.path.dirname(os.path.abspath(__file__))).decode().split()
+        for name in ('boto3', 'multiprocessing', 'http.server', 'pstats', 'numpy'):
+            assert name not in modules, name
+
+    def test_size(self):
+        assert [emulambda.render.size(n) for n in (0, 1023, 1024, 5000, 12 * 1024 * 1024 + 5, 3 * 1024 ** 3)] == \
+            ['0B', '1023B', '1K', '4K', '12M', '3G']
+
+    def test_process_start(self):
+        started = emulambda.startup.process_start()
+        if started is not None:
+            assert started <= time.time()
+
+    def test_modules_counted_from_loaded(self):
+        now = time.time()
+        timer = emulambda.startup.StartupTimer((now - 0.2, 10), (now - 0.1, 20))
+        timer.mark('Emulambda setup')
+        assert timer.phases[-1][2] == len(sys.modules) - 20
+
+    def test_startup_report(self):
+        sys.argv = [sys.argv[0], 'example.example_handler', 'example/example.json', '--startup-report']
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            emulambda.main()
+        report = out.getvalue()
+        assert 'Startup of example.example_handler' in report
+        assert 'Emulambda import' in report and 'Emulambda setup' in report and 'Handler import' in report
+        assert 'Function import:' in report
+
+    def test_startup_report_with_containers(self):
+        sys.argv = [sys.argv[0], 'example.example_handler', 'example/example.json', '--startup-report',
+                    '--recycle-invokes', '1']
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertRaises(SystemExit, emulambda.parseargs)
+
+
+class EmulambdaReloadTest(unittest.TestCase):
+    modules = ('emulambda_test_app', 'emulambda_test_pkg', 'emulambda_test_pkg.util', 'emulambda_test_pkg.heavy')
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        sys.path.insert(0, self.path)
+        os.mkdir(os.path.join(self.path, 'emulambda_test_pkg'))
+        self.write('emulambda_test_pkg/__init__.py', '')
+        self.write('emulambda_test_pkg/util.py', 'VALUE = 1\n')
+        self.write('emulambda_test_pkg/heavy.py', 'import json\nLOADS = 0\nLOADS += 1\n')
+        self.write('emulambda_test_app.py', 'from emulambda_test_pkg import heavy, util\n\n'
+                                            'def handler(event, context):\n    return util.VALUE, heavy.LOADS\n')
+
+    def tearDown(self):
+        sys.path.remove(self.path)
+        shutil.rmtree(self.path)
+        for name in self.modules:
+            sys.modules.pop(name, None)
+        emulambda.forget_lambda('emulambda_test_app.handler')
+
+    def write(self, name, source):
+        with open(os.path.join(self.path, name), 'w') as f:
+            f.write(source)
+
+    def test_graph(self):
+        emulambda.import_lambda('emulambda_test_app.handler')
+        graph = emulambda.reload.ModuleGraph('emulambda_test_app')
+        assert sorted(graph.files) == sorted(self.modules)
+        assert graph.imports['emulambda_test_app'] == set(self.modules[1:])
+        assert graph.affected(['emulambda_test_pkg.util']) == ['emulambda_test_pkg.util', 'emulambda_test_app']
+        assert 'json' not in graph.files
+
+    def reload(self, watcher):
+        func = emulambda.import_lambda('emulambda_test_app.handler')
+        reloader = emulambda.reload.Reloader('emulambda_test_app.handler', watcher)
+        try:
+            assert func(None, None) == (1, 1)
+            assert reloader.wait(0.1) == []
+            time.sleep(0.05)
+            self.write('emulambda_test_pkg/util.py', 'VALUE = 200\n')
+            changed = reloader.wait(5)
+            assert changed == ['emulambda_test_pkg.util']
+            func, reloaded, elapsed = reloader.reload(changed)
+        finally:
+            reloader.close()
+        assert reloaded == ['emulambda_test_pkg.util', 'emulambda_test_app'] and elapsed > 0
+        # The module which did not change was not run again.
+        assert func(None, None) == (200, 1)
+        assert emulambda.import_lambda('emulambda_test_app.handler') is func
+
+    def test_polling(self):
+        self.reload(emulambda.reload.PollingWatcher(0.01))
+
+    def test_inotify(self):
+        watcher = emulambda.reload.get_watcher()
+        if watcher.kind != 'inotify':
+            watcher.close()
+            self.skipTest('inotify is not available')
+        self.reload(watcher)
+
+    def test_file_path(self):
+        path = os.path.join(self.path, 'emulambda_test_file') + '.handler'
+        self.write('emulambda_test_file.py', 'def handler(event, context):\n    return 1\n')
+        try:
+            assert emulambda.import_lambda(path)(None, None) == 1
+            reloader = emulambda.reload.Reloader(path, emulambda.reload.PollingWatcher(0.01))
+            self.write('emulambda_test_file.py', 'def handler(event, context):\n    return 22\n')
+            func, reloaded, elapsed = reloader.reload(reloader.wait(5))
+            assert reloaded == ['handler'] and func(None, None) == 22
+        finally:
+            emulambda.forget_lambda(path)
+            sys.modules.pop('handler', None)
+
+
+class EmulambdaMemoTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        del testmodule.handlers.calls[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_main(self, lines, *extra):
+        return run_main(['testmodule.handlers.remember', '-', '-s', '--memoize'] + list(extra), lines)[:2]
+
+    def test_hits(self):
+        stats, out = self.run_main(['{"a": 1, "b": 2}', '{"b":2,"a":1}', '{"a": 2}'])
+        # The reordered event is the same event, so its result is the memoized one.
+        assert out == ['1', '1', '2'] and len(testmodule.handlers.calls) == 2
+        assert stats['memo_hit'].count == 1 and stats['clock'].count == 2
+        assert stats['memo_saved'].count == 1 and stats['memo_verified'] == 0
+
+    def test_store(self):
+        path = os.path.join(self.dir, 'memo.db')
+        self.run_main(['{"a": 1}', '{"a": 2}'], '--memo-store', path)
+        stats, out = self.run_main(['{"a": 2}', '{"a": 1}'], '--memo-store', path)
+        assert out == ['2', '1'] and len(testmodule.handlers.calls) == 2
+        assert stats['memo_hit'].count == 2 and stats['clock'].count == 0
+
+    def test_verify(self):
+        stats, out = self.run_main(['{"a": 1}', '{"a": 1}', '{"a": 1}'], '--memo-verify', '1')
+        # remember() is not deterministic, as it counts its calls.
+        assert len(testmodule.handlers.calls) == 3 and stats['memo_hit'].count == 0
+        assert stats['memo_verified'] == 2 and stats['memo_mismatches'] == 2
+        assert 'Nondeterminism' in out
+
+    def test_lru(self):
+        memo = emulambda.memo.Memo('code', size=2)
+        keys = [memo.key({'n': n}) for n in range(3)]
+        memo.put(keys[0], 0, 1, 1)
+        memo.put(keys[1], 1, 1, 1)
+        assert memo.get(keys[0]) == (0, 1, 1)
+        memo.put(keys[2], 2, 1, 1)
+        assert memo.get(keys[1]) is None and memo.get(keys[0]) is not None
+        memo.put(keys[1], object(), 1, 1)
+        assert memo.get(keys[1]) is None
+
+    def test_results_changed_by_json_not_kept(self):
+        memo = emulambda.memo.Memo('code')
+        keys = [memo.key({'n': n}) for n in range(3)]
+        memo.put(keys[0], {'pair': (1, 2)}, 1, 1)
+        memo.put(keys[1], {1: 'one'}, 1, 1)
+        memo.put(keys[2], {'pair': [1, 2]}, 1, 1)
+        assert memo.get(keys[0]) is None and memo.get(keys[1]) is None
+        assert memo.get(keys[2]) == ({'pair': [1, 2]}, 1, 1)
+
+    def test_keys(self):
+        fingerprint = emulambda.memo.code_fingerprint('testmodule.handlers.echo', testmodule.handlers.echo)
+        assert fingerprint == emulambda.memo.code_fingerprint('testmodule.handlers.echo', testmodule.handlers.echo)
+        memo = emulambda.memo.Memo(fingerprint)
+        assert memo.key({'a': 1, 'b': [1, 2]}) == memo.key({'b': [1, 2], 'a': 1})
+        assert memo.key({'a': 1}) != emulambda.memo.Memo(fingerprint + 'changed').key({'a': 1})
+        assert memo.key({'a': object()}) is None
+
+    def test_args(self):
+        sys.argv = [sys.argv[0], 'testmodule.handlers.remember', '-', '-s', '--memoize', '-w', '2']
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertRaises(SystemExit, emulambda.parseargs)
+        sys.argv = [sys.argv[0], 'testmodule.handlers.remember', '-', '--memo-verify', '2']
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertRaises(SystemExit, emulambda.parseargs)
+
+
+class EmulambdaTraceTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'run.trace')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_record(self):
+        for run in range(2):
+            tracer = emulambda.trace.Tracer(self.path)
+            tracer.start()
+            time.sleep(0.02)
+            tracer.stop(1, cold=True)
+            tracer.start()
+            sum(i * i for i in range(100000))
+            tracer.stop(2, error=True)
+            tracer.close()
+        runs = emulambda.trace.read_trace(self.path)
+        assert len(runs) == 2 and runs[0]['run'][0] != runs[1]['run'][0]
+        run = runs[1]
+        assert list(run['index']) == [1, 2] and run['flags'][0] & emulambda.trace.COLD
+        assert run['flags'][1] & emulambda.trace.ERROR and not run['flags'][1] & emulambda.trace.COLD
+        # Sleeping waits off CPU, and gives up the CPU voluntarily.
+        assert run['wall_ns'][0] >= 20000000 and run['cpu_ns'][0] < run['wall_ns'][0] / 2
+        assert run['voluntary'][0] >= 1 and run['cpu_ns'][1] > 0
+        assert os.path.getsize(self.path) == emulambda.trace.HEADER.size + 4 * emulambda.trace.WIDTH
+
+    def test_partial_record(self):
+        tracer = emulambda.trace.Tracer(self.path)
+        tracer.start()
+        tracer.stop(1)
+        tracer.close()
+        with open(self.path, 'ab') as f:
+            f.write(b'\0' * 10)
+        assert len(emulambda.trace.read_trace(self.path)[0]['index']) == 1
+        emulambda.trace.Tracer(self.path).close()
+        assert os.path.getsize(self.path) == emulambda.trace.HEADER.size + emulambda.trace.WIDTH
+
+    def test_not_a_trace(self):
+        with open(self.path, 'w') as f:
+            f.write('{"key": 1}\n' * 4)
+        self.assertRaises(ValueError, emulambda.trace.read_trace, self.path)
+        self.assertRaises(ValueError, emulambda.trace.Tracer, self.path)
+
+    def test_report(self):
+        for end in ('3', '2'):
+            sys.stdin = io.StringIO(u''.join('{"key": %i}\n' % i for i in range(1, 4)))
+            sys.argv = [sys.argv[0], 'testmodule.handlers.echo', '-', '-s', '--end', end, '--trace', self.path]
+            with contextlib.redirect_stdout(io.StringIO()):
+                emulambda.main()
+        sys.argv = [sys.argv[0], 'trace-report', self.path]
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            summaries = emulambda.main()
+        assert [summary['count'] for summary in summaries] == [3, 2]
+        assert summaries[0]['cold'] == 1 and summaries[0]['errors'] == 0
+        assert 'run.trace#2 against the baseline' in out.getvalue()
+
+    def test_args(self):
+        sys.argv = [sys.argv[0], 'testmodule.handlers.echo', '-', '-s', '-w', '2', '--trace', self.path]
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertRaises(SystemExit, emulambda.parseargs)
+        sys.argv = [sys.argv[0], 'testmodule.handlers.echo', '-', '-s', '--source', 'sqs', '--trace', self.path]
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertRaises(SystemExit, emulambda.parseargs)
+
+
+class EmulambdaOnlineStatsTest(unittest.TestCase):
+    def test_moments(self):
+        stats = emulambda.stats.OnlineStats()
+        for x in [2, 4, 4, 4, 5, 5, 7, 9]:
+            stats.add(x)
+        assert stats.count == 8
+        assert stats.mean == 5.0
+        assert abs(stats.stddev() - 2.13808993) < 1e-6
+        assert (stats.min, stats.max) == (2, 9)
+
+    def test_percentiles(self):
+        stats = emulambda.stats.OnlineStats(precision=0.01)
+        samples = [(i * 7919) % 10007 / 10.0 for i in range(10007)]
+        for x in samples:
+            stats.add(x)
+        samples.sort()
+        for q in (50, 90, 99, 99.9):
+            exact = samples[int(q / 100.0 * (len(samples) - 1))]
+            assert abs(stats.percentile(q) - exact) <= exact * 0.02
+        assert stats.samples is None
+
+    def test_merge(self):
+        a, b, both = [emulambda.stats.OnlineStats() for _ in range(3)]
+        for x in range(100):
+            (a if x % 3 else b).add(x)
+            both.add(x)
+        a.merge(b)
+        assert a.count == both.count
+        assert abs(a.mean - both.mean) < 1e-9
+        assert abs(a.stddev() - both.stddev()) < 1e-9
+        assert a.percentile(50) == both.percentile(50)
+
+
+class StubSTSHandler(BaseHTTPRequestHandler):
+    expiration = '2100-01-01T00:00:00Z'
+    calls = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        StubSTSHandler.calls += 1
+        body = ('<AssumeRoleResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/"><AssumeRoleResult>'
+                '<Credentials><AccessKeyId>ASIASTUB%i</AccessKeyId><SecretAccessKey>secret</SecretAccessKey>'
+                '<SessionToken>token</SessionToken><Expiration>%s</Expiration></Credentials>'
+                '<AssumedRoleUser><AssumedRoleId>AROASTUB:emulambda</AssumedRoleId><Arn>arn:aws:sts::123456789012:'
+                'assumed-role/stub/emulambda</Arn></AssumedRoleUser></AssumeRoleResult>'
+                '<ResponseMetadata><RequestId>stub</RequestId></ResponseMetadata></AssumeRoleResponse>'
+                % (StubSTSHandler.calls, StubSTSHandler.expiration)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class EmulambdaCredentialCacheTest(unittest.TestCase):
+    role = 'arn:aws:iam::123456789012:role/stub'
+
+    def setUp(self):
+        self.env = dict(os.environ)
+        os.environ.update({'AWS_ACCESS_KEY_ID': 'stub', 'AWS_SECRET_ACCESS_KEY': 'stub',
+                           'AWS_DEFAULT_REGION': 'us-east-1'})
+        StubSTSHandler.calls = 0
+        self.server = HTTPServer(('127.0.0.1', 0), StubSTSHandler)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.cache = emulambda.credentials.CredentialCache(
+            endpoint_url='http://127.0.0.1:%i' % self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        boto3.DEFAULT_SESSION = None
+        os.environ.clear()
+        os.environ.update(self.env)
+
+    def test_session_is_cached(self):
+        StubSTSHandler.expiration = '2100-01-01T00:00:00Z'
+        first = self.cache.session(self.role)
+        assert self.cache.session(self.role) is first
+        assert first.client('s3') is first.client('s3')
+        assert StubSTSHandler.calls == 1
+        assert first.get_credentials().access_key == 'ASIASTUB1'
+
+    def test_session_refreshed_before_expiration(self):
+        StubSTSHandler.expiration = '2000-01-01T00:00:00Z'
+        first = self.cache.session(self.role)
+        assert self.cache.session(self.role) is not first
+        assert StubSTSHandler.calls == 2
+
+    def test_endpoint_changed(self):
+        StubSTSHandler.expiration = '2100-01-01T00:00:00Z'
+        self.cache.session(self.role)
+        other = HTTPServer(('127.0.0.1', 0), StubSTSHandler)
+        threading.Thread(target=other.serve_forever).start()
+        try:
+            self.cache.endpoint_url = 'http://127.0.0.1:%i' % other.server_address[1]
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = other
+            self.cache.session(self.role + '2')
+        except Exception:
+            other.shutdown()
+            other.server_close()
+            raise
+        assert StubSTSHandler.calls == 2
+
+    def test_invoke_lambda_with_role(self):
+        StubSTSHandler.expiration = '2100-01-01T00:00:00Z'
+        emulambda.credentials.default_cache, default = self.cache, emulambda.credentials.default_cache
+        try:
+            for _ in range(3):
+                emulambda.invoke_lambda(lambda e, c: e, {}, None, 300, self.role)
+        finally:
+            emulambda.credentials.default_cache = default
+        assert StubSTSHandler.calls == 1
+
+
+class EmulambdaTimeoutTest(unittest.TestCase):
+    def spin(self, e, c):
+        while True:
+            pass
+
+    def test_timeout_main_thread(self):
+        s = time.time()
+        result, clock = emulambda.invoke_lambda(self.spin, {}, None, 0.05, None)
+        assert result == "EMULAMBDA: TIMEOUT ERROR"
+        assert time.time() - s < 1
+
+    def test_timeout_worker_threads(self):
+        results = list()
+
+        def run():
+            results.append(emulambda.invoke_lambda(self.spin, {}, None, 0.05, None)[0])
+
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        s = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results == ["EMULAMBDA: TIMEOUT ERROR"] * 4
+        assert time.time() - s < 1
+
+    def test_no_timeout(self):
+        with emulambda.timeout.Deadline(0.05):
+            pass
+        time.sleep(0.1)
+        result, clock = emulambda.invoke_lambda(lambda e, c: 'ok', {}, None, 0.05, None)
+        assert result == 'ok'
+
+    def test_late_alarm_restores_deadline(self):
+        # SIGALRM arriving as the deadline is disarmed raises in __exit__, which must still restore the thread.
+        setitimer = signal.setitimer
+
+        def late(which, seconds, *interval):
+            setitimer(which, seconds, *interval)
+            if seconds == 0:
+                raise emulambda.timeout.TimeoutError('Timer Expired')
+
+        signal.setitimer = late
+        try:
+            with emulambda.timeout.Deadline(5):
+                pass
+        except emulambda.timeout.TimeoutError:
+            pass
+        finally:
+            signal.setitimer = setitimer
+        assert emulambda.timeout.remaining_millis() is None
+        result, clock = emulambda.invoke_lambda(lambda e, c: 'ok', {}, None, 0.05, None)
+        assert result == 'ok'
+
+    def test_remaining_time(self):
+        result, clock = emulambda.invoke_lambda(lambda e, c: c.get_remaining_time_in_millis(), {}, None, 2, None)
+        assert 1900 < result <= 2000
+        assert emulambda.timeout.remaining_millis() is None
+
+
+class EmulambdaServerTest(unittest.TestCase):
+    def setUp(self):
+        def run(event, context):
+            result, exec_clock = emulambda.invoke_lambda(testmodule.handlers.echo, event, context, 1, None)
+            return result, exec_clock, 0, None
+
+        functions = {'echo': emulambda.server.Function('echo', run)}
+        self.server = emulambda.server.InvokeServer(('127.0.0.1', 0), functions, 2)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.url = 'http://127.0.0.1:%i' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_boto3_invoke(self):
+        client = boto3.client('lambda', endpoint_url=self.url, region_name='us-east-1',
+                                                    aws_access_key_id='stub', aws_secret_access_key='stub')
+        response = client.invoke(FunctionName='echo', Payload=b'{"key": "value"}')
+        assert json.loads(response['Payload'].read()) == 'value'
+        response = client.invoke(FunctionName='echo', Payload=b'{}')
+        assert response['FunctionError'] == 'Unhandled'
+        stats = json.loads(urlopen(self.url + '/stats').read().decode('utf-8'))
+        assert stats['echo']['clock']['count'] == 1
+        assert stats['echo']['errors'] == 1
+
+    def test_event_invocations_bounded(self):
+        requests = [Request(self.url + '/2015-03-31/functions/echo/invocations', data=b'{"key": %i}' % i,
+                            headers={'X-Amz-Invocation-Type': 'Event'}) for i in range(20)]
+        for request in requests:
+            assert urlopen(request).status == 202
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            stats = json.loads(urlopen(self.url + '/stats').read().decode('utf-8'))
+            if stats['echo']['clock']['count'] == 20:
+                break
+            time.sleep(0.01)
+        assert stats['echo']['clock']['count'] == 20
+        # Queued to the pool, not a thread each.
+        assert len([t for t in threading.enumerate() if t.name.startswith('emulambda-event')]) <= 2
+
+    def test_unknown_function(self):
+        self.server.functions['other'] = self.server.functions['echo']
+        client = boto3.client('lambda', endpoint_url=self.url, region_name='us-east-1',
+                                                    aws_access_key_id='stub', aws_secret_access_key='stub')
+        self.assertRaises(client.exceptions.ResourceNotFoundException, client.invoke, FunctionName='missing')
+
+
+class EmulambdaAsyncioTest(unittest.TestCase):
+    def run_main(self, handler, lines, *extra):
+        return run_main([handler, '-', '-s', '--asyncio', '--concurrency', '10'] + list(extra), lines)[1:]
+
+    def test_coroutine_lambdas_overlap(self):
+        lines = ['{"key": %i, "sleep": 0.2}' % i for i in range(10)]
+        out, elapsed = self.run_main('testmodule.async_handlers.sleepy', lines)
+        assert sorted(out, key=int) == [str(i) for i in range(10)]
+        assert elapsed < 1
+
+    def test_coroutine_timeout(self):
+        out, elapsed = self.run_main('testmodule.async_handlers.sleepy', ['{"key": 1, "sleep": 5}'], '-t', '0.1')
+        assert 'EMULAMBDA: TIMEOUT ERROR' in ' '.join(out)
+
+    def test_sync_lambdas(self):
+        out, elapsed = self.run_main('testmodule.handlers.echo', ['{"key": %i}' % i for i in range(20)])
+        assert sorted(out, key=int) == [str(i) for i in range(20)]
+
+    def test_sync_timeout_from_pickup(self):
+        # A stuck event must not time out the events queued behind it, nor free its slot while it still runs.
+        lines = ['{"key": 1, "sleep": 0.6}', '{"key": 2, "sleep": 0.05}', '{"key": 3, "sleep": 0.05}']
+        out, elapsed = self.run_main('testmodule.handlers.sleepy', lines, '--concurrency', '1', '-t', '0.2')
+        results = ' '.join(out)
+        assert results.count('EMULAMBDA: TIMEOUT ERROR') == 1
+        assert out[-2:] == ['2', '3']
+        assert elapsed >= 0.7
+
+    def test_replay_arrival_times(self):
+        lines = ['{"key": %i, "sleep": 0, "at": %f}' % (i, 1000 + i * 0.1) for i in range(4)]
+        out, elapsed = self.run_main('testmodule.async_handlers.sleepy', lines, '--replay-field', 'at')
+        assert elapsed >= 0.3
+
+
+class EmulambdaSerializerTest(unittest.TestCase):
+    def tearDown(self):
+        emulambda.serializer.select()
+
+    def test_backends(self):
+        for backend in ('auto', 'json'):
+            emulambda.serializer.select(backend)
+            assert emulambda.serializer.loads('{"a": [1, 2.5, "\\u00e9"]}') == {'a': [1, 2.5, u'é']}
+            assert json.loads(emulambda.serializer.dumps({'a': [1, None, True]})) == {'a': [1, None, True]}
+
+    def test_same_output_across_backends(self):
+        for backend in ('orjson', 'ujson', 'json'):
+            try:
+                emulambda.serializer.select(backend)
+            except ValueError:
+                continue
+            assert emulambda.serializer.dumps({'path': 'a/b'}).replace(' ', '') == '{"path":"a/b"}', backend
+
+    def test_unserializable(self):
+        assert json.loads(emulambda.serializer.dumps({1: 2 ** 70})) == {'1': 2 ** 70}
+        assert json.loads(emulambda.serializer.dumps(set())) == 'set()'
+
+    def test_results_are_json_lines(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            emulambda.render.render_result(False, 'foo.bar', {'key': 'value'}, 1, 1)
+            emulambda.render.render_result(False, 'foo.bar', 'value', 1, 1)
+            assert out.getvalue() == ''
+            emulambda.render.flush_results()
+        assert [json.loads(line) for line in out.getvalue().splitlines()] == [{'key': 'value'}, 'value']
+
+
+class EmulambdaEventFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'events.ldjson')
+        with open(self.path, 'w') as f:
+            f.write(''.join('{"key": %i}\n' % i for i in range(1, 101)))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_index(self):
+        events = emulambda.eventfile.EventFile(self.path)
+        assert len(events) == 100
+        assert json.loads(events.line(42)) == {'key': 42}
+        assert os.path.exists(self.path + '.idx')
+        reloaded = emulambda.eventfile.EventFile(self.path)
+        assert isinstance(reloaded.offsets, memoryview)
+        assert json.loads(reloaded.line(100)) == {'key': 100}
+
+    def test_index_rebuilt_when_file_changes(self):
+        emulambda.eventfile.EventFile(self.path)
+        with open(self.path, 'a') as f:
+            f.write('{"key": 101}')
+        events = emulambda.eventfile.EventFile(self.path)
+        assert len(events) == 101
+        assert json.loads(events.line(101)) == {'key': 101}
+
+    def test_slices_and_parts(self):
+        lines = emulambda.eventfile.read_events(self.path, start=10, end=30, step=10)
+        assert [i for i, line in lines] == [10, 20, 30]
+        parts = [[i for i, line in emulambda.eventfile.read_events(self.path, part=(k, 3))] for k in (1, 2, 3)]
+        assert sum(parts, []) == list(range(1, 101))
+        assert all(20 < len(part) < 45 for part in parts)
+
+    def test_checkpoint_resume(self):
+        checkpoint_path = os.path.join(self.dir, 'checkpoint')
+        checkpoint = emulambda.eventfile.Checkpoint(checkpoint_path, every=10)
+        for i, line in emulambda.eventfile.read_events(self.path, checkpoint=checkpoint):
+            if i > 25:
+                break
+            checkpoint.done(i)
+        checkpoint.save()
+        resumed = emulambda.eventfile.Checkpoint(checkpoint_path)
+        assert resumed.resumed == 25
+        assert next(emulambda.eventfile.read_events(self.path, checkpoint=resumed))[0] == 26
+        # Resuming with another slice would skip lines the run never took.
+        self.assertRaises(ValueError, emulambda.eventfile.Checkpoint, checkpoint_path, step=3)
+        self.assertRaises(ValueError, emulambda.eventfile.Checkpoint, checkpoint_path, part=(1, 2))
+        self.assertRaises(ValueError, emulambda.eventfile.Checkpoint, checkpoint_path, end=50)
+
+    def test_close(self):
+        with emulambda.eventfile.EventFile(self.path) as events:
+            events.line(1)
+        assert events.data.closed
+        reloaded = emulambda.eventfile.EventFile(self.path)
+        reloaded.close()
+        assert reloaded.data.closed and isinstance(reloaded.offsets, memoryview)
+
+    def test_part_with_stdin(self):
+        sys.argv = [sys.argv[0], 'testmodule.handlers.echo', '-', '-s', '--part', '1/2']
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertRaises(SystemExit, emulambda.parseargs)
+
+    def test_index_little_endian(self):
+        emulambda.eventfile.EventFile(self.path)
+        with open(self.path + '.idx', 'rb') as f:
+            f.seek(emulambda.eventfile.INDEX_HEADER.size + 8)
+            assert struct.unpack('<Q', f.read(8))[0] == len('{"key": 1}\n')
+
+    def test_stream_slice_from_stdin(self):
+        sys.stdin = io.StringIO(u''.join('{"key": %i}\n' % i for i in range(1, 11)))
+        sys.argv = [sys.argv[0], 'testmodule.handlers.echo', '-', '-s', '--start', '3', '--sample', '3']
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            emulambda.main()
+        assert out.getvalue().split() == ['3', '6', '9']
+
+
+class EmulambdaGCPolicyTest(unittest.TestCase):
+    def forced(self, policy, invocations, meter=None):
+        stats = emulambda.stats.new_stats()
+        gc_policy = emulambda.gcpolicy.GCPolicy(policy, meter, stats)
+        try:
+            for _ in range(invocations):
+                gc_policy.before()
+        finally:
+            gc_policy.close()
+        return stats['forced_gc'].count
+
+    def test_policies(self):
+        assert self.forced('always', 5) == 5
+        assert self.forced('never', 5) == 0
+        assert self.forced('every-2', 5) == 2
+        assert self.forced('adaptive', 5, emulambda.memory.RusageMeter()) == 0
+
+    def test_adaptive(self):
+        meter = emulambda.memory.get_meter('tracemalloc')
+        policy = emulambda.gcpolicy.GCPolicy('adaptive', meter)
+        try:
+            garbage = [[] for _ in range(1000)]
+            policy.before()
+            assert [forced for forced, ms in policy.drain() if forced] == [True]
+        finally:
+            policy.close()
+            meter.tracemalloc.stop()
+
+    def test_adaptive_generation(self):
+        meter = emulambda.memory.get_meter('tracemalloc')
+        policy = emulambda.gcpolicy.GCPolicy('adaptive', meter)
+        generations = list()
+        collect = policy._collect
+        policy._collect = lambda generation=2: (generations.append(generation), collect(generation))
+        try:
+            gc.collect()
+            garbage = [[] for _ in range(100)]
+            policy.before()
+            # A little new garbage is collected young, not with a full collection.
+            assert generations[-1] == 0
+            for _ in range(gc.get_threshold()[2]):
+                gc.collect(1)
+            policy.before()
+            assert generations[-1] == 2
+        finally:
+            policy.close()
+            meter.tracemalloc.stop()
+
+    def test_parse(self):
+        assert emulambda.gcpolicy.parse_policy('every-100') == 'every-100'
+        for value in ('every-N', 'every-0', 'sometimes'):
+            self.assertRaises(argparse.ArgumentTypeError, emulambda.gcpolicy.parse_policy, value)
+
+    def test_stream_summary(self):
+        sys.argv = [sys.argv[0], 'example.example_handler', 'example/ex-stream.ldjson', '-s', '-v', '--gc', 'every-2']
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            stats = emulambda.main()
+        assert stats['forced_gc'].count > 0
+        assert 'Forced by policy: %i collections' % stats['forced_gc'].count in out.getvalue()
+
+
+class EmulambdaMetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_main(self, name, *extra):
+        path = os.path.join(self.dir, name)
+        run_main(['example.example_handler', 'example/ex-stream.ldjson', '-s', '--end', '3', '--metrics', path] +
+                 list(extra))
+        return path
+
+    def test_jsonl(self):
+        with open(self.run_main('metrics.jsonl')) as f:
+            records = [json.loads(line) for line in f]
+        assert [r['type'] for r in records] == ['invocation'] * 3 + ['summary']
+        assert [r['index'] for r in records[:3]] == [1, 2, 3]
+        assert [r['cold'] for r in records[:3]] == [True, False, False]
+        assert records[0]['billed_ms'] % 100 == 0 and records[0]['gc_ms'] is not None
+        assert records[3]['clock']['count'] == 3 and records[3]['errors'] == 0
+
+    def test_csv(self):
+        path = self.run_main('metrics.csv', '--workers', '2', '--chunk-size', '1')
+        with open(path) as f:
+            assert [row['index'] for row in csv.DictReader(f)] == ['1', '2', '3']
+        with open(os.path.join(self.dir, 'metrics.summary.csv')) as f:
+            assert dict((row['metric'], row['count']) for row in csv.DictReader(f))['clock'] == '3'
+
+    def test_prometheus(self):
+        with open(self.run_main('metrics.prom')) as f:
+            text = f.read()
+        assert 'emulambda_invocations_total{error="none"} 3.0' in text
+        assert 'emulambda_duration_ms_count 3.0' in text
+
+    def test_error_type(self):
+        assert emulambda.metrics.error_type("EMULAMBDA: OUT OF MEMORY ERROR", -1) == 'out_of_memory'
+        assert emulambda.metrics.error_type("EMULAMBDA: OUT OF MEMORY ERROR", 5) is None
+
+
+class EmulambdaLogCaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_capture(self):
+        path = os.path.join(self.dir, 'run.log')
+        sys.stdin = io.StringIO(u''.join('{"key": %i}\n' % i for i in range(1, 4)))
+        sys.argv = [sys.argv[0], 'testmodule.handlers.chatty', '-', '-s', '--log-file', path]
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            stats = emulambda.main()
+        assert out.getvalue().split() == ['1', '2', '3']
+        with open(path) as f:
+            lines = f.read().splitlines()
+        assert len(lines) == 15
+        assert lines[0].startswith('START RequestId: ') and lines[1] == 'processing 1'
+        assert lines[2].startswith('[WARNING]\t') and lines[2].endswith('\tkey 1')
+        assert lines[3].startswith('END RequestId: ')
+        assert lines[4].startswith('REPORT RequestId: ') and 'Init Duration: ' in lines[4]
+        # The absolute peak of the process, as Lambda reports, rather than the growth during the invocation.
+        assert int(lines[4].split('Max Memory Used: ')[1].split(' MB')[0]) > 1
+        assert 'Init Duration: ' not in lines[9]
+        assert stats['log_lines'].count == 3 and stats['log_lines'].max == 2
+        assert stats['log_bytes'].min == len('processing 1\n') + len(lines[2]) + 1
+        assert stats['log_write'].count == 1
+
+    def test_restores_streams(self):
+        capture = emulambda.logs.LogCapture(os.path.join(self.dir, 'run.log'))
+        stdout = sys.stdout
+        capture.start()
+        print('captured')
+        capture.stop(-1, 0)
+        capture.close()
+        assert sys.stdout is stdout
+        with open(os.path.join(self.dir, 'run.log')) as f:
+            assert 'captured\nEND' in f.read()
+
+
+class EmulambdaSourcesTest(unittest.TestCase):
+    def run_source(self, source, lines, *extra):
+        sys.stdin = io.StringIO(u''.join(line + '\n' for line in lines))
+        sys.argv = [sys.argv[0], 'testmodule.handlers.batch', '-', '-s', '--source', source] + list(extra)
+        args = emulambda.parseargs()
+        batches = list()
+
+        def run(event, context):
+            batches.append(event['Records'])
+            return testmodule.handlers.batch(event, context), 1, 0, None
+
+        report = emulambda.sources.emit_batches(args, run, lambda *r: None)
+        return report, batches
+
+    def test_sqs_retries_failed_messages(self):
+        lines = ['{"id": %i%s}' % (i, ', "fail": true' if i == 2 else '') for i in range(1, 6)]
+        report, batches = self.run_source('sqs', lines, '--batch-size', '3', '--max-attempts', '2')
+        bodies = [[json.loads(r['body'])['id'] for r in records] for records in batches]
+        assert bodies == [[1, 2, 3], [2, 4, 5]]
+        assert batches[1][0]['attributes']['ApproximateReceiveCount'] == '2'
+        assert report['records'] == 5 and report['failures'] == 2 and report['dropped'] == 1
+
+    def test_kinesis_retries_from_first_failure(self):
+        lines = ['{"id": %i%s}' % (i, ', "fail": true' if i == 2 else '') for i in range(1, 5)]
+        report, batches = self.run_source('kinesis', lines, '--batch-size', '3', '--max-attempts', '2')
+        sequences = [[int(r['kinesis']['sequenceNumber']) for r in records] for records in batches]
+        assert sequences == [[1, 2, 3], [2, 3, 4], [3, 4]]
+        assert report['dropped'] == 1
+
+    def test_batch_window(self):
+        lines = ['{"at": %f}' % at for at in (0, 0.5, 2, 2.1, 10)]
+        report, batches = self.run_source('sqs', lines, '--batch-window', '1', '--replay-field', 'at')
+        assert [len(records) for records in batches] == [2, 2, 1]
+
+    def test_batch_window_needs_replay_field(self):
+        sys.argv = [sys.argv[0], 'testmodule.handlers.batch', '-', '-s', '--source', 'sqs', '--batch-window', '1']
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertRaises(SystemExit, emulambda.parseargs)
+
+    def test_dynamodb_shape(self):
+        report, batches = self.run_source('dynamodb', ['{"name": "a", "n": 1, "tags": [true, null]}'],
+                                          '--partition-key', 'name')
+        record = batches[0][0]['dynamodb']
+        assert record['Keys'] == {'name': {'S': 'a'}}
+        assert record['NewImage'] == {'name': {'S': 'a'}, 'n': {'N': '1'},
+                                      'tags': {'L': [{'BOOL': True}, {'NULL': True}]}}
+
+
+class EmulambdaLoadTest(unittest.TestCase):
+    def test_schedule(self):
+        events = [(i, '{"at": %i}' % (100 + i * 2)) for i in range(1, 5)]
+        fixed = [due for i, line, due in emulambda.loadgen.schedule(iter(events), 'fixed', rate=4)]
+        assert fixed == [0, 0.25, 0.5, 0.75]
+        replay = [due for i, line, due in emulambda.loadgen.schedule(iter(events), 'replay', field='at')]
+        assert replay == [0, 2, 4, 6]
+        poisson = [due for i, line, due in emulambda.loadgen.schedule(iter(events * 250), 'poisson', rate=100, seed=1)]
+        assert 8 < poisson[-1] < 12
+
+    def run_load(self, *extra):
+        with stream_file(['{"key": %i, "sleep": 0.05}' % i for i in range(1, 21)]) as stream:
+            sys.argv = [sys.argv[0], 'testmodule.handlers.sleepy', stream, '-s', '--load', 'fixed',
+                        '--rate', '200', '--concurrency', '2', '--gc', 'never'] + list(extra)
+            args = emulambda.parseargs()
+            results = list()
+            stats, report = emulambda.loadgen.emit_load(args, lambda *r: results.append(r[0]))
+        return results, stats, report
+
+    def test_queue(self):
+        results, stats, report = self.run_load()
+        assert sorted(results) == list(range(1, 21))
+        assert len(stats) == 2 and report['completed'] == 20 and report['peak'] == 2
+        assert report['queue'].max > 200 and report['latency'].min >= 50
+
+    def test_reject(self):
+        results, stats, report = self.run_load('--throttle', 'reject')
+        assert report['throttled'] > 10 and report['completed'] == len(results) == 20 - report['throttled']
+
+
+class EmulambdaManifestTest(unittest.TestCase):
+    template = '\n'.join([
+        'Globals:',
+        '  Function:',
+        '    Timeout: 5',
+        '    MemorySize: 256',
+        'Resources:',
+        '  Echo:',
+        '    Type: AWS::Serverless::Function',
+        '    Properties:',
+        '      Handler: testmodule.handlers.echo',
+        '      Role: !GetAtt Role.Arn',
+        '  Sleepy:',
+        '    Type: AWS::Serverless::Function',
+        '    Properties:',
+        '      Handler: testmodule.handlers.sleepy',
+        '      Timeout: 0.05',
+        '      MemorySize: !Ref Memory',
+        '  Shared:',
+        '    Type: AWS::Serverless::Function',
+        '    Properties:',
+        '      Handler: emulambda_test_shared.handler',
+        '      CodeUri: src',
+        '  Node:',
+        '    Type: AWS::Serverless::Function',
+        '    Properties:',
+        '      Handler: index.handler',
+        '      Runtime: nodejs18.x',
+    ])
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.path, 'src'))
+        with open(os.path.join(self.path, 'src', 'emulambda_test_shared.py'), 'w') as f:
+            f.write('def handler(event, context):\n    return "shared"\n')
+        with open(os.path.join(self.path, 'template.yaml'), 'w') as f:
+            f.write(self.template)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        sys.path.remove(os.path.join(self.path, 'src')) if os.path.join(self.path, 'src') in sys.path else None
+        sys.modules.pop('emulambda_test_shared', None)
+
+    def write(self, name, document):
+        with open(os.path.join(self.path, name), 'w') as f:
+            json.dump(document, f)
+        return os.path.join(self.path, name)
+
+    def test_template(self):
+        routes = emulambda.manifest.load_manifest(os.path.join(self.path, 'template.yaml'))
+        assert [(r.name, r.handler, r.timeout, r.memory_size) for r in routes] == [
+            ('Echo', 'testmodule.handlers.echo', 5, 256), ('Sleepy', 'testmodule.handlers.sleepy', 0.05, 256),
+            ('Shared', 'emulambda_test_shared.handler', 5, 256)]
+        assert routes[2].code_uri == os.path.join(self.path, 'src')
+
+    def test_list(self):
+        path = self.write('functions.json', [{'name': 'echo', 'handler': 'testmodule.handlers.echo', 'timeout': 1},
+                                             'testmodule.handlers.sleepy'])
+        routes = emulambda.manifest.load_manifest(path)
+        assert [(r.name, r.timeout) for r in routes] == [('echo', 1), ('testmodule.handlers.sleepy', None)]
+        assert emulambda.manifest.is_manifest(path) and not emulambda.manifest.is_manifest('testmodule.handlers.echo')
+
+    def test_invalid(self):
+        for document in ([], [{'name': 'a', 'handler': 'm.a'}, {'name': 'a', 'handler': 'm.b'}],
+                         [{'handler': 'm.a', 'code_uri': 'x'}, {'handler': 'm.b', 'code_uri': 'y'}], [{'name': 'a'}]):
+            self.assertRaises(ValueError, emulambda.manifest.load_manifest, self.write('bad.json', document))
+
+    def test_route(self):
+        router = emulambda.manifest.Router(emulambda.manifest.load_manifest(os.path.join(self.path, 'template.yaml')),
+                                           'function')
+        router.load()
+        assert router.route({'function': 'Shared'}).func({}, None) == 'shared'
+        assert router.route({'function': 'testmodule.handlers.echo'}).name == 'Echo'
+        assert router.route({'function': 'missing'}) is None and router.route({}) is None
+        assert router.unrouted == 2
+        assert emulambda.import_lambda('testmodule.handlers.echo') is router.routes[0].func
+
+    def test_main(self):
+        stream = self.write('events.ldjson', {})
+        with open(stream, 'w') as f:
+            f.write('{"function": "Echo", "key": 1}\n{"function": "Sleepy", "sleep": 0.2, "key": 2}\n'
+                    '{"function": "Nope"}\n{"function": "Shared"}\n{"function": "Sleepy", "sleep": 0, "key": 5}\n')
+        sys.argv = [sys.argv[0], os.path.join(self.path, 'template.yaml'), stream, '-s', '-v']
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            stats = emulambda.main()
+        output = out.getvalue()
+        assert stats['clock'].count == 3 and stats['errors'] == 2
+        assert '"EMULAMBDA: TIMEOUT ERROR"' in output and '"EMULAMBDA: ROUTING ERROR"' in output
+        assert 'Functions (routed by the "function" field of each event)' in output
+        assert 'Events naming no function: 1' in output
+
+    def test_parseargs(self):
+        sys.argv = [sys.argv[0], os.path.join(self.path, 'template.yaml'), '-', '-s', '-w', '2']
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertRaises(SystemExit, emulambda.parseargs)
+
+
+class EmulambdaBenchTest(unittest.TestCase):
+    def result(self, samples, rss=1024 * 1024):
+        samples = sorted(samples)
+        return {'p50': samples[len(samples) // 2], 'p99': samples[-1], 'rss': rss, 'samples': samples}
+
+    def test_mann_whitney(self):
+        slow, fast = [i + 50 for i in range(100)], list(range(100))
+        assert emulambda.bench.mann_whitney(slow, fast) < 0.001
+        assert emulambda.bench.mann_whitney(fast, slow) > 0.999
+        assert 0.2 < emulambda.bench.mann_whitney(fast, fast) < 0.8
+        assert emulambda.bench.mann_whitney([1] * 10, [1] * 10) == 1.0
+
+    def test_compare(self):
+        baseline = {'noop/serial': self.result(range(100))}
+        same = emulambda.bench.compare(baseline, {'noop/serial': self.result(range(100))})
+        assert not any(row[-1] for row in same)
+        slower = emulambda.bench.compare(baseline, {'noop/serial': self.result(range(50, 150)), 'new/serial': {}})
+        assert [row[1] for row in slower if row[-1]] == ['p50', 'p99']
+        bigger = emulambda.bench.compare(baseline, {'noop/serial': self.result(range(100), rss=4 * 1024 * 1024)})
+        assert [row[1] for row in bigger if row[-1]] == ['rss']
+
+    def test_compare_tiny_latency(self):
+        # A microsecond handler 20% slower, significantly, is still within the latency slack.
+        baseline = {'noop/serial': self.result([0.001 + i * 1e-6 for i in range(100)])}
+        slower = {'noop/serial': self.result([0.0012 + i * 1e-6 for i in range(100)])}
+        rows = emulambda.bench.compare(baseline, slower)
+        assert rows[0][4] > 0.1 and rows[0][5] < 0.01
+        assert not any(row[-1] for row in rows)
+        assert [row[1] for row in emulambda.bench.compare(baseline, slower, latency_slack=0) if row[-1]] == \
+            ['p50', 'p99']
+
+    def test_run(self):
+        results = emulambda.bench.run_all({'noop': 'emulambda.bench.noop'}, ['serial'], 20)
+        assert results['noop/serial']['events'] == 20
+        assert len(results['noop/serial']['samples']) == 20
+        assert results['noop/serial']['overhead'] is not None
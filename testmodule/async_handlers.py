@@ -0,0 +1,8 @@
+import asyncio
+
+__author__ = 'dominiczippilli'
+
+
+async def sleepy(event, context):
+    await asyncio.sleep(event['sleep'])
+    return event['key']
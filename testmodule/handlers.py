@@ -0,0 +1,55 @@
+import base64
+import json
+import logging
+import os
+import signal
+import time
+
+__author__ = 'dominiczippilli'
+
+
+def echo(event, context):
+    return event['key']
+
+
+def allocate(event, context):
+    data = bytearray(event['mb'] * 1024 * 1024)
+    data[::4096] = b'x' * len(data[::4096])
+    return len(data)
+
+
+calls = list()
+
+
+def remember(event, context):
+    calls.append(event)
+    return len(calls)
+
+
+def crash(event, context):
+    if event.get('crash'):
+        os.kill(os.getpid(), signal.SIGSEGV)
+    return 'ok'
+
+
+def chatty(event, context):
+    print('processing %s' % event['key'])
+    logging.getLogger().warning('key %s', event['key'])
+    return event['key']
+
+
+def batch(event, context):
+    failed = list()
+    for record in event['Records']:
+        if 'dynamodb' in record:
+            continue
+        body = json.loads(record['body']) if 'body' in record else \
+            json.loads(base64.b64decode(record['kinesis']['data']).decode('utf-8'))
+        if body.get('fail'):
+            failed.append({'itemIdentifier': record.get('messageId') or record['kinesis']['sequenceNumber']})
+    return {'batchItemFailures': failed}
+
+
+def sleepy(event, context):
+    time.sleep(event['sleep'])
+    return event['key']